@@ -1,5 +1,6 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 
 /*
 This program has been created to handle an incompatibility between how mysqldump escapes
@@ -62,135 +63,124 @@ hexdump after passing through this program:
 
 Author : vamsi Nov 2015
 
-*/
-
-#define FALSE 0
-#define TRUE 1
+The input is processed in blocks: memchr finds the next 0x5c, everything
+before it is copied in bulk, and only runs of 0x5c are looked at byte by
+byte. A run of 0x5c at the end of a block is carried over to the next block.
 
-#define RBUFFERLEN 65536
+Build the nullescape CLI:
 
-char bufferR[RBUFFERLEN];
-int ibufferR = 0; /* index in bufferR */
-int nbufferR = 0; /* number of valid chars in bufferR */
+  gcc -O2 -o nullescape NullEscape.c
 
+Build the shared library used by lib/nullescape.py:
 
-#define WBUFFERLEN 65536
+  gcc -O2 -shared -fPIC -DNULLESCAPE_NO_MAIN -o lib/libnullescape.so NullEscape.c
 
-char bufferW[WBUFFERLEN];
-int ibufferW = 0; /* index in bufferW upto which we wrote */
+*/
 
-/* wrapper for efficieny. Returns if eof reached. If not, puts next char in *addrc  */
-int getcharWrapper(char *addrc) {
-  int error = 0;
+#define BLOCKLEN 65536
 
-  if ((nbufferR <= ibufferR) && !feof(stdin))  {
-    /* we used up what we read earlier */
+/*
+ * Transform len bytes of in into out, which must have room for len + *pending
+ * bytes. *pending is the number of 0x5c at the end of the previous block that
+ * have not yet been output, and is updated for the next block. Returns the
+ * number of bytes written to out. At the end of the stream, *pending 0x5c
+ * must be output.
+ */
+size_t nullescape_block(const char *in, size_t len, char *out, long *pending) {
+  size_t i = 0;
+  size_t o = 0;
+  long run = *pending;
+
+  while (i < len) {
+    if (run == 0) {
+      const char *next = memchr(in + i, 0x5c, len - i);
+      size_t span = next ? (size_t)(next - in) - i : len - i;
+
+      memcpy(out + o, in + i, span);
+      o += span;
+      i += span;
+      if (i == len) {
+        break;
+      }
+    }
 
-    nbufferR = fread(bufferR, 1, RBUFFERLEN, stdin);
-    ibufferR = 0;
+    /* count the run of 0x5c, which may have started in a previous block */
+    while (i < len && in[i] == 0x5c) {
+      run++;
+      i++;
+    }
 
-    if ((nbufferR != RBUFFERLEN) && !feof(stdin)) {
-      error = ferror(stdin);
-      fprintf(stderr, "Read failed with error %d\n", error);
-      exit(1);
+    if (i == len) {
+      /* the run may continue in the next block */
+      break;
     }
-  }
 
-  if (nbufferR <= ibufferR) {
-    return TRUE;
+    if (in[i] == 0x30 && run % 2 == 1) {
+      /* 0x5c30 with no or an even number of 0x5c before it */
+      memset(out + o, 0x5c, run - 1);
+      o += run - 1;
+      out[o++] = 0x00;
+      i++;
+    } else {
+      memset(out + o, 0x5c, run);
+      o += run;
+    }
+    run = 0;
   }
 
-  *addrc = bufferR[ibufferR];
-  ibufferR++;
-  return FALSE;
+  *pending = run;
+  return o;
 }
 
-void flush() {
+#ifndef NULLESCAPE_NO_MAIN
+
+char bufferR[BLOCKLEN];
+char bufferW[BLOCKLEN + 2];
+
+void writeOrDie(const char *buffer, size_t len) {
   int error = 0;
-  int written = 0;
-  written = fwrite(bufferW, 1, ibufferW, stdout);
+  size_t written = fwrite(buffer, 1, len, stdout);
 
-  if (written != ibufferW) {
+  if (written != len) {
     error = ferror(stdout);
     fprintf(stderr, "Write failed with error %d\n", error);
     exit(2);
   }
-
-  ibufferW = 0;
 }
 
-/* wrapper to buffer */
-void putcharWrapper(char c) {
+int main(int argc, char** argv) {
   int error = 0;
-  int written = 0;
-
-  if (ibufferW >= WBUFFERLEN) {
-    /* buffer full */
-    flush();
+  long pending = 0;
+  size_t nread = 0;
+  size_t nwritten = 0;
+
+  while ((nread = fread(bufferR, 1, BLOCKLEN, stdin)) > 0) {
+    /* a run of 0x5c longer than a block is written out as we go, leaving
+     * one or two pending to keep the parity of the run, so that the output
+     * always fits in bufferW */
+    if (pending > 2) {
+      long keep = (pending % 2 == 1) ? 1 : 2;
+      memset(bufferW, 0x5c, pending - keep);
+      writeOrDie(bufferW, pending - keep);
+      pending = keep;
+    }
+    nwritten = nullescape_block(bufferR, nread, bufferW, &pending);
+    writeOrDie(bufferW, nwritten);
   }
 
-  if (ibufferW >= WBUFFERLEN) {
-    fprintf(stderr, "Buffer full even after flush %d\n", error);
-    exit(3);
+  if (ferror(stdin)) {
+    error = ferror(stdin);
+    fprintf(stderr, "Read failed with error %d\n", error);
+    exit(1);
   }
 
-  bufferW[ibufferW] = c;
-  ibufferW++;
-}
-
-int main(int argc, char** argv) {
-  char c;
-  int eof = FALSE;
-  while (!(eof = getcharWrapper(&c))) {
-    if (c != 0x5c) {
-      putcharWrapper(c);
-      continue;
-    }
-
-    /*
-     * if we reach here, we have one outstanding 0x5c that we have not yet put in output.
-     * let us count consecutive 0x5c that we see excluding the outstanding one.
-     */
-    long count = 0;
-
-    /* we found 0x5c. Keep reading until we get EOF or something other than 0x5c */
-    while (!(eof = getcharWrapper(&c))) {
-      if (c == 0x30) {
-        if (count % 2 == 0) {
-          /* we saw 0 or even number of 0x5c before 0x5c30 */
-          putcharWrapper(0x00);
-          break;
-	} else {
-          /*
-           * we saw odd number of 0x5c before 0x5c30. put the outstanding 0c5c in the output,
-           * and then 0x30
-           */
-          putcharWrapper(0x5c);
-          putcharWrapper(0x30);
-          break;
-	}
-      } else if (c == 0x5c) {
-        putcharWrapper(0x5c);
-        count++;
-      } else {
-        /* put the outstanding 0x5c and the char we just read in output */
-        putcharWrapper(0x5c);
-        putcharWrapper(c);
-        break;
-      }
-    }
-
-    if (eof) {
-      /* put the outstanding 0x5c */
-      putcharWrapper(0x5c);
-      flush();
-      fflush(stdout);
-      return 0;
-    }
-
-    /* if we reach here we should not have any outstanding 0x5c. just continbue reading. */
+  /* put any outstanding 0x5c */
+  while (pending > 0) {
+    writeOrDie("\\", 1);
+    pending--;
   }
-
-  flush();
   fflush(stdout);
+  return 0;
 }
+
+#endif
@@ -6,12 +6,14 @@ import boto
 import boto.s3.key
 import logging
 import multiprocessing
+import multiprocessing.pool
 import subprocess
 import time
 import traceback
 
 import binlog_rotator
 import safe_uploader
+from lib import binlog_index
 from lib import host_utils
 from lib import mysql_lib
 from lib import environment_specific
@@ -32,6 +34,13 @@ STANDARD_RETENTION_BINLOG_S3_DIR = 'standard_retention'
 BINLOG_LOCK_FILE = '/tmp/archive_mysql_binlogs.lock'
 BINLOG_INFINITE_REPEATER_TERM_FILE = '/tmp/archive_mysql_binlogs_infinite.die'
 MAX_ERRORS = 5
+# How many binlogs are compressed and uploaded at once
+MAX_UPLOAD_THREADS = 4
+# Most binlogs logged as uploaded in a single statement
+LOG_BATCH_SIZE = 100
+# Longest a binlog waits to be logged as uploaded while a batch fills
+LOG_BATCH_INTERVAL = 30
+BINLOG_S3_SUFFIX = '.lzo'
 TMP_DIR = '/tmp/'
 
 log = logging.getLogger(__name__)
@@ -63,81 +72,260 @@ def archive_mysql_binlogs(port, dry_run):
     instance = host_utils.HostAddr(':'.join((host_utils.HOSTNAME,
                                              str(port))))
 
-    if zk.get_replica_set_from_instance(instance)[0] is None:
+    replica_set = zk.get_replica_set_from_instance(instance)[0]
+    if replica_set is None:
         log.info('Instance is not in production, exiting')
         return
 
+    # Resolved once and reused for every binlog
+    master = zk.get_mysql_instance_from_replica_set(replica_set)
+    master_conn = mysql_lib.connect_mysql(master, 'scriptrw')
+    bucket_name = environment_specific.BACKUP_BUCKET_UPLOAD_MAP[host_utils.get_iam_role()]
+
     lock_handle = None
-    ensure_binlog_archiving_table_sanity(instance)
+    ensure_binlog_archiving_table_sanity(master_conn)
     try:
         log.info('Taking binlog archiver lock')
         lock_handle = host_utils.take_flock_lock(BINLOG_LOCK_FILE)
         log_bin_dir = host_utils.get_cnf_setting('log_bin', port)
         bin_logs = mysql_lib.get_master_logs(instance)
         logged_uploads = get_logged_binlog_uploads(instance)
+        unarchived = list()
         for binlog in bin_logs[:-1]:
-            err_count = 0
             local_file = os.path.join(os.path.dirname(log_bin_dir),
                                       binlog['Log_name'])
-            if already_uploaded(instance, local_file, logged_uploads):
+            if os.path.basename(local_file) in logged_uploads:
+                log.debug('Binlog already logged as uploaded')
                 continue
-            success = False
-            while not success:
-                try:
-                    upload_binlog(instance, local_file, dry_run)
-                    success = True
-                except:
-                    if err_count > MAX_ERRORS:
-                        log.error('Error count in thread > MAX_THREAD_ERROR. '
-                                  'Aborting :(')
-                        raise
-
-                    log.error('error: {e}'.format(e=traceback.format_exc()))
-                    err_count = err_count + 1
-                    time.sleep(err_count*2)
+            unarchived.append(local_file)
+
+        if unarchived:
+            boto_conn = boto.connect_s3()
+            bucket = boto_conn.get_bucket(bucket_name, validate=False)
+            in_s3 = get_uploaded_binlogs(bucket, instance)
+        else:
+            in_s3 = set()
+        archived = upload_binlogs(instance, master_conn, unarchived, in_s3,
+                                  bucket_name, dry_run)
+        log_archiving_lag(unarchived[len(archived):])
+        if len(archived) < len(unarchived):
+            raise Exception('Could not archive {binlog}'
+                            ''.format(binlog=unarchived[len(archived)]))
         log.info('Archiving complete')
     finally:
+        master_conn.close()
         if lock_handle:
             log.info('Releasing lock')
             host_utils.release_flock_lock(lock_handle)
 
 
-def already_uploaded(instance, binlog, logged_uploads):
-    """ Check to see if a binlog has already been uploaded
+def upload_binlogs(instance, master_conn, binlogs, in_s3, bucket_name,
+                   dry_run):
+    """ Upload and index binlogs concurrently, logging them as uploaded in
+        order. A binlog is only logged once all binlogs before it are, so the
+        log never has gaps for a PITR to fall into.
+
+    Args:
+    instance - a hostAddr object
+    master_conn - a connection to the master, for logging uploads
+    binlogs - a list of full paths to binlog files, oldest first
+    in_s3 - a set of the names of binlogs which are already in s3, as
+            returned by get_uploaded_binlogs. These are indexed and logged
+            without being uploaded again.
+    bucket_name - the s3 bucket to upload to
+    dry_run - if set, do not actually upload or log binlogs
+
+    Returns:
+    A list of the binlogs which were archived, the longest prefix of binlogs
+    which all uploaded successfully
+    """
+    archived = list()
+    if not binlogs:
+        return archived
+
+    pool = multiprocessing.pool.ThreadPool(min(MAX_UPLOAD_THREADS,
+                                               len(binlogs)))
+    to_log = list()
+    to_index = list()
+    last_flush = time.time()
+    try:
+        results = list()
+        for binlog in binlogs:
+            if os.path.basename(binlog) in in_s3:
+                log.debug('Binlog already uploaded but not logged {b}'
+                          ''.format(b=binlog))
+                results.append(pool.apply_async(index_binlog, (binlog, )))
+            else:
+                results.append(pool.apply_async(archive_binlog,
+                                                (instance, binlog,
+                                                 bucket_name, dry_run)))
+        for (i, binlog) in enumerate(binlogs):
+            # Don't hold a batch back for longer than LOG_BATCH_INTERVAL
+            # while waiting on a slow upload
+            results[i].wait(max(0, last_flush + LOG_BATCH_INTERVAL - time.time()))
+            if not results[i].ready() and to_log:
+                log_archived_binlogs(master_conn, instance, to_log, to_index,
+                                     dry_run)
+                last_flush = time.time()
+
+            try:
+                entry = results[i].get()
+            except:
+                log.error('Could not upload {binlog}, later binlogs will '
+                          'not be logged until it is: {e}'
+                          ''.format(binlog=binlog,
+                                    e=traceback.format_exc()))
+                break
+            archived.append(binlog)
+            to_log.append(binlog)
+            if entry:
+                to_index.append(entry)
+
+            if (len(to_log) >= LOG_BATCH_SIZE or
+                    time.time() - last_flush >= LOG_BATCH_INTERVAL):
+                log_archived_binlogs(master_conn, instance, to_log, to_index,
+                                     dry_run)
+                last_flush = time.time()
+    finally:
+        # Uploads already running are left to finish, they will be found
+        # in s3 and logged by the next run
+        pool.close()
+        pool.join()
+
+    if to_log:
+        log_archived_binlogs(master_conn, instance, to_log, to_index, dry_run)
+    return archived
+
+
+def log_archived_binlogs(master_conn, instance, binlogs, entries, dry_run):
+    """ Record a batch of archived binlogs in the index and the archiving
+        log, then empty the batch
+
+    Args:
+    master_conn - a connection to the master
+    instance - a hostAddr object
+    binlogs - a list of full paths to binlog files, emptied once logged
+    entries - a list of index entries of the binlogs, emptied once logged
+    dry_run - if set, do not log the binlogs
+    """
+    if not dry_run:
+        binlog_index.record_binlog_index(master_conn, instance, entries)
+        log_binlog_uploads(master_conn, instance, binlogs)
+    del binlogs[:]
+    del entries[:]
+
+
+def archive_binlog(instance, binlog, bucket_name, dry_run):
+    """ Upload a binlog file to s3 with retries, and build its index entry
 
     Args:
     instance - a hostAddr object
     binlog - the full path to the binlog file
-    logged_uploads - a set of all uploaded binlogs for this instance
+    bucket_name - the s3 bucket to upload to
+    dry_run - if set, do not actually upload a binlog
 
-    Returns True if already uplaoded, False otherwise.
+    Returns:
+    An index entry as returned by binlog_index.parse_binlog, or None if the
+    binlog could not be parsed
     """
-    if os.path.basename(binlog) in logged_uploads:
-        log.debug('Binlog already logged as uploaded')
-        return True
+    upload_binlog_with_retries(instance, binlog, bucket_name, dry_run)
+    return index_binlog(binlog)
 
-    # we should hit this code rarely, only when uploads have not been logged
-    boto_conn = boto.connect_s3()
-    bucket = boto_conn.get_bucket(environment_specific.BACKUP_BUCKET_UPLOAD_MAP[host_utils.get_iam_role()],
-                                  validate=False)
-    if bucket.get_key(s3_binlog_path(instance, os.path.basename((binlog)))):
-        log.debug("Binlog already uploaded but not logged {b}".format(b=binlog))
-        log_binlog_upload(instance, binlog)
-        return True
 
-    return False
+def index_binlog(binlog):
+    """ Build the index entry of a binlog. The index only speeds up
+        planning a PITR, so failing to parse a binlog does not stop it from
+        being archived.
 
+    Args:
+    binlog - the full path to the binlog file
+
+    Returns:
+    An index entry as returned by binlog_index.parse_binlog, or None if the
+    binlog could not be parsed
+    """
+    try:
+        return binlog_index.parse_binlog(binlog)
+    except:
+        log.error('Could not index {binlog}: {e}'
+                  ''.format(binlog=binlog,
+                            e=traceback.format_exc()))
+        return None
 
-def upload_binlog(instance, binlog, dry_run):
-    """ Upload a binlog file to s3
+
+def upload_binlog_with_retries(instance, binlog, bucket_name, dry_run):
+    """ Upload a binlog file to s3, retrying with a backoff
 
     Args:
     instance - a hostAddr object
     binlog - the full path to the binlog file
+    bucket_name - the s3 bucket to upload to
+    dry_run - if set, do not actually upload a binlog
+    """
+    err_count = 0
+    while True:
+        try:
+            upload_binlog(instance, binlog, bucket_name, dry_run)
+            return
+        except:
+            if err_count > MAX_ERRORS:
+                log.error('Error count for {binlog} > MAX_ERRORS. '
+                          'Aborting :('.format(binlog=binlog))
+                raise
+
+            log.error('error: {e}'.format(e=traceback.format_exc()))
+            err_count = err_count + 1
+            time.sleep(err_count*2)
+
+
+def get_uploaded_binlogs(bucket, instance):
+    """ Find which binlogs of an instance are in s3, with a single listing of
+        the instance's prefix rather than a HEAD per binlog
+
+    Args:
+    bucket - a boto bucket object
+    instance - a hostAddr object
+
+    Returns:
+    A set of binlog file names
+    """
+    prefix = os.path.dirname(s3_binlog_path(instance, 'binlog')) + '/'
+    ret = set()
+    for key in bucket.list(prefix=prefix):
+        name = os.path.basename(key.name)
+        if name.endswith(BINLOG_S3_SUFFIX):
+            ret.add(name[:-len(BINLOG_S3_SUFFIX)])
+    return ret
+
+
+def log_archiving_lag(unarchived):
+    """ Log how far behind archiving is, as the age of the oldest closed
+        binlog which is not archived
+
+    Args:
+    unarchived - a list of full paths to binlog files which have not been
+                 archived, oldest first
+    """
+    if not unarchived:
+        lag = 0
+    else:
+        lag = int(time.time() - os.stat(unarchived[0]).st_mtime)
+    log.info('Binlog archiving lag: {lag} seconds, {cnt} binlogs unarchived'
+             ''.format(lag=lag,
+                       cnt=len(unarchived)))
+
+
+def upload_binlog(instance, binlog, bucket, dry_run):
+    """ Upload a binlog file to s3. The caller is responsible for logging
+        the upload.
+
+    Args:
+    instance - a hostAddr object
+    binlog - the full path to the binlog file
+    bucket - the s3 bucket to upload to
     dry_run - if set, do not actually upload a binlog
     """
     s3_upload_path = s3_binlog_path(instance, binlog)
-    bucket = environment_specific.BACKUP_BUCKET_UPLOAD_MAP[host_utils.get_iam_role()]
     log.info('Local file {local_file} will uploaded to s3://{buk}/{s3_upload_path}'
              ''.format(local_file=binlog,
                        buk=bucket,
@@ -159,35 +347,37 @@ def upload_binlog(instance, binlog, dry_run):
         log.debug('In exception handling for failed binlog upload')
         safe_uploader.kill_precursor_procs(procs)
         raise
-    log_binlog_upload(instance, binlog)
 
 
-def log_binlog_upload(instance, binlog):
-    """ Log to the master that a binlog has been uploaded
+def log_binlog_uploads(master_conn, instance, binlogs):
+    """ Log to the master that binlogs have been uploaded, in a single
+        statement
 
     Args:
+    master_conn - a connection to the master
     instance - a hostAddr object
-    binlog - the full path to the binlog file
+    binlogs - a list of full paths to binlog files
     """
-    zk = host_utils.MysqlZookeeper()
-    binlog_creation = datetime.datetime.fromtimestamp(os.stat(binlog).st_atime)
-    replica_set = zk.get_replica_set_from_instance(instance)[0]
-    master = zk.get_mysql_instance_from_replica_set(replica_set)
-    conn = mysql_lib.connect_mysql(master, 'scriptrw')
-    cursor = conn.cursor()
-    sql = ("REPLACE INTO {metadata_db}.{tbl} "
-           "SET hostname = %(hostname)s, "
-           "    port = %(port)s, "
-           "    binlog = %(binlog)s, "
-           "    binlog_creation = %(binlog_creation)s, "
-           "    uploaded = NOW() ").format(metadata_db=mysql_lib.METADATA_DB,
-                                           tbl=environment_specific.BINLOG_ARCHIVING_TABLE_NAME)
     metadata = {'hostname': instance.hostname,
-                'port': str(instance.port),
-                'binlog': os.path.basename(binlog),
-                'binlog_creation': binlog_creation}
+                'port': str(instance.port)}
+    values = list()
+    for (i, binlog) in enumerate(binlogs):
+        values.append('(%(hostname)s, %(port)s, %(binlog_{i})s, '
+                      '%(binlog_creation_{i})s, NOW())'.format(i=i))
+        metadata['binlog_{i}'.format(i=i)] = os.path.basename(binlog)
+        metadata['binlog_creation_{i}'.format(i=i)] = \
+            datetime.datetime.fromtimestamp(os.stat(binlog).st_atime)
+    sql = ("REPLACE INTO {metadata_db}.{tbl} "
+           "(hostname, port, binlog, binlog_creation, uploaded) "
+           "VALUES {values}").format(metadata_db=mysql_lib.METADATA_DB,
+                                     tbl=environment_specific.BINLOG_ARCHIVING_TABLE_NAME,
+                                     values=', '.join(values))
+    cursor = master_conn.cursor()
     cursor.execute(sql, metadata)
-    conn.commit()
+    master_conn.commit()
+    log.info('Logged {cnt} binlogs as uploaded, through {binlog}'
+             ''.format(cnt=len(binlogs),
+                       binlog=os.path.basename(binlogs[-1])))
 
 
 def get_logged_binlog_uploads(instance):
@@ -216,23 +406,16 @@ def get_logged_binlog_uploads(instance):
     return ret
 
 
-def ensure_binlog_archiving_table_sanity(instance):
-    """ Create binlog archiving log table if missing, purge old data
+def ensure_binlog_archiving_table_sanity(master_conn):
+    """ Create binlog archiving log and index tables if missing, purge old
+        data
 
     Args:
-    instance - A hostAddr object. Note: this function will find the master of
-               the instance if the instance is not a master
+    master_conn - A connection to the master of the instance
     """
-    zk = host_utils.MysqlZookeeper()
-    replica_set = zk.get_replica_set_from_instance(instance)[0]
-    master = zk.get_mysql_instance_from_replica_set(replica_set)
-    conn = mysql_lib.connect_mysql(master, 'scriptrw')
-    cursor = conn.cursor()
-    if not mysql_lib.does_table_exist(master, mysql_lib.METADATA_DB,
-                                      environment_specific.BINLOG_ARCHIVING_TABLE_NAME):
-            log.debug('Creating missing metadata table')
-            cursor.execute(BINLOG_ARCHIVING_TABLE.format(db=mysql_lib.METADATA_DB,
-                                                         tbl=environment_specific.BINLOG_ARCHIVING_TABLE_NAME))
+    cursor = master_conn.cursor()
+    cursor.execute(BINLOG_ARCHIVING_TABLE.format(db=mysql_lib.METADATA_DB,
+                                                 tbl=environment_specific.BINLOG_ARCHIVING_TABLE_NAME))
     sql = ("DELETE FROM {metadata_db}.{tbl} "
            "WHERE binlog_creation < now() - INTERVAL {d} DAY"
            "").format(metadata_db=mysql_lib.METADATA_DB,
@@ -240,7 +423,17 @@ def ensure_binlog_archiving_table_sanity(instance):
                       d=(environment_specific.S3_BINLOG_RETENTION+1))
     log.info(sql)
     cursor.execute(sql)
-    conn.commit()
+
+    cursor.execute(binlog_index.BINLOG_INDEX_TABLE.format(db=mysql_lib.METADATA_DB,
+                                                          tbl=binlog_index.BINLOG_INDEX_TABLE_NAME))
+    sql = ("DELETE FROM {metadata_db}.{tbl} "
+           "WHERE first_event < now() - INTERVAL {d} DAY"
+           "").format(metadata_db=mysql_lib.METADATA_DB,
+                      tbl=binlog_index.BINLOG_INDEX_TABLE_NAME,
+                      d=(environment_specific.S3_BINLOG_RETENTION+1))
+    log.info(sql)
+    cursor.execute(sql)
+    master_conn.commit()
 
 
 def s3_binlog_path(instance, binlog):
@@ -261,7 +454,7 @@ def s3_binlog_path(instance, binlog):
                         instance.hostname,
                         str(instance.port),
                         ''.join((os.path.basename(binlog),
-                                 '.lzo')))
+                                 BINLOG_S3_SUFFIX)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+import argparse
+import distutils.spawn
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from lib import lzop
+from lib import nullescape
+
+DEFAULT_TABLES = 500
+DEFAULT_TABLE_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+WRITE_SIZE = 64 * 1024
+LINE_TEMPLATE = '{mode:<14}{tables:>8}{seconds:>12}{per_table:>14}{throughput:>16}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Compare the forked cat | '
+                                                  'nullescape | lzop export '
+                                                  'pipeline with the in '
+                                                  'process pipeline'))
+    parser.add_argument('--tables',
+                        help=('How many tables to export. Default is '
+                              '{tables}'.format(tables=DEFAULT_TABLES)),
+                        default=DEFAULT_TABLES,
+                        type=int)
+    parser.add_argument('--table_size',
+                        help=('Size in bytes of each table. Default is '
+                              '{size}, small tables are where per table '
+                              'overhead dominates'.format(size=DEFAULT_TABLE_SIZE)),
+                        default=DEFAULT_TABLE_SIZE,
+                        type=int)
+    args = parser.parse_args()
+
+    data = generate_table_data(args.table_size)
+    work_dir = tempfile.mkdtemp()
+    try:
+        print LINE_TEMPLATE.format(mode='mode',
+                                   tables='tables',
+                                   seconds='seconds',
+                                   per_table='ms/table',
+                                   throughput='MB/sec')
+        if (distutils.spawn.find_executable('nullescape') and
+                distutils.spawn.find_executable('lzop')):
+            print_result('forked', args.tables, len(data),
+                         run_benchmark(forked_pipeline, work_dir,
+                                       args.tables, data))
+        else:
+            print 'Skipping forked pipeline, nullescape or lzop is missing'
+
+        if lzop.available():
+            print_result('in process', args.tables, len(data),
+                         run_benchmark(in_process_pipeline, work_dir,
+                                       args.tables, data))
+        else:
+            print 'Skipping in process pipeline, python-lzo is missing'
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def generate_table_data(size):
+    """ Generate tab separated data resembling SELECT INTO OUTFILE output,
+        including some escaped NULs and backslashes
+
+    Args:
+    size - The approximate size of the data in bytes
+
+    Returns:
+    A string
+    """
+    lines = []
+    total = 0
+    row = 0
+    while total < size:
+        row += 1
+        fields = [str(row),
+                  ''.join(random.choice('abcdefghij') for _ in range(40)),
+                  random.choice(['\\0', '\\\\', 'x\\\\\\0', 'plain']),
+                  str(random.random())]
+        line = '\t'.join(fields) + '\n'
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)
+
+
+def run_benchmark(pipeline, work_dir, tables, data):
+    """ Export a number of tables through a pipeline
+
+    Args:
+    pipeline - A function which takes a fifo path and drains it
+    work_dir - A directory to create fifos in
+    tables - The number of tables to export
+    data - The contents of each table
+
+    Returns:
+    Elapsed seconds
+    """
+    start = time.time()
+    for table in range(tables):
+        fifo = os.path.join(work_dir, str(table))
+        os.mkfifo(fifo)
+        writer = threading.Thread(target=write_fifo, args=(fifo, data))
+        writer.start()
+        pipeline(fifo)
+        writer.join()
+        os.remove(fifo)
+    return time.time() - start
+
+
+def write_fifo(fifo, data):
+    """ Stand in for the mysql server writing a table into a fifo """
+    with open(fifo, 'wb') as handle:
+        for offset in range(0, len(data), WRITE_SIZE):
+            handle.write(data[offset:offset + WRITE_SIZE])
+
+
+def forked_pipeline(fifo):
+    """ The cat | nullescape | lzop pipeline, as used before the in process
+        pipeline was available
+    """
+    devnull = open(os.devnull, 'w')
+    cat = subprocess.Popen(['cat', fifo], stdout=subprocess.PIPE)
+    escape = subprocess.Popen(['nullescape'], stdin=cat.stdout,
+                              stdout=subprocess.PIPE)
+    compress = subprocess.Popen(['lzop'], stdin=escape.stdout, stdout=devnull)
+    cat.stdout.close()
+    escape.stdout.close()
+    for proc in (cat, escape, compress):
+        if proc.wait() != 0:
+            raise Exception('Forked pipeline failed')
+
+
+def in_process_pipeline(fifo):
+    """ The in process pipeline, as used by mysql_backup_csv """
+    escaper = nullescape.NullEscaper()
+    compressor = lzop.LzopCompressor()
+    with open(os.devnull, 'wb') as devnull:
+        devnull.write(compressor.header())
+        with open(fifo, 'rb') as handle:
+            while True:
+                data = handle.read(READ_SIZE)
+                if not data:
+                    break
+                devnull.write(compressor.compress(escaper.transform(data)))
+        devnull.write(compressor.compress(escaper.flush()))
+        devnull.write(compressor.flush())
+
+
+def print_result(mode, tables, table_size, seconds):
+    print LINE_TEMPLATE.format(mode=mode,
+                               tables=tables,
+                               seconds='{:.2f}'.format(seconds),
+                               per_table='{:.2f}'.format(seconds * 1000 / tables),
+                               throughput='{:.1f}'.format(tables * table_size /
+                                                          seconds / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
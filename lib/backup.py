@@ -1,4 +1,5 @@
 import boto
+import contextlib
 import copy
 import datetime
 import os
@@ -76,6 +77,16 @@ XB_RESTORE_STATUS = ("CREATE TABLE IF NOT EXISTS test.xb_restore_status ("
                      "INDEX (restore_type, started_at), "
                      "INDEX (restore_type, restore_status, "
                      "       started_at) )")
+XB_RESTORE_PHASES = ("CREATE TABLE IF NOT EXISTS test.xb_restore_phases ("
+                     "restore_id        INT UNSIGNED NOT NULL, "
+                     "phase             VARCHAR(64) NOT NULL, "
+                     "phase_order       TINYINT UNSIGNED NOT NULL, "
+                     "started_at        DATETIME NOT NULL, "
+                     "duration          DECIMAL(12,3) NOT NULL, "
+                     "bytes             BIGINT UNSIGNED, "
+                     "throughput        DECIMAL(16,3), "
+                     "PRIMARY KEY(restore_id, phase), "
+                     "INDEX (started_at, phase) )")
 
 XBSTREAM = ['/usr/bin/xbstream', '--extract']
 XTRABACKUP_CMD = ' '.join((INNOBACKUPEX,
@@ -98,6 +109,42 @@ MINIMUM_VALID_BACKUP_SIZE_BYTES = 1024 * 1024
 log = environment_specific.setup_logging_defaults(__name__)
 
 
+class RestoreProfiler:
+    """Collect timings for the phases of a restore"""
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name, size=None):
+        """ Time a phase of a restore. Phases that raise are still recorded
+            so that a failed restore shows where the time went.
+
+        Args:
+        name - The name of the phase, ie 'apply_log'
+        size - (optional) The number of bytes processed in the phase. If not
+               known ahead of time, the caller can set 'bytes' in the yielded
+               dict.
+        """
+        entry = {'phase': name,
+                 'phase_order': len(self.phases),
+                 'started_at': datetime.datetime.now(),
+                 'start': time.time(),
+                 'bytes': size}
+        try:
+            yield entry
+        finally:
+            entry['duration'] = time.time() - entry['start']
+            if entry['bytes'] and entry['duration'] > 0:
+                entry['throughput'] = entry['bytes'] / entry['duration']
+            else:
+                entry['throughput'] = None
+            self.phases.append(entry)
+            log.info('Restore phase {phase} took {duration:.1f} seconds, '
+                     'bytes: {bytes}, throughput: {throughput} bytes/sec'
+                     ''.format(**entry))
+
+
 def create_backup_file_name(instance, timestamp, initial_build, backup_type):
     """ Figure out where to put a backup in s3
 
@@ -205,6 +252,16 @@ def xtrabackup_instance(instance, timestamp, initial_build):
                            'log', 'xtrabackup_{ts}.log'.format(
                             ts=time.strftime('%Y-%m-%d-%H:%M:%S', timestamp)))
     tmp_log_handle = open(tmp_log, "w")
+
+    # Capture the buffer pool page list so that it is included in the backup
+    # and can be used to warm up the buffer pool of a restored instance.
+    try:
+        log.info('Dumping InnoDB buffer pool page list')
+        mysql_lib.dump_buffer_pool(instance)
+    except Exception as e:
+        log.warning('Unable to dump buffer pool, restores from this backup '
+                    'will start with a cold buffer pool: {e}'.format(e=e))
+
     procs = dict()
     try:
         cmd = create_xtrabackup_command(instance, timestamp, tmp_log)
@@ -321,6 +378,56 @@ def get_s3_backup(instance, date, backup_type):
     return backup_keys
 
 
+def get_listing_prefixes(paths, datestamp=None):
+    """ Reduce a collection of s3 paths to a small set of prefixes to LIST
+
+    Args:
+    paths - An iterable of s3 key names
+    datestamp - (optional) A datestamp which is part of the paths. If a path
+                contains it, the path is cut just after the datestamp so that
+                all paths for the date share a prefix.
+
+    Returns:
+    A set of prefixes
+    """
+    prefixes = set()
+    for path in paths:
+        if datestamp and datestamp in path:
+            prefixes.add(path[:path.index(datestamp) + len(datestamp)])
+        else:
+            prefixes.add(os.path.dirname(path) + '/')
+
+    # Drop any prefix which is covered by a shorter one
+    ret = set()
+    for prefix in sorted(prefixes):
+        if not any(prefix.startswith(kept) for kept in ret):
+            ret.add(prefix)
+    return ret
+
+
+def list_existing_keys(bucket, paths, datestamp=None):
+    """ Determine which keys exist under the prefixes of a collection of s3
+        paths using a few LISTs, rather than a HEAD for every path
+
+    Args:
+    bucket - A boto bucket object
+    paths - An iterable of s3 key names
+    datestamp - (optional) A datestamp which is part of the paths, see
+                get_listing_prefixes
+
+    Returns:
+    A set of the names of all keys under the prefixes of the paths
+    """
+    existing = set()
+    for prefix in get_listing_prefixes(paths, datestamp):
+        log.debug('Listing s3://{bucket}/{prefix}'
+                  ''.format(bucket=bucket.name,
+                            prefix=prefix))
+        for key in bucket.list(prefix=prefix):
+            existing.add(key.name)
+    return existing
+
+
 def get_metadata_from_backup_file(full_path):
     """ Parse the filename of a backup to determine the source of a backup
 
@@ -431,6 +538,85 @@ def update_restore_log(instance, row_id, params):
     conn.close()
 
 
+def log_restore_phases(instance, row_id, profiler):
+    """ Record the phase timings of a restore in xb_restore_phases
+
+    Args:
+    instance - A hostaddr object for where to log to
+    row_id - The restore log id the phases belong to
+    profiler - A RestoreProfiler object
+    """
+    if row_id is None or not profiler.phases:
+        return
+
+    try:
+        conn = mysql_lib.connect_mysql(instance)
+    except Exception as e:
+        log.warning("Unable to connect to master to log "
+                    "restore phases: {e}".format(e=e))
+        return
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(XB_RESTORE_PHASES)
+        sql = ("REPLACE INTO test.xb_restore_phases "
+               "SET "
+               "restore_id = %(row_id)s, "
+               "phase = %(phase)s, "
+               "phase_order = %(phase_order)s, "
+               "started_at = %(started_at)s, "
+               "duration = %(duration)s, "
+               "bytes = %(bytes)s, "
+               "throughput = %(throughput)s")
+        for entry in profiler.phases:
+            params = copy.copy(entry)
+            params['row_id'] = row_id
+            cursor.execute(sql, params)
+            log.info(cursor._executed)
+        conn.commit()
+    except Exception as e:
+        log.warning("Unable to log restore phases: {e}".format(e=e))
+    cursor.close()
+    conn.close()
+
+
+def get_restore_phase_stats(args):
+    """ Get phase timings of recent restores of a replica set
+
+    Args: A tuple which can be expanded to:
+    replica_set - A MySQL replica set
+    days - How many days of restores to consider
+
+    Returns - A list of dicts, one per phase of a restore. This is done to
+              make it easy to use multiprocessing.
+    """
+    (replica_set, days) = args
+    zk = host_utils.MysqlZookeeper()
+    master = zk.get_mysql_instance_from_replica_set(replica_set)
+    try:
+        conn = mysql_lib.connect_mysql(master)
+        if not mysql_lib.does_table_exist(master, 'test',
+                                          'xb_restore_phases'):
+            return []
+        cursor = conn.cursor()
+        sql = ("SELECT p.restore_id, p.phase, p.phase_order, p.duration, "
+               "       p.bytes, s.restore_status "
+               "FROM test.xb_restore_phases p "
+               "JOIN test.xb_restore_status s ON s.id = p.restore_id "
+               "WHERE s.started_at > NOW() - INTERVAL %(days)s DAY")
+        cursor.execute(sql, {'days': days})
+        phases = cursor.fetchall()
+    except Exception as e:
+        log.error(e)
+        return []
+
+    ret = []
+    for phase in phases:
+        phase['replica_set'] = replica_set
+        ret.append(phase)
+    return ret
+
+
 def get_age_last_restore(replica_set):
     """ Determine age of last successful backup restore
 
@@ -0,0 +1,323 @@
+"""
+Index the contents of binlogs as they are archived, so that the binlogs
+needed for a point in time recovery can be found without downloading and
+scanning them.
+"""
+import binascii
+import datetime
+import os
+import struct
+
+from lib import mysql_lib
+
+BINLOG_INDEX_TABLE_NAME = 'binlog_index'
+BINLOG_INDEX_TABLE = """CREATE TABLE IF NOT EXISTS {db}.{tbl} (
+  `hostname` varchar(90) NOT NULL,
+  `port` int(11) NOT NULL,
+  `binlog` varchar(90) NOT NULL,
+  `first_event` datetime NOT NULL,
+  `last_event` datetime NOT NULL,
+  `start_position` bigint unsigned NOT NULL,
+  `end_position` bigint unsigned NOT NULL,
+  `previous_gtids` text,
+  `gtids` text,
+  `indexed` datetime NOT NULL,
+  PRIMARY KEY (`hostname`, `port`, `binlog`),
+  INDEX `first_event` (`first_event`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1"""
+BINLOG_MAGIC = '\xfebin'
+# timestamp, type, server_id, event size, end position, flags
+EVENT_HEADER = struct.Struct('<IBIIIH')
+FORMAT_DESCRIPTION_EVENT = 15
+GTID_LOG_EVENT = 33
+PREVIOUS_GTIDS_LOG_EVENT = 35
+# Events which describe the binlog rather than changes to data
+HEADER_EVENTS = set([FORMAT_DESCRIPTION_EVENT, PREVIOUS_GTIDS_LOG_EVENT])
+
+
+def parse_binlog(path):
+    """ Read the events of a binlog to build its index entry. Only event
+        headers, and the bodies of GTID events, are read. A truncated
+        final event, ie of a binlog still being written, is ignored.
+
+    Args:
+    path - The path to a binlog file
+
+    Returns:
+    A dict with keys binlog (file name), first_event and last_event
+    (datetimes in UTC), start_position (of the first event after the
+    header events), end_position (of the last complete event),
+    previous_gtids and gtids (GTID sets as text, None if GTIDs are off)
+    """
+    file_size = os.path.getsize(path)
+    first_event = None
+    last_event = 0
+    start_position = None
+    previous_gtids = None
+    gtids = dict()
+    with open(path, 'rb') as handle:
+        if handle.read(len(BINLOG_MAGIC)) != BINLOG_MAGIC:
+            raise Exception('{path} is not a binlog'.format(path=path))
+
+        position = len(BINLOG_MAGIC)
+        while position + EVENT_HEADER.size <= file_size:
+            (timestamp, event_type, _, event_size, _, _) = \
+                EVENT_HEADER.unpack(handle.read(EVENT_HEADER.size))
+            if event_size < EVENT_HEADER.size or position + event_size > file_size:
+                break
+
+            body_size = event_size - EVENT_HEADER.size
+            if event_type in (GTID_LOG_EVENT, PREVIOUS_GTIDS_LOG_EVENT):
+                body = handle.read(body_size)
+                if event_type == GTID_LOG_EVENT:
+                    # flags, then the source id and transaction number
+                    sid = format_sid(body[1:17])
+                    (gno, ) = struct.unpack_from('<Q', body, 17)
+                    # Transactions of a source are almost always in order,
+                    # so intervals are extended as they are read
+                    intervals = gtids.setdefault(sid, list())
+                    if intervals and gno == intervals[-1][1] + 1:
+                        intervals[-1] = (intervals[-1][0], gno)
+                    else:
+                        intervals.append((gno, gno))
+                else:
+                    previous_gtids = decode_gtid_set(body)
+            else:
+                handle.seek(body_size, os.SEEK_CUR)
+
+            if timestamp:
+                if first_event is None:
+                    first_event = timestamp
+                last_event = max(last_event, timestamp)
+            if start_position is None and event_type not in HEADER_EVENTS:
+                start_position = position
+            position += event_size
+
+    if first_event is None:
+        raise Exception('{path} does not contain any complete events'
+                        ''.format(path=path))
+
+    return {'binlog': os.path.basename(path),
+            'first_event': datetime.datetime.utcfromtimestamp(first_event),
+            'last_event': datetime.datetime.utcfromtimestamp(last_event),
+            'start_position': start_position or position,
+            'end_position': position,
+            'previous_gtids': previous_gtids,
+            'gtids': format_gtid_set(dict((sid, merge_intervals(intervals))
+                                          for (sid, intervals) in gtids.items()))}
+
+
+def merge_intervals(intervals):
+    """ Merge intervals of transaction numbers which overlap or are
+        contiguous. Gaps between intervals are kept.
+
+    Args:
+    intervals - A list of tuples of first and last (inclusive) transaction
+                numbers
+
+    Returns:
+    A sorted list of tuples of first and last transaction numbers
+    """
+    ret = list()
+    for (first, last) in sorted(intervals):
+        if ret and first <= ret[-1][1] + 1:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], last))
+        else:
+            ret.append((first, last))
+    return ret
+
+
+def get_event_time(path, position):
+    """ Read the timestamp of the event at a position in a binlog
+
+    Args:
+    path - The path to a binlog file
+    position - The position of the start of an event
+
+    Returns:
+    A datetime in UTC
+    """
+    with open(path, 'rb') as handle:
+        handle.seek(position)
+        header = handle.read(EVENT_HEADER.size)
+    if len(header) < EVENT_HEADER.size:
+        raise Exception('{path} does not have an event at {position}'
+                        ''.format(path=path,
+                                  position=position))
+    return datetime.datetime.utcfromtimestamp(EVENT_HEADER.unpack(header)[0])
+
+
+def format_sid(sid):
+    """ Format the binary source id of a GTID
+
+    Args:
+    sid - 16 bytes
+
+    Returns:
+    A uuid string
+    """
+    hexed = binascii.hexlify(sid)
+    return '-'.join((hexed[0:8], hexed[8:12], hexed[12:16], hexed[16:20],
+                     hexed[20:32]))
+
+
+def decode_gtid_set(body):
+    """ Decode the body of a PREVIOUS_GTIDS event
+
+    Args:
+    body - The bytes of the event after the common header
+
+    Returns:
+    A GTID set as text, or None if it is empty
+    """
+    (n_sids, ) = struct.unpack_from('<Q', body, 0)
+    offset = 8
+    intervals = dict()
+    for _ in range(n_sids):
+        sid = format_sid(body[offset:offset + 16])
+        (n_intervals, ) = struct.unpack_from('<Q', body, offset + 16)
+        offset += 24
+        intervals[sid] = list()
+        for _ in range(n_intervals):
+            # intervals are stored with an exclusive end
+            (start, end) = struct.unpack_from('<QQ', body, offset)
+            intervals[sid].append((start, end - 1))
+            offset += 16
+    return format_gtid_set(intervals)
+
+
+def format_gtid_set(intervals):
+    """ Format a GTID set as MySQL does
+
+    Args:
+    intervals - A dict with a key of source id and a value of a list of
+                tuples of first and last (inclusive) transaction numbers
+
+    Returns:
+    A string, ie 3E11FA47-71CA-11E1-9E33-C80AA9429562:1-5:11-18, or None if
+    there are no intervals
+    """
+    if not intervals:
+        return None
+
+    ret = list()
+    for sid in sorted(intervals):
+        ranges = list()
+        for (first, last) in sorted(intervals[sid]):
+            if first == last:
+                ranges.append(str(first))
+            else:
+                ranges.append('{first}-{last}'.format(first=first, last=last))
+        ret.append(':'.join([sid] + ranges))
+    return ','.join(ret)
+
+
+def record_binlog_index(master_conn, instance, entries):
+    """ Record index entries for binlogs of an instance, in a single
+        statement
+
+    Args:
+    master_conn - A connection to the master of the instance
+    instance - A hostAddr object of the instance which wrote the binlogs
+    entries - A list of dicts as returned by parse_binlog
+    """
+    if not entries:
+        return
+
+    params = {'hostname': instance.hostname,
+              'port': str(instance.port)}
+    values = list()
+    for (i, entry) in enumerate(entries):
+        columns = list()
+        for column in ('binlog', 'first_event', 'last_event', 'start_position',
+                       'end_position', 'previous_gtids', 'gtids'):
+            name = '{column}_{i}'.format(column=column, i=i)
+            params[name] = entry[column]
+            columns.append('%({name})s'.format(name=name))
+        values.append('(%(hostname)s, %(port)s, {columns}, NOW())'
+                      ''.format(columns=', '.join(columns)))
+    sql = ("REPLACE INTO {db}.{tbl} "
+           "(hostname, port, binlog, first_event, last_event, start_position, "
+           " end_position, previous_gtids, gtids, indexed) "
+           "VALUES {values}").format(db=mysql_lib.METADATA_DB,
+                                     tbl=BINLOG_INDEX_TABLE_NAME,
+                                     values=', '.join(values))
+    cursor = master_conn.cursor()
+    cursor.execute(sql, params)
+    master_conn.commit()
+
+
+def get_binlogs_for_window(instance, binlog_host, start_binlog,
+                           start_position, target_time):
+    """ Find the minimal ordered set of archived binlogs needed to replay
+        from a position up to a point in time
+
+    Args:
+    instance - A hostAddr object of an instance in the replica set, whose
+               copy of the index is queried
+    binlog_host - A hostAddr object of the instance which wrote the binlogs
+    start_binlog - The name of the binlog to start replay from
+    start_position - The position in start_binlog to start replay from
+    target_time - A datetime in UTC to replay up to
+
+    Returns:
+    A list of dicts with the columns of the index, oldest first
+    """
+    conn = mysql_lib.connect_mysql(instance)
+    cursor = conn.cursor()
+    sql = ("SELECT binlog, first_event, last_event, start_position, "
+           "       end_position, previous_gtids, gtids "
+           "FROM {db}.{tbl} "
+           "WHERE hostname = %(hostname)s AND "
+           "      port = %(port)s AND "
+           "      binlog >= %(start_binlog)s "
+           "ORDER BY binlog").format(db=mysql_lib.METADATA_DB,
+                                     tbl=BINLOG_INDEX_TABLE_NAME)
+    cursor.execute(sql, {'hostname': binlog_host.hostname,
+                         'port': str(binlog_host.port),
+                         'start_binlog': start_binlog})
+    rows = cursor.fetchall()
+    if not rows or rows[0]['binlog'] != start_binlog:
+        raise Exception('{binlog} of {host} is not indexed'
+                        ''.format(binlog=start_binlog,
+                                  host=binlog_host))
+    if (rows[0]['first_event'] > target_time or
+            (start_position >= rows[0]['end_position'] and
+             rows[0]['last_event'] >= target_time)):
+        raise Exception('{binlog}:{position} of {host} is already past '
+                        '{target}'.format(binlog=start_binlog,
+                                          position=start_position,
+                                          host=binlog_host,
+                                          target=target_time))
+
+    ret = list()
+    for (i, row) in enumerate(rows):
+        if i and get_binlog_number(row['binlog']) != get_binlog_number(rows[i - 1]['binlog']) + 1:
+            raise Exception('Binlogs between {previous} and {binlog} are not '
+                            'indexed'.format(previous=rows[i - 1]['binlog'],
+                                             binlog=row['binlog']))
+        if i and row['first_event'] > target_time:
+            # The previous binlog runs up to the target
+            return ret
+        # Nothing to replay in the start binlog if the start is at its end
+        if i or start_position < row['end_position']:
+            ret.append(row)
+        if row['last_event'] >= target_time:
+            return ret
+
+    raise Exception('Indexed binlogs of {host} run until {last}, which is '
+                    'before {target}'.format(host=binlog_host,
+                                             last=rows[-1]['last_event'],
+                                             target=target_time))
+
+
+def get_binlog_number(binlog):
+    """ Get the sequence number of a binlog
+
+    Args:
+    binlog - A binlog name, ie mysql-bin.000123
+
+    Returns:
+    An int, ie 123
+    """
+    return int(binlog.rsplit('.', 1)[1])
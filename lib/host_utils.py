@@ -2,7 +2,9 @@ import ConfigParser
 import fcntl
 import json
 import multiprocessing
+import grp
 import os
+import pwd
 import pycurl
 import re
 import shutil
@@ -792,6 +794,19 @@ def change_owner(directory, user, group):
         raise Exception("Error chown'ing directory:{err}".format(err=err))
 
 
+def change_file_owner(path, user, group):
+    """ Chown a single file without forking chown
+
+    Args:
+    path - A string of the path to be chown'ed
+    user - The string of the username of a user
+    group - The string of the groupname of a group
+    """
+    os.chown(path,
+             pwd.getpwnam(user).pw_uid,
+             grp.getgrnam(group).gr_gid)
+
+
 def change_perms(directory, numeric_perms):
     """ Chmod a directory
 
@@ -823,6 +838,24 @@ def clean_directory(directory):
             shutil.rmtree(path)
 
 
+def get_directory_size(directory):
+    """ Get the size of the contents of a directory
+
+    Args:
+    directory - The directory to be measured
+
+    Returns:
+    The size in bytes of all files in the directory
+    """
+    size = 0
+    for root, _, files in os.walk(directory):
+        for entry in files:
+            path = os.path.join(root, entry)
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+    return size
+
+
 def get_local_instance_id():
     """ Get the aws instance_id
 
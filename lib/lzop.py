@@ -0,0 +1,117 @@
+"""
+Produce lzop framed output in process, so that streams can be compressed
+without forking the lzop binary. The output is readable by lzop and by the
+hadoop lzo codecs. Requires python-lzo, use available() to check.
+"""
+import struct
+import time
+import zlib
+
+try:
+    import lzo
+except ImportError:
+    lzo = None
+
+LZOP_MAGIC = b'\x89LZO\x00\r\n\x1a\n'
+LZOP_VERSION = 0x1030
+LZOP_VERSION_NEEDED = 0x0940
+# LZO1X-1, which is what lzop uses by default
+LZOP_METHOD = 1
+LZOP_LEVEL = 5
+F_ADLER32_D = 0x00000001
+F_OS_UNIX = 0x03000000
+FILE_MODE = 0o100644
+BLOCK_SIZE = 256 * 1024
+
+
+def available():
+    """ Check if in process lzop compression is possible
+
+    Returns:
+    True if python-lzo is installed, False otherwise
+    """
+    return lzo is not None
+
+
+def adler32(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+class LzopCompressor(object):
+    """ Compress a stream of blocks into lzop format """
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        if not available():
+            raise Exception('python-lzo is not installed')
+        self.block_size = block_size
+        self.pending = []
+        self.pending_len = 0
+
+    def header(self):
+        """ Get the lzop file header, which must be the start of the stream
+
+        Returns:
+        A string of bytes
+        """
+        mtime = int(time.time())
+        lib_version = getattr(lzo, 'LZO_VERSION', 0x2060) & 0xffff
+        header = struct.pack('>HHHBBLLLLB',
+                             LZOP_VERSION,
+                             lib_version,
+                             LZOP_VERSION_NEEDED,
+                             LZOP_METHOD,
+                             LZOP_LEVEL,
+                             F_ADLER32_D | F_OS_UNIX,
+                             FILE_MODE,
+                             mtime & 0xffffffff,
+                             mtime >> 32,
+                             0)
+        return LZOP_MAGIC + header + struct.pack('>L', adler32(header))
+
+    def compress(self, data):
+        """ Add data to the stream
+
+        Args:
+        data - A string of bytes
+
+        Returns:
+        A string of framed blocks, which will be empty until at least
+        block_size bytes have been supplied
+        """
+        if not data:
+            return b''
+        self.pending.append(data)
+        self.pending_len += len(data)
+        if self.pending_len < self.block_size:
+            return b''
+
+        data = b''.join(self.pending)
+        whole = len(data) - len(data) % self.block_size
+        remainder = data[whole:]
+        self.pending = [remainder] if remainder else []
+        self.pending_len = len(remainder)
+        return b''.join(self._frame(data[offset:offset + self.block_size])
+                        for offset in range(0, whole, self.block_size))
+
+    def flush(self):
+        """ End the stream
+
+        Returns:
+        A string of any remaining framed data and the end of stream marker
+        """
+        data = b''.join(self.pending)
+        self.pending = []
+        self.pending_len = 0
+        ret = self._frame(data) if data else b''
+        return ret + struct.pack('>L', 0)
+
+    def _frame(self, block):
+        compressed = lzo.compress(block, 1, False)
+        if len(compressed) >= len(block):
+            # lzop stores incompressible blocks as is
+            compressed = block
+        return b''.join((struct.pack('>LLL',
+                                     len(block),
+                                     len(compressed),
+                                     adler32(block)),
+                         compressed))
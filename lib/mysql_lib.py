@@ -1,3 +1,4 @@
+import collections
 import json
 import datetime
 import MySQLdb
@@ -13,6 +14,11 @@ import mysql_connect
 from lib import environment_specific
 
 
+# How long to wait for InnoDB buffer pool dumps and loads
+BUFFER_POOL_DUMP_TIMEOUT = 300
+BUFFER_POOL_LOAD_TIMEOUT = 3600
+BUFFER_POOL_STATUS_COMPLETED = 'completed'
+BUFFER_POOL_STATUS_ABORTED = 'aborted'
 # Max IO thread lag in bytes. If more than NORMAL_IO_LAG refuse to modify zk, etc
 # 10k bytes of lag is just a few seconds normally
 NORMAL_IO_LAG = 10485760
@@ -22,6 +28,16 @@ NORMAL_HEARTBEAT_LAG = 120
 HEARTBEAT_SAFETY_MARGIN = 10
 # Max lag in second for a dead master failover
 LOOSE_HEARTBEAT_LAG = 3600
+# How many seconds of lag samples are used to estimate catch up rate
+LAG_TRACKER_WINDOW = 600
+# Number of samples before an estimate is considered fully trustworthy
+LAG_TRACKER_MIN_SAMPLES = 5
+# When waiting on lag, poll again after this fraction of the estimated time
+# remaining, within the bounds below.
+LAG_POLL_FRACTION = 0.25
+LAG_POLL_MIN = 5
+LAG_POLL_MAX = 300
+LAG_POLL_LOW_CONFIDENCE_MAX = 60
 
 CHECK_SQL_THREAD = 'sql'
 CHECK_IO_THREAD = 'io'
@@ -68,6 +84,151 @@ class InvalidVariableForOperation(Exception):
     pass
 
 
+class ReplicationLagTracker:
+    """Estimate replication catch up rate and time to catch up
+
+    SBM as computed from the heartbeat table jumps around while a replica is
+    catching up, so rather than comparing two readings, the rate of catch up
+    is fit over a sliding window using both the heartbeat lag and the bytes
+    of unexecuted replication logs.
+    """
+
+    def __init__(self, target_sbm, window=LAG_TRACKER_WINDOW):
+        """
+        Args:
+        target_sbm - Seconds behind master which is considered caught up
+        window - How many seconds of samples are used in estimates
+        """
+        self.target_sbm = target_sbm
+        self.window = window
+        self.samples = collections.deque()
+
+    def add_sample(self, replication, sample_time=None):
+        """ Record a lag sample
+
+        Args:
+        replication - A dict as returned by calc_slave_lag
+        sample_time - (optional) The time of the sample, default is now
+        """
+        if sample_time is None:
+            sample_time = time.time()
+
+        sbm = replication['sbm']
+        if sbm is None or sbm == INVALID:
+            sbm = None
+        sql_bytes = replication['sql_bytes']
+        if sql_bytes is None or sql_bytes == INVALID:
+            sql_bytes = None
+        if sbm is None and sql_bytes is None:
+            return
+
+        self.samples.append((sample_time, sbm, sql_bytes))
+        while (len(self.samples) > 2 and
+               sample_time - self.samples[0][0] > self.window):
+            self.samples.popleft()
+
+    def _fit(self, index):
+        """ Least squares fit of a sample field against time
+
+        Args:
+        index - 1 for heartbeat lag, 2 for sql bytes
+
+        Returns:
+        A tuple of the slope, the fitted value at the most recent sample and
+        the coefficient of determination, or None if there are not enough
+        samples
+        """
+        points = [(sample[0], float(sample[index]))
+                  for sample in self.samples if sample[index] is not None]
+        if len(points) < 2:
+            return None
+
+        count = float(len(points))
+        mean_t = sum(p[0] for p in points) / count
+        mean_v = sum(p[1] for p in points) / count
+        var_t = sum((p[0] - mean_t) ** 2 for p in points)
+        if var_t == 0:
+            return None
+        slope = sum((p[0] - mean_t) * (p[1] - mean_v) for p in points) / var_t
+        intercept = mean_v - slope * mean_t
+        var_v = sum((p[1] - mean_v) ** 2 for p in points)
+        if var_v == 0:
+            r_squared = 1.0
+        else:
+            residual = sum((p[1] - (intercept + slope * p[0])) ** 2
+                           for p in points)
+            r_squared = max(0.0, 1 - residual / var_v)
+        current = intercept + slope * points[-1][0]
+        return (slope, current, r_squared)
+
+    def get_estimate(self):
+        """ Estimate time until the replica is caught up
+
+        Returns:
+        A dict with keys:
+        eta - Estimated seconds until caught up or None if the replica is not
+              catching up
+        confidence - A float from 0 to 1 describing how well the samples fit
+        sbm_rate - Seconds of heartbeat lag recovered per second
+        bytes_rate - Bytes of replication logs recovered per second
+        """
+        ret = {'eta': None,
+               'confidence': 0.0,
+               'sbm_rate': None,
+               'bytes_rate': None}
+        estimates = []
+        sbm_fit = self._fit(1)
+        if sbm_fit:
+            (slope, current, r_squared) = sbm_fit
+            ret['sbm_rate'] = -slope
+            if current <= self.target_sbm:
+                estimates.append((0, r_squared))
+            elif slope < 0:
+                estimates.append(((current - self.target_sbm) / -slope,
+                                  r_squared))
+
+        bytes_fit = self._fit(2)
+        if bytes_fit:
+            (slope, current, r_squared) = bytes_fit
+            ret['bytes_rate'] = -slope
+            if slope < 0:
+                estimates.append((max(current, 0) / -slope, r_squared))
+
+        weight = sum(e[1] for e in estimates)
+        if not estimates:
+            return ret
+        elif weight == 0:
+            ret['eta'] = max(e[0] for e in estimates)
+        else:
+            ret['eta'] = sum(e[0] * e[1] for e in estimates) / weight
+        sample_factor = min(1.0, len(self.samples) / float(LAG_TRACKER_MIN_SAMPLES))
+        ret['confidence'] = weight / len(estimates) * sample_factor
+        return ret
+
+    def next_poll_interval(self, min_interval=LAG_POLL_MIN,
+                           max_interval=LAG_POLL_MAX):
+        """ Determine how long to wait before sampling lag again
+
+        Args:
+        min_interval - The shortest interval to return
+        max_interval - The longest interval to return
+
+        Returns:
+        A number of seconds
+        """
+        estimate = self.get_estimate()
+        if len(self.samples) < LAG_TRACKER_MIN_SAMPLES:
+            # gather enough data to say something useful
+            interval = min_interval
+        elif estimate['eta'] is None:
+            interval = LAG_POLL_LOW_CONFIDENCE_MAX
+        else:
+            interval = estimate['eta'] * LAG_POLL_FRACTION
+            if estimate['confidence'] < 0.5:
+                interval = min(interval, LAG_POLL_LOW_CONFIDENCE_MAX)
+        return max(min_interval, min(max_interval, interval))
+
+
 log = environment_specific.setup_logging_defaults(__name__)
 
 
@@ -359,6 +520,33 @@ def get_binlog_archiving_lag(instance):
         return None
 
 
+def get_binlogs_archived_since(instance, since):
+    """ Count the binlogs of an instance created since a point in time
+
+    Args:
+    instance - a hostAddr object. Note: the archiving log is queried on the
+               instance itself, so this should be a master.
+    since - A datetime object
+
+    Returns:
+    An int of the number of archived binlogs created since the supplied time
+    """
+    conn = connect_mysql(instance)
+    cursor = conn.cursor()
+    sql = ("SELECT COUNT(*) AS cnt "
+           "FROM {db}.{tbl} "
+           "WHERE hostname= %(hostname)s  AND "
+           "      port = %(port)s AND "
+           "      binlog_creation >= %(since)s"
+           "").format(db=METADATA_DB,
+                      tbl=environment_specific.BINLOG_ARCHIVING_TABLE_NAME)
+    params = {'hostname': instance.hostname,
+              'port': instance.port,
+              'since': since}
+    cursor.execute(sql, params)
+    return cursor.fetchone()['cnt']
+
+
 def calc_binlog_behind(log_file_num, log_file_pos, master_logs):
     """ Calculate replication lag in bytes
 
@@ -404,6 +592,92 @@ def get_global_variables(instance):
     return ret
 
 
+def get_global_status(instance):
+    """ Get MySQL global status
+
+    Args:
+    instance - A hostAddr object
+
+    Returns:
+    A dict with the key the status variable name
+    """
+    conn = connect_mysql(instance)
+    ret = dict()
+    cursor = conn.cursor()
+    cursor.execute("SHOW GLOBAL STATUS")
+    list_status = cursor.fetchall()
+    for entry in list_status:
+        ret[entry['Variable_name']] = entry['Value']
+
+    return ret
+
+
+def dump_buffer_pool(instance, timeout=BUFFER_POOL_DUMP_TIMEOUT):
+    """ Write the list of pages in the InnoDB buffer pool to disk and wait
+        for the dump to complete
+
+    Args:
+    instance - A hostAddr object
+    timeout - How many seconds to wait for the dump to complete
+    """
+    # The status of a previous dump, ie 'Buffer pool(s) dump completed at
+    # 170101 12:00:00', remains until the new dump changes it
+    previous_status = get_global_status(instance)['Innodb_buffer_pool_dump_status']
+    set_global_variable(instance, 'innodb_buffer_pool_dump_now', True)
+    start = time.time()
+    while True:
+        status = get_global_status(instance)['Innodb_buffer_pool_dump_status']
+        if BUFFER_POOL_STATUS_COMPLETED in status and status != previous_status:
+            log.info(status)
+            return
+        elif (time.time() - start) > timeout:
+            raise Exception('Buffer pool dump did not complete after {t} '
+                            'seconds: {status}'.format(t=timeout,
+                                                       status=status))
+        time.sleep(1)
+
+
+def load_buffer_pool(instance):
+    """ Start loading pages listed in the buffer pool dump file
+
+    Args:
+    instance - A hostAddr object
+    """
+    set_global_variable(instance, 'innodb_buffer_pool_load_now', True)
+
+
+def wait_buffer_pool_load(instance, timeout=BUFFER_POOL_LOAD_TIMEOUT):
+    """ Wait for a buffer pool load started by load_buffer_pool
+
+    Args:
+    instance - A hostAddr object
+    timeout - How many seconds to wait for the load to complete
+
+    Returns:
+    True if the load completed, False otherwise
+    """
+    start = time.time()
+    last_log = 0
+    while True:
+        status = get_global_status(instance)['Innodb_buffer_pool_load_status']
+        if BUFFER_POOL_STATUS_COMPLETED in status:
+            log.info(status)
+            return True
+        elif BUFFER_POOL_STATUS_ABORTED in status:
+            log.warning(status)
+            return False
+        elif (time.time() - start) > timeout:
+            log.warning('Buffer pool load did not complete after {t} '
+                        'seconds: {status}'.format(t=timeout,
+                                                   status=status))
+            return False
+
+        if (time.time() - last_log) > 60:
+            log.info(status)
+            last_log = time.time()
+        time.sleep(5)
+
+
 def get_dbs(instance):
     """ Get MySQL databases other than mysql, information_schema,
     performance_schema and test
@@ -431,6 +705,38 @@ def get_dbs(instance):
     return ret
 
 
+def get_integer_primary_key(instance, db, table):
+    """ Get the primary key column of a table if the primary key is a single
+        integer column
+
+    Args:
+    instance - A hostAddr object
+    db - A string that contains the database name
+    table - A string containing the name of the table
+
+    Returns:
+    The name of the column, or None if the primary key is missing, is a
+    composite or is not an integer.
+    """
+    conn = connect_mysql(instance)
+    cursor = conn.cursor()
+    sql = ("SELECT COLUMN_NAME, DATA_TYPE "
+           "FROM information_schema.columns "
+           "WHERE TABLE_SCHEMA=%(db)s AND "
+           "      TABLE_NAME=%(tbl)s AND "
+           "      COLUMN_KEY='PRI'")
+    cursor.execute(sql, {'db': db, 'tbl': table})
+    columns = cursor.fetchall()
+    if len(columns) != 1:
+        return None
+
+    if columns[0]['DATA_TYPE'] not in ('tinyint', 'smallint', 'mediumint',
+                                       'int', 'bigint'):
+        return None
+
+    return columns[0]['COLUMN_NAME']
+
+
 def does_table_exist(instance, db, table):
     """ Return True if a given table exists in a given database.
 
@@ -494,6 +800,33 @@ def get_tables(instance, db, skip_views=False):
     return ret
 
 
+def get_table_sizes(instance, db):
+    """ Get the size on disk of the tables of a db
+
+    Args:
+    instance - A hostAddr object
+    db - a string which contains a name of a db
+
+    Returns
+    A dict with a key of the table name and a value of the data length in
+    bytes, as reported by information_schema.
+    """
+    conn = connect_mysql(instance)
+    cursor = conn.cursor()
+    ret = dict()
+
+    param = {'db': db}
+    sql = ("SELECT TABLE_NAME, DATA_LENGTH "
+           "FROM information_schema.tables "
+           "WHERE TABLE_SCHEMA=%(db)s AND "
+           "      TABLE_TYPE='BASE TABLE'")
+    cursor.execute(sql, param)
+    for table in cursor.fetchall():
+        ret[table['TABLE_NAME']] = int(table['DATA_LENGTH'] or 0)
+
+    return ret
+
+
 def get_columns_for_table(instance, db, table):
     """ Get a list of columns in a table
 
@@ -717,6 +1050,30 @@ def get_connected_users(instance):
     return ret
 
 
+def get_table_columns(instance, db, table):
+    """ Get the columns of a table in order
+
+    Args:
+    instance - a hostAddr object
+    db - the MySQL database to run against
+    table - the table on the db database to run against
+
+    Returns:
+    A list of dicts with keys COLUMN_NAME, DATA_TYPE, COLUMN_TYPE,
+    NUMERIC_PRECISION, NUMERIC_SCALE and CHARACTER_SET_NAME
+    """
+    conn = connect_mysql(instance)
+    cursor = conn.cursor()
+    sql = ("SELECT COLUMN_NAME, DATA_TYPE, COLUMN_TYPE, "
+           "       NUMERIC_PRECISION, NUMERIC_SCALE, CHARACTER_SET_NAME "
+           "FROM information_schema.columns "
+           "WHERE TABLE_SCHEMA=%(db)s AND "
+           "      TABLE_NAME=%(tbl)s "
+           "ORDER BY ORDINAL_POSITION")
+    cursor.execute(sql, {'db': db, 'tbl': table})
+    return list(cursor.fetchall())
+
+
 def show_create_table(instance, db, table, standardize=True):
     """ Get a standardized CREATE TABLE statement
 
@@ -747,6 +1104,50 @@ def show_create_table(instance, db, table, standardize=True):
     return ret
 
 
+def show_create_tables(instance, db, conn=None, standardize=True):
+    """ Get standardized CREATE TABLE statements for all tables in a db,
+        using a single connection
+
+    Args:
+    instance - a hostAddr object
+    db - the MySQL database to run against
+    conn - (optional) a connection to reuse, default is to open a new one
+    standardize - Remove AUTO_INCREMENT=$NUM and similar
+
+    Returns:
+    A dict with a key of the table name and a value of the CREATE TABLE
+    statement
+    """
+    if not conn:
+        conn = connect_mysql(instance)
+    cursor = conn.cursor()
+    ret = dict()
+
+    param = {'db': db}
+    sql = ("SELECT TABLE_NAME "
+           "FROM information_schema.tables "
+           "WHERE TABLE_SCHEMA=%(db)s AND "
+           "      TABLE_TYPE='BASE TABLE'")
+    cursor.execute(sql, param)
+    for row in cursor.fetchall():
+        table = row['TABLE_NAME']
+        try:
+            cursor.execute('SHOW CREATE TABLE `{db}`.`{table}`'.format(table=table,
+                                                                       db=db))
+        except MySQLdb.ProgrammingError as detail:
+            (error_code, msg) = detail.args
+            if error_code != MYSQL_ERROR_NO_SUCH_TABLE:
+                raise
+            # Dropped since we listed the tables
+            continue
+        create_stm = cursor.fetchone()['Create Table']
+        if standardize is True:
+            create_stm = re.sub('AUTO_INCREMENT=[0-9]+ ', '', create_stm)
+        ret[table] = create_stm
+
+    return ret
+
+
 def create_db(instance, db):
     """ Create a database if it does not already exist
 
@@ -975,10 +1376,8 @@ def wait_replication_catch_up(slave_hostaddr):
     Args:
     slave_hostaddr - A HostAddr object
     """
-    last_sbm = None
     catch_up_sbm = NORMAL_HEARTBEAT_LAG - HEARTBEAT_SAFETY_MARGIN
-    remaining_time = 'Not yet availible'
-    sleep_duration = 5
+    tracker = ReplicationLagTracker(catch_up_sbm)
 
     # Confirm that replication is setup at all
     get_slave_status(slave_hostaddr)
@@ -1012,32 +1411,23 @@ def wait_replication_catch_up(slave_hostaddr):
                                catch_up_sbm=catch_up_sbm))
             return
 
-        # last_sbm is set at the end of the first execution and should always
-        # be set from then on
-        if last_sbm:
-            catch_up_rate = (last_sbm - replication['sbm']) / float(sleep_duration)
-            if catch_up_rate > 0:
-                remaining_time = datetime.timedelta(seconds=((replication['sbm'] - catch_up_sbm) / catch_up_rate))
-                if remaining_time.total_seconds() > 6 * 60 * 60:
-                    sleep_duration = 5 * 60
-                elif remaining_time.total_seconds() > 60 * 60:
-                    sleep_duration = 60
-                else:
-                    sleep_duration = 5
-            else:
-                remaining_time = '> heat death of the universe'
-                sleep_duration = 60
-            log.info('Replication is lagged by {sbm} seconds, waiting '
-                     'for < {catch_up}. Guestimate time to catch up: {eta}'
-                     ''.format(sbm=replication['sbm'],
-                               catch_up=catch_up_sbm,
-                               eta=str(remaining_time)))
+        tracker.add_sample(replication)
+        estimate = tracker.get_estimate()
+        if estimate['eta'] is None:
+            eta = 'Not yet availible'
         else:
-            # first time through
-            log.info('Replication is lagged by {sbm} seconds.'
-                     ''.format(sbm=replication['sbm']))
-
-        last_sbm = replication['sbm']
+            eta = str(datetime.timedelta(seconds=int(estimate['eta'])))
+        sleep_duration = tracker.next_poll_interval()
+        log.info('Replication is lagged by {sbm} seconds and {sql_bytes} '
+                 'bytes, waiting for < {catch_up}. Estimated time to catch '
+                 'up: {eta} (confidence {conf:.2f}), checking again in '
+                 '{sleep:.0f} seconds'
+                 ''.format(sbm=replication['sbm'],
+                           sql_bytes=replication['sql_bytes'],
+                           catch_up=catch_up_sbm,
+                           eta=eta,
+                           conf=estimate['confidence'],
+                           sleep=sleep_duration))
         time.sleep(sleep_duration)
 
 
@@ -0,0 +1,133 @@
+"""
+A streaming implementation of the transform done by the nullescape binary
+(see NullEscape.c). SELECT ... INTO OUTFILE escapes NUL as 0x5c30, which hive
+reads as a literal backslash and zero. A 0x5c30 preceded by no or an even
+number of 0x5c is translated to 0x00, anything else is left alone.
+
+If libnullescape.so has been built from NullEscape.c it is used to do the
+transform, otherwise a pure python implementation is used.
+"""
+import ctypes
+import os
+import re
+
+BACKSLASH = b'\\'
+# Matching whole runs of backslashes, rather than a run followed by a zero,
+# keeps long runs linear and lets the regex engine search for the literal
+NULL_ESCAPE_RE = re.compile(br'\\+0?')
+LIBRARY_NAME = 'libnullescape.so'
+LIBRARY_PATHS = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              LIBRARY_NAME),
+                 os.path.join('/usr/local/lib', LIBRARY_NAME)]
+
+
+def load_library(path):
+    """ Load the shared library built from NullEscape.c
+
+    Args:
+    path - The path to the library
+
+    Returns:
+    A ctypes library object
+    """
+    library = ctypes.CDLL(path)
+    library.nullescape_block.argtypes = [ctypes.c_char_p,
+                                         ctypes.c_size_t,
+                                         ctypes.c_char_p,
+                                         ctypes.POINTER(ctypes.c_long)]
+    library.nullescape_block.restype = ctypes.c_size_t
+    return library
+
+
+def find_library():
+    """ Find and load the shared library built from NullEscape.c
+
+    Returns:
+    A ctypes library object, or None if the library is not available
+    """
+    for path in LIBRARY_PATHS:
+        if os.path.exists(path):
+            try:
+                return load_library(path)
+            except OSError:
+                pass
+    return None
+
+
+_library = find_library()
+
+
+def _replace_escape(match):
+    escape = match.group(0)
+    run = len(escape) - 1
+    if escape[-1:] == b'0' and run % 2:
+        return BACKSLASH * (run - 1) + b'\x00'
+    return escape
+
+
+class NullEscaper(object):
+    """ Apply the null escape transform to a stream of blocks """
+
+    def __init__(self, library=None, pure_python=False):
+        """
+        Args:
+        library - (optional) a library returned by load_library. Default is
+                  to use the library found at import time if there is one.
+        pure_python - (optional) never use the library
+        """
+        if pure_python:
+            self.library = None
+        else:
+            self.library = library or _library
+        # A run of backslashes at the end of a block can only be resolved
+        # once we see the following byte, so it is held back until then.
+        self.pending = 0
+
+    def transform(self, data):
+        """ Transform a block of the stream
+
+        Args:
+        data - A string of bytes
+
+        Returns:
+        A string of transformed bytes, which may be shorter than data if
+        trailing backslashes are being held back.
+        """
+        if not self.pending and BACKSLASH not in data:
+            return data
+
+        if self.library:
+            pending = ctypes.c_long(self.pending)
+            out = ctypes.create_string_buffer(len(data) + self.pending)
+            written = self.library.nullescape_block(data, len(data), out,
+                                                    ctypes.byref(pending))
+            self.pending = pending.value
+            return out.raw[:written]
+
+        data = BACKSLASH * self.pending + data
+        stripped = data.rstrip(BACKSLASH)
+        self.pending = len(data) - len(stripped)
+        if b'\\0' not in stripped:
+            return stripped
+        return NULL_ESCAPE_RE.sub(_replace_escape, stripped)
+
+    def flush(self):
+        """ Return any bytes held back at the end of the stream """
+        pending = self.pending
+        self.pending = 0
+        return BACKSLASH * pending
+
+
+def null_escape(data, library=None, pure_python=False):
+    """ Apply the null escape transform to a complete buffer
+
+    Args:
+    data - A string of bytes
+    library - (optional) a library returned by load_library
+    pure_python - (optional) never use the library
+
+    Returns:
+    A string of transformed bytes
+    """
+    escaper = NullEscaper(library, pure_python)
+    return escaper.transform(data) + escaper.flush()
@@ -0,0 +1,139 @@
+"""
+Write the rows of a MySQL query to a Parquet file, a batch of rows at a
+time so that memory use is bounded by the batch size. Requires pyarrow, use
+available() to check.
+"""
+import MySQLdb.cursors
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+BATCH_ROWS = 100000
+COMPRESSION = 'snappy'
+INTEGER_TYPES = {'tinyint': 8,
+                 'smallint': 16,
+                 'mediumint': 32,
+                 'int': 32,
+                 'bigint': 64}
+STRING_TYPES = set(['char', 'varchar', 'tinytext', 'text', 'mediumtext',
+                    'longtext', 'enum', 'set', 'json'])
+BINARY_TYPES = set(['binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob',
+                    'longblob', 'bit', 'geometry'])
+# Text in any other character set is written as the bytes stored in MySQL,
+# as arrow strings must be utf8
+UTF8_CHARSETS = set(['ascii', 'utf8', 'utf8mb3', 'utf8mb4'])
+
+
+def available():
+    """ Check if parquet output is possible
+
+    Returns:
+    True if pyarrow is installed, False otherwise
+    """
+    return pyarrow is not None
+
+
+def get_arrow_type(column):
+    """ Map a MySQL column to an arrow type
+
+    Args:
+    column - A dict as returned by mysql_lib.get_table_columns
+
+    Returns:
+    A pyarrow DataType
+    """
+    data_type = column['DATA_TYPE'].lower()
+    if data_type in INTEGER_TYPES:
+        bits = INTEGER_TYPES[data_type]
+        if 'unsigned' in column['COLUMN_TYPE'].lower():
+            return getattr(pyarrow, 'uint{bits}'.format(bits=bits))()
+        return getattr(pyarrow, 'int{bits}'.format(bits=bits))()
+    elif data_type == 'decimal':
+        return pyarrow.decimal128(int(column['NUMERIC_PRECISION']),
+                                  int(column['NUMERIC_SCALE']))
+    elif data_type == 'float':
+        return pyarrow.float32()
+    elif data_type == 'double':
+        return pyarrow.float64()
+    elif data_type == 'year':
+        return pyarrow.int16()
+    elif data_type == 'date':
+        return pyarrow.date32()
+    elif data_type in ('datetime', 'timestamp'):
+        return pyarrow.timestamp('us')
+    elif data_type == 'time':
+        return pyarrow.duration('us')
+    elif data_type in STRING_TYPES:
+        if column['CHARACTER_SET_NAME'] in UTF8_CHARSETS:
+            return pyarrow.string()
+        return pyarrow.binary()
+    elif data_type in BINARY_TYPES:
+        return pyarrow.binary()
+    raise Exception('Unsupported column type {data_type} for column '
+                    '{column}'.format(data_type=data_type,
+                                      column=column['COLUMN_NAME']))
+
+
+def get_arrow_schema(columns):
+    """ Map the columns of a MySQL table to an arrow schema
+
+    Args:
+    columns - A list of dicts as returned by mysql_lib.get_table_columns
+
+    Returns:
+    A pyarrow Schema
+    """
+    return pyarrow.schema([pyarrow.field(column['COLUMN_NAME'],
+                                         get_arrow_type(column))
+                           for column in columns])
+
+
+def write_query(conn, sql, params, columns, path, batch_rows=BATCH_ROWS):
+    """ Stream the results of a query into a Parquet file, writing a row
+        group per batch of rows
+
+    Args:
+    conn - A connection to MySQL. The query is run in whatever transaction
+           the connection has open, ie a consistent snapshot. Results are
+           read in the character set of each column, rather than converted
+           to the connection's, for the duration of the query.
+    sql - A SELECT statement whose columns match columns
+    params - Parameters for the statement
+    columns - A list of dicts as returned by mysql_lib.get_table_columns
+    path - The local path to write
+    batch_rows - The number of rows to hold in memory at once
+
+    Returns:
+    The number of rows written
+    """
+    schema = get_arrow_schema(columns)
+    rows_written = 0
+    charset_cursor = conn.cursor(MySQLdb.cursors.Cursor)
+    charset_cursor.execute('SELECT @@session.character_set_results')
+    (charset_results,) = charset_cursor.fetchone()
+    charset_cursor.execute('SET SESSION character_set_results = NULL')
+    cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+    writer = pyarrow.parquet.ParquetWriter(path, schema,
+                                           compression=COMPRESSION)
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            arrays = [pyarrow.array([row[i] for row in rows],
+                                    type=schema[i].type)
+                      for i in range(len(columns))]
+            writer.write_table(pyarrow.Table.from_arrays(arrays,
+                                                         schema=schema))
+            rows_written += len(rows)
+    finally:
+        writer.close()
+        cursor.close()
+        charset_cursor.execute('SET SESSION character_set_results = %s',
+                               (charset_results,))
+        charset_cursor.close()
+    return rows_written
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import binascii
+import distutils.spawn
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from lib import nullescape
+
+NULLESCAPE_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 os.pardir, 'NullEscape.c')
+
+# From the comments in NullEscape.c
+sample_transforms = [('5c30', '00'),
+                     ('5c5c30', '5c5c30'),
+                     ('5c5c5c30', '5c5c00'),
+                     ('5c5c5c5c30', '5c5c5c5c30'),
+                     ('5c5c5c3030', '5c5c0030'),
+                     ('5c5c5c5c3030', '5c5c5c5c3030'),
+                     ('5c5c5c40', '5c5c5c40'),
+                     ('5c5c5c5c40', '5c5c5c5c40'),
+                     ('310964617461310930205c090d5c0a22275c305c5c3009322e320a',
+                      '310964617461310930205c090d5c0a2227005c5c3009322e320a')]
+
+
+def reference_null_escape(data):
+    """
+    A byte at a time port of the original NullEscape.c
+    """
+    out = bytearray()
+    data = bytearray(data)
+    i = 0
+    while i < len(data):
+        c = data[i]
+        i += 1
+        if c != 0x5c:
+            out.append(c)
+            continue
+
+        count = 0
+        while True:
+            if i == len(data):
+                out.append(0x5c)
+                return bytes(out)
+            c = data[i]
+            i += 1
+            if c == 0x30:
+                if count % 2 == 0:
+                    out.append(0x00)
+                else:
+                    out.extend(b'\x5c\x30')
+                break
+            elif c == 0x5c:
+                out.append(0x5c)
+                count += 1
+            else:
+                out.append(0x5c)
+                out.append(c)
+                break
+    return bytes(out)
+
+
+def random_data(rand, max_length):
+    """
+    Random data which is mostly backslashes and zeros, so that escapes and
+    runs of backslashes of all lengths are common
+    """
+    length = rand.randint(0, max_length)
+    return bytes(bytearray(rand.choice(b'\\\\\\\\00a\x00')
+                           for _ in range(length)))
+
+
+def transform_in_blocks(escaper, data, rand, max_block):
+    """
+    Feed data through an escaper in randomly sized blocks
+    """
+    out = []
+    offset = 0
+    while offset < len(data):
+        size = rand.randint(1, max_block)
+        out.append(escaper.transform(data[offset:offset + size]))
+        offset += size
+    out.append(escaper.flush())
+    return b''.join(out)
+
+
+class NullEscapeTests(object):
+    """
+    Tests run against each implementation, subclasses provide escaper()
+    """
+
+    def test_sample_transforms(self):
+        """
+        The sample transforms documented in NullEscape.c should hold
+        """
+        for (before, after) in sample_transforms:
+            escaper = self.escaper()
+            result = (escaper.transform(binascii.unhexlify(before)) +
+                      escaper.flush())
+            self.assertEqual(binascii.hexlify(result).decode(), after)
+
+    def test_matches_reference(self):
+        """
+        Random data split into random blocks should transform exactly as the
+        original byte at a time implementation does
+        """
+        rand = random.Random(0)
+        for _ in range(5000):
+            data = random_data(rand, 64)
+            self.assertEqual(transform_in_blocks(self.escaper(), data,
+                                                 rand, 8),
+                             reference_null_escape(data))
+
+    def test_long_backslash_runs(self):
+        """
+        Runs of backslashes spanning many blocks should keep their parity
+        """
+        rand = random.Random(1)
+        for run in (1, 2, 65535, 65536, 65537, 200001):
+            for tail in (b'', b'0', b'a'):
+                data = b'x' + b'\\' * run + tail
+                self.assertEqual(transform_in_blocks(self.escaper(), data,
+                                                     rand, 70000),
+                                 reference_null_escape(data))
+
+    def test_no_backslash_passthrough(self):
+        """
+        Data without backslashes should be returned untouched
+        """
+        data = b'1\tdata\x00\n' * 1000
+        self.assertEqual(self.escaper().transform(data), data)
+
+
+class TestPurePython(NullEscapeTests, unittest.TestCase):
+
+    def escaper(self):
+        return nullescape.NullEscaper(pure_python=True)
+
+
+@unittest.skipUnless(distutils.spawn.find_executable('gcc'),
+                     'gcc is required to build NullEscape.c')
+class TestLibrary(NullEscapeTests, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.build_dir = tempfile.mkdtemp()
+        path = os.path.join(cls.build_dir, nullescape.LIBRARY_NAME)
+        subprocess.check_call(['gcc', '-O2', '-shared', '-fPIC',
+                               '-DNULLESCAPE_NO_MAIN', '-o', path,
+                               NULLESCAPE_SOURCE])
+        cls.library = nullescape.load_library(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.build_dir)
+
+    def escaper(self):
+        return nullescape.NullEscaper(library=self.library)
+
+
+@unittest.skipUnless(distutils.spawn.find_executable('gcc'),
+                     'gcc is required to build NullEscape.c')
+class TestCommandLine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.build_dir = tempfile.mkdtemp()
+        cls.binary = os.path.join(cls.build_dir, 'nullescape')
+        subprocess.check_call(['gcc', '-O2', '-o', cls.binary,
+                               NULLESCAPE_SOURCE])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.build_dir)
+
+    def run_binary(self, data):
+        proc = subprocess.Popen([self.binary],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        (out, _) = proc.communicate(data)
+        self.assertEqual(proc.returncode, 0)
+        return out
+
+    def test_matches_reference(self):
+        """
+        The CLI should transform random data, including backslash runs longer
+        than its read buffer, exactly as the original implementation does
+        """
+        rand = random.Random(2)
+        for _ in range(50):
+            data = random_data(rand, 200000)
+            self.assertEqual(self.run_binary(data),
+                             reference_null_escape(data))
+        for run in (65535, 65536, 65537, 131073):
+            for tail in (b'', b'0', b'a'):
+                data = b'\\' * run + tail
+                self.assertEqual(self.run_binary(data),
+                                 reference_null_escape(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
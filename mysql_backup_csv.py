@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 import argparse
 import datetime
+import hashlib
 import json
 import logging
 import multiprocessing
+import multiprocessing.pool
 import os
+import Queue
 import subprocess
 import threading
 import time
@@ -20,7 +23,10 @@ import mysql_backup_status
 from lib import backup
 from lib import environment_specific
 from lib import host_utils
+from lib import lzop
 from lib import mysql_lib
+from lib import nullescape
+from lib import parquet_writer
 
 ACTIVE = 'active'
 CSV_BACKUP_LOCK_TABLE_NAME = 'backup_locks'
@@ -39,13 +45,103 @@ CSV_BACKUP_LOCK_TABLE = """CREATE TABLE IF NOT EXISTS {db}.{tbl} (
   INDEX `expires` (`expires`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1"""
 MAX_THREAD_ERROR = 5
+# Threads per worker for uploading schemas and other small objects
+SMALL_UPLOAD_THREADS = 4
 LOCKS_HELD_TIME = '5 MINUTE'
 # How long locks are held and updated
 LOCK_EXTEND_FREQUENCY = 10
 # LOCK_EXTEND_FREQUENCY in seconds
+# Seconds to wait for another worker to finish taking or releasing a db lock
+DB_LOCK_WAIT = .1
+# How long replication may be stopped waiting for workers to take snapshots
+SNAPSHOT_BARRIER_TIMEOUT = 60
+# Seconds a worker blocks on the work queue before checking again whether
+# any units are outstanding
+QUEUE_GET_TIMEOUT = 1
+
+# Concurrency control. All workers take a snapshot at start, but only
+# ACTIVE_WORKERS_START of them do work at once at first. Every CONCURRENCY_INTERVAL
+# seconds one more is allowed to work if replication lag and disk and
+# network utilization are below the RAMP thresholds, or one fewer if any are
+# above the BACKOFF thresholds.
+ACTIVE_WORKERS_START = 2
+CONCURRENCY_INTERVAL = 30
+LAG_RAMP_SECONDS = 60
+LAG_BACKOFF_SECONDS = 600
+DISK_UTIL_RAMP = 0.6
+DISK_UTIL_BACKOFF = 0.9
+NIC_UTIL_RAMP = 0.6
+NIC_UTIL_BACKOFF = 0.9
+NIC_BANDWIDTH_BYTES = 10 * 1000 * 1000 * 1000 / 8
+
+# Tables larger than this are split into primary key ranges when chunking
+CHUNK_SIZE = 10 * 1024 * 1024 * 1024
+MAX_CHUNKS = 64
+PART_PATH_FORMAT = '{base}-part{part:05d}{ext}'
+
+# Delta exports. Tables returned by environment_specific.get_csv_delta_tables
+# only export rows past a watermark, with a full export every
+# DELTA_FULL_EXPORT_DAYS days. The state before backup_date is kept so that
+# rerunning a date exports the same range again.
+CSV_WATERMARK_TABLE_NAME = 'csv_backup_watermarks'
+CSV_WATERMARK_TABLE = """CREATE TABLE IF NOT EXISTS {db}.{tbl} (
+  `db` varchar(64) NOT NULL,
+  `tbl` varchar(64) NOT NULL,
+  `watermark_column` varchar(64) NOT NULL,
+  `watermark` varchar(64) NOT NULL,
+  `backup_date` date NOT NULL,
+  `last_full_export` date NOT NULL,
+  `previous_watermark` varchar(64) DEFAULT NULL,
+  `previous_full_export` date DEFAULT NULL,
+  `updated` datetime NOT NULL,
+  PRIMARY KEY (`db`, `tbl`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1"""
+DELTA_FULL_EXPORT_DAYS = 7
+# Rows can appear below a watermark after it was read, ie auto increment ids
+# committed out of order or rows stamped with the same time as the
+# watermark. Delta exports re-scan this far below the watermark, so
+# consumers must merge on the primary key.
+DELTA_OVERLAP_IDS = 100000
+DELTA_OVERLAP_SECONDS = 3600
+DELTA_INTEGER_TYPES = set(['tinyint', 'smallint', 'mediumint', 'int',
+                           'bigint'])
+DELTA_TEMPORAL_TYPES = set(['date', 'datetime', 'timestamp'])
+
+# A row per uploaded key, so that verification does not have to go to s3
+CSV_LEDGER_TABLE_NAME = 'csv_backup_ledger'
+CSV_LEDGER_TABLE = """CREATE TABLE IF NOT EXISTS {db}.{tbl} (
+  `backup_date` date NOT NULL,
+  `bucket` varchar(255) NOT NULL,
+  `s3_key` varchar(512) NOT NULL,
+  `db` varchar(64) NOT NULL,
+  `tbl` varchar(64) NOT NULL,
+  `bytes` bigint unsigned DEFAULT NULL,
+  `row_count` bigint unsigned DEFAULT NULL,
+  `duration` float DEFAULT NULL,
+  `checksum` char(32) DEFAULT NULL,
+  `uploaded` datetime NOT NULL,
+  PRIMARY KEY (`backup_date`, `bucket`, `s3_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1"""
+PATH_DELTA_DATA = 'delta/{replica_set}/{db_name}/{table}/{date}'
+# Read size for the in process export pipeline
+PIPELINE_READ_SIZE = 1024 * 1024
+# How long a failed dump query will try to signal EOF to the fifo reader
+FIFO_UNBLOCK_TIMEOUT = 10
+
+OUTPUT_FORMAT_CSV = 'csv'
+OUTPUT_FORMAT_PARQUET = 'parquet'
+PARQUET_EXTENSION = '.parquet'
+UPLOAD_READ_SIZE = 8 * 1024 * 1024
+
+# A local journal of completed work, so a restarted run can continue where a
+# crashed one stopped without rescanning s3
+JOURNAL_FILE_PREFIX = 'csv_backup_journal.'
+JOURNAL_CHUNKS = 'chunks'
+JOURNAL_DONE = 'done'
 
 PATH_PITR_DATA = 'pitr/{replica_set}/{db_name}/{date}'
 SUCCESS_ENTRY = 'YAY_IT_WORKED'
+ROWS_ENTRY = 'ROWS'
 
 log = logging.getLogger(__name__)
 
@@ -70,12 +166,23 @@ def main():
                         default=False,
                         action='store_true',
                         help='Use the dev bucket, useful for testing')
+    parser.add_argument('--chunk',
+                        default=False,
+                        action='store_true',
+                        help=('Export large tables as several primary key '
+                              'ranges in parallel'))
+    parser.add_argument('--output_format',
+                        default=OUTPUT_FORMAT_CSV,
+                        choices=[OUTPUT_FORMAT_CSV, OUTPUT_FORMAT_PARQUET],
+                        help=('Export null escaped, lzop compressed tsv '
+                              '(default) or parquet'))
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.loglevel.upper(), None))
     # If we ever want to run multi instance, this wil need to be updated
     backup_obj = mysql_backup_csv(host_utils.HostAddr(host_utils.HOSTNAME),
                                   args.db, args.force_table,
-                                  args.force_reupload, args.dev_bucket)
+                                  args.force_reupload, args.dev_bucket,
+                                  args.chunk, args.output_format)
     backup_obj.backup_instance()
 
 
@@ -83,7 +190,8 @@ class mysql_backup_csv:
 
     def __init__(self, instance,
                  db=None, force_table=None,
-                 force_reupload=False, dev_bucket=False):
+                 force_reupload=False, dev_bucket=False, chunk=False,
+                 output_format=OUTPUT_FORMAT_CSV):
         """ Init function for backup, takes all args
 
         Args:
@@ -91,20 +199,23 @@ class mysql_backup_csv:
         db - (option) backup only specified db
         force_table - (option) backup only specified table
         force_reupload - (optional) force reupload of backup
+        dev_bucket - (optional) use the dev bucket
+        chunk - (optional) export large tables in primary key ranges
+        output_format - (optional) OUTPUT_FORMAT_CSV or OUTPUT_FORMAT_PARQUET
         """
         self.instance = instance
         self.timestamp = datetime.datetime.utcnow()
         # datestamp is for s3 files which are by convention -1 day
         self.datestamp = (self.timestamp - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-        self.dbs_to_backup = multiprocessing.Queue()
-        if db:
-            self.dbs_to_backup.put(db)
-        else:
-            for db in mysql_lib.get_dbs(self.instance):
-                self.dbs_to_backup.put(db)
+        self.db = db
 
         self.force_table = force_table
         self.force_reupload = force_reupload
+        self.chunk = chunk
+        if (output_format == OUTPUT_FORMAT_PARQUET and
+                not parquet_writer.available()):
+            raise Exception('Parquet output requires pyarrow')
+        self.output_format = output_format
         if dev_bucket:
             self.upload_bucket = environment_specific.S3_CSV_BUCKET_DEV
         else:
@@ -129,127 +240,512 @@ class mysql_backup_csv:
             log.info('Will temporarily dump inside of {path}'
                      ''.format(path=self.dump_base_path))
 
+            self.lock_manager = BackupLockManager(self.instance)
             log.info('Releasing any invalid shard backup locks')
-            self.ensure_backup_locks_sanity()
+            self.lock_manager.ensure_sanity()
 
             log.info('Deleting old expired locks')
-            self.purge_old_expired_locks()
+            self.lock_manager.purge_old_expired()
+            self.lock_manager.execute(CSV_WATERMARK_TABLE.format(db=mysql_lib.METADATA_DB,
+                                                                 tbl=CSV_WATERMARK_TABLE_NAME))
+            self.lock_manager.execute(CSV_LEDGER_TABLE.format(db=mysql_lib.METADATA_DB,
+                                                              tbl=CSV_LEDGER_TABLE_NAME))
+
+            log.info('Determining tables to backup')
+            self.setup_table_queue()
+            # Workers have their own lock managers, and should not inherit
+            # an open connection
+            self.lock_manager.close()
+
+            # Workers signal once they have a snapshot. Replication is
+            # restarted as soon as all have, or after a timeout in which case
+            # the late workers exit rather than work from a different snapshot.
+            self.snapshots_taken = multiprocessing.Semaphore(0)
+            self.snapshot_window_lock = multiprocessing.Lock()
+            self.snapshot_window_closed = multiprocessing.Event()
 
             log.info('Stopping replication SQL thread to get a snapshot')
             mysql_lib.stop_replication(self.instance, mysql_lib.REPLICATION_THREAD_SQL)
-
+            pause_start = time.time()
+
+            max_workers = multiprocessing.cpu_count() / 2
+            self.active_workers = multiprocessing.Value('i', min(ACTIVE_WORKERS_START,
+                                                                max_workers))
+            # Count of workers with a table in hand, protected by the lock of
+            # active_workers. Turns are handed to whichever live worker asks,
+            # so workers which exited early do not hold on to them.
+            self.working_workers = multiprocessing.Value('i', 0, lock=False)
             workers = []
-            for _ in range(multiprocessing.cpu_count() / 2):
-                proc = multiprocessing.Process(target=self.mysql_backup_csv_dbs)
+            for _ in range(max_workers):
+                proc = multiprocessing.Process(target=self.mysql_backup_csv_tables)
                 proc.daemon = True
                 proc.start()
                 workers.append(proc)
-            # throw in a sleep to make sure all threads have started dumps
-            time.sleep(2)
+
+            snapshots = self.wait_for_snapshots(len(workers), pause_start)
             log.info('Restarting replication')
             mysql_lib.start_replication(self.instance, mysql_lib.REPLICATION_THREAD_SQL)
-
-            for worker in workers:
-                worker.join()
-
-            if not self.dbs_to_backup.empty():
+            log.info('Replication was paused for {pause:.2f} seconds, '
+                     '{snapshots} of {workers} workers took snapshots'
+                     ''.format(pause=time.time() - pause_start,
+                               snapshots=snapshots,
+                               workers=len(workers)))
+            if not snapshots:
+                raise Exception('No workers took a snapshot within {timeout} '
+                                'seconds'.format(timeout=SNAPSHOT_BARRIER_TIMEOUT))
+
+            self.control_concurrency(workers)
+
+            if self.units_remaining.value:
                 raise Exception('All worker processes have completed, but '
                                 'work remains in the queue')
 
-            log.info('CSV backup is complete, will run a check')
-            mysql_backup_status.verify_csv_backup(self.instance.replica_type,
-                                                  self.datestamp,
-                                                  self.instance)
+            if self.output_format == OUTPUT_FORMAT_PARQUET:
+                log.info('Parquet backup is complete, the csv backup check '
+                         'does not apply')
+            else:
+                log.info('CSV backup is complete, will run a check')
+                mysql_backup_status.verify_csv_backup(self.instance.replica_type,
+                                                      self.datestamp,
+                                                      self.instance)
         finally:
             if host_lock_handle:
                 log.info('Releasing general host backup lock')
                 host_utils.release_flock_lock(host_lock_handle)
 
-    def mysql_backup_csv_dbs(self):
-        """ Worker for backing up a queue of dbs """
+    def setup_table_queue(self):
+        """ Populate the shared work queue with (db, table) units, largest
+            tables first so that the longest running dumps start early and
+            smaller tables fill in around them.
+        """
+        if self.db:
+            dbs = [self.db]
+        else:
+            dbs = mysql_lib.get_dbs(self.instance)
+
+        self.manager = multiprocessing.Manager()
+        self.chunks_remaining = self.manager.dict()
+        self.journal_lock = multiprocessing.Lock()
+        (journal_found, journaled, chunk_plans) = self.load_journal()
+
+        units = list()
+        finished_chunks = list()
+        self.delta_tables = dict()
+        for db in dbs:
+            self.delta_tables[db] = get_csv_delta_tables(self.instance, db)
+            sizes = mysql_lib.get_table_sizes(self.instance, db)
+            for table in self.get_tables_to_backup(db):
+                if (db, table, None) in journaled:
+                    continue
+
+                size = sizes.get(table, 0)
+                chunks = None
+                if (db, table) in chunk_plans:
+                    # Keep the ranges of the interrupted run, so that the
+                    # parts line up
+                    chunks = chunk_plans[(db, table)]
+                elif self.chunk and table not in self.delta_tables.get(db, {}):
+                    chunks = self.get_table_chunks(db, table, size)
+                    if chunks:
+                        self.journal({'type': JOURNAL_CHUNKS,
+                                      'db': db,
+                                      'table': table,
+                                      'chunks': chunks})
+
+                if not chunks:
+                    units.append((size, db, table, None))
+                    continue
+
+                remaining = [chunk for chunk in chunks
+                             if (db, table, chunk[0]) not in journaled]
+                if not remaining:
+                    finished_chunks.append((db, table))
+                    continue
+
+                self.chunks_remaining[(db, table)] = len(remaining)
+                for chunk in remaining:
+                    units.append((size / len(chunks), db, table, chunk))
+        units.sort(reverse=True)
+
+        for (db, table) in finished_chunks:
+            self.finish_chunked_table(db, table)
+
+        # Build an index of what has already been uploaded before the workers
+        # are forked, so that skip decisions are set lookups. If a journal
+        # was found, it is used instead.
+        self.existing_keys = set()
+        if journal_found:
+            log.info('Resuming from journal {path}, {cnt} units remain'
+                     ''.format(path=self.journal_path,
+                               cnt=len(units)))
+        elif not self.force_reupload:
+            paths = set()
+            for (_, db, table, _) in units:
+                paths.add(self.get_data_path(db, table))
+            boto_conn = boto.connect_s3()
+            bucket = boto_conn.get_bucket(self.upload_bucket, validate=False)
+            self.existing_keys = backup.list_existing_keys(bucket, paths,
+                                                           self.datestamp)
+            log.info('Found {cnt} existing keys for {date}'
+                     ''.format(cnt=len(self.existing_keys),
+                               date=self.datestamp))
+
+        self.tables_to_backup = multiprocessing.Queue()
+        for (_, db, table, chunk) in units:
+            self.tables_to_backup.put((db, table, chunk))
+        # An empty queue does not mean there is no work left, the feeder
+        # thread may not have flushed it yet and failed units are put back.
+        # Workers only exit once this count of unfinished units is 0.
+        self.units_remaining = multiprocessing.Value('i', len(units))
+        # Set if a worker dies outside of python, ie is killed, as the unit
+        # it held will never be finished
+        self.worker_lost = multiprocessing.Event()
+        log.info('Queued {cnt} tables from {dbs} dbs, {size} bytes total'
+                 ''.format(cnt=len(units),
+                           dbs=len(dbs),
+                           size=sum(unit[0] for unit in units)))
+
+        # Backup locks on the master are per db, but tables of a db may be
+        # in flight in several workers at once. Track the lock and a count
+        # of in flight tables so that the lock is taken by the first worker
+        # and released by the last. While the lock is being taken or
+        # released on the master the identifier is None.
+        self.db_locks = self.manager.dict()
+        self.pitr_uploaded = self.manager.dict()
+        self.db_locks_mutex = multiprocessing.Lock()
+        # Dbs which another host was found backing up. The lock is released
+        # between tables, so once a db is seen locked by another host it is
+        # left to that host for the rest of the run, otherwise each host
+        # could skip tables the other never gets to.
+        self.foreign_dbs = self.manager.dict()
+
+    def wait_for_snapshots(self, workers, pause_start):
+        """ Wait for workers to take consistent snapshots, then close the
+            window in which snapshots are allowed
+
+        Args:
+        workers - The number of workers started
+        pause_start - When replication was stopped, as a unix timestamp
+
+        Returns:
+        The number of workers which took a snapshot in time
+        """
+        snapshots = 0
+        while snapshots < workers:
+            remaining = pause_start + SNAPSHOT_BARRIER_TIMEOUT - time.time()
+            if remaining <= 0 or not self.snapshots_taken.acquire(True, remaining):
+                log.warning('Timed out waiting for worker snapshots')
+                break
+            snapshots += 1
+
+        with self.snapshot_window_lock:
+            self.snapshot_window_closed.set()
+            # Count any worker which signalled after the timeout but before
+            # the window closed, its snapshot was still taken while
+            # replication was stopped
+            while self.snapshots_taken.acquire(False):
+                snapshots += 1
+        return snapshots
+
+    def signal_snapshot_taken(self):
+        """ Tell the parent process that this worker has a snapshot
+
+        Returns:
+        True if the snapshot was taken in time, False if replication may have
+        been restarted and the worker should exit
+        """
+        with self.snapshot_window_lock:
+            if self.snapshot_window_closed.is_set():
+                return False
+            self.snapshots_taken.release()
+            return True
+
+    def control_concurrency(self, workers):
+        """ Adjust the number of active workers until all workers exit
+
+        Args:
+        workers - A list of worker processes
+        """
+        disk_io = psutil.disk_io_counters(perdisk=True)
+        net_io = psutil.net_io_counters()
+        last_check = time.time()
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(float(CONCURRENCY_INTERVAL) / len(workers))
+            if (not self.worker_lost.is_set() and
+                    any(worker.exitcode not in (None, 0) for worker in workers)):
+                log.error('A worker died, remaining workers will stop once '
+                          'their current tables are done')
+                self.worker_lost.set()
+
+            now = time.time()
+            if now - last_check < CONCURRENCY_INTERVAL:
+                continue
+            prev_disk_io = disk_io
+            prev_net_io = net_io
+            disk_io = psutil.disk_io_counters(perdisk=True)
+            net_io = psutil.net_io_counters()
+            elapsed = now - last_check
+            last_check = now
+
+            disk_util = 0
+            for disk in disk_io:
+                if disk in prev_disk_io and hasattr(disk_io[disk], 'busy_time'):
+                    busy = disk_io[disk].busy_time - prev_disk_io[disk].busy_time
+                    disk_util = max(disk_util, busy / 1000.0 / elapsed)
+            nic_util = ((net_io.bytes_sent - prev_net_io.bytes_sent) /
+                        elapsed / NIC_BANDWIDTH_BYTES)
+            heartbeat = mysql_lib.get_heartbeat(self.instance)
+            if heartbeat:
+                lag = (datetime.datetime.utcnow() - heartbeat).total_seconds()
+            else:
+                lag = LAG_BACKOFF_SECONDS
+
+            # Once past the expected completion time, finishing matters more
+            # than being gentle with IO, replica freshness still wins.
+            past_completion = (datetime.datetime.utcnow().time() >
+                               mysql_backup_status.CSV_COMPLETION_TIME)
+            backoff = lag > LAG_BACKOFF_SECONDS
+            ramp = lag < LAG_RAMP_SECONDS
+            if not past_completion:
+                backoff = (backoff or disk_util > DISK_UTIL_BACKOFF or
+                           nic_util > NIC_UTIL_BACKOFF)
+                ramp = (ramp and disk_util < DISK_UTIL_RAMP and
+                        nic_util < NIC_UTIL_RAMP)
+
+            with self.active_workers.get_lock():
+                active = self.active_workers.value
+                if backoff and active > 1:
+                    active -= 1
+                elif (ramp and not backoff and
+                      active < sum(worker.is_alive() for worker in workers)):
+                    active += 1
+                self.active_workers.value = active
+            log.info('Concurrency: {active} of {workers} workers active, '
+                     'lag {lag:.0f}s, disk {disk:.0%}, nic {nic:.0%}'
+                     ''.format(active=active,
+                               workers=len(workers),
+                               lag=lag,
+                               disk=disk_util,
+                               nic=nic_util))
+
+    def wait_for_turn(self):
+        """ Wait until fewer than the allowed number of workers are working,
+            then take a turn. end_turn must be called once the turn is done.
+
+        Returns:
+        True if the worker may proceed, False if there is no work left
+        """
+        while True:
+            if not self.units_remaining.value or self.worker_lost.is_set():
+                return False
+            with self.active_workers.get_lock():
+                if self.working_workers.value < self.active_workers.value:
+                    self.working_workers.value += 1
+                    return True
+            time.sleep(1)
+
+    def end_turn(self):
+        """ Give up a turn taken by wait_for_turn """
+        with self.active_workers.get_lock():
+            self.working_workers.value -= 1
+
+    def mysql_backup_csv_tables(self):
+        """ Worker for backing up a queue of tables, one table per turn """
         proc_id = multiprocessing.current_process().name
+        # Each worker process gets its own lock manager and master connection
+        self.lock_manager = BackupLockManager(self.instance)
+        # S3 and MySQL sessions for metadata, reused across tables
+        self.s3_sessions = threading.local()
+        self.schema_conn = None
+        self.schemas = dict()
+        self.upload_pool = multiprocessing.pool.ThreadPool(SMALL_UPLOAD_THREADS)
         conn = mysql_lib.connect_mysql(self.instance, backup.USER_ROLE_MYSQLDUMP)
         mysql_lib.start_consistent_snapshot(conn, read_only=True)
         pitr_data = mysql_lib.get_pitr_data(self.instance)
+        if not self.signal_snapshot_taken():
+            log.error('{proc_id}: Snapshot was taken after replication was '
+                      'restarted, exiting'.format(proc_id=proc_id))
+            return
         err_count = 0
-        while not self.dbs_to_backup.empty():
-            db = self.dbs_to_backup.get()
-            try:
-                self.mysql_backup_csv_db(db, conn, pitr_data)
-            except:
-                self.dbs_to_backup.put(db)
-                log.error('{proc_id}: Could not dump {db}, '
-                          'error: {e}'.format(db=db,
-                                              e=traceback.format_exc(),
-                                              proc_id=proc_id))
-                err_count = err_count + 1
-                if err_count > MAX_THREAD_ERROR:
-                    log.error('{proc_id}: Error count in thread > MAX_THREAD_ERROR. '
-                              'Aborting :('.format(proc_id=proc_id))
-                    return
-
-    def mysql_backup_csv_db(self, db, conn, pitr_data):
-        """ Back up a single db
+        try:
+            while self.wait_for_turn():
+                try:
+                    (db, table, chunk) = self.tables_to_backup.get(timeout=QUEUE_GET_TIMEOUT)
+                except Queue.Empty:
+                    # Units may still be in flight in other workers, and be
+                    # put back if they fail
+                    self.end_turn()
+                    continue
+
+                try:
+                    self.mysql_backup_csv_table_wrapper(db, table, chunk,
+                                                        conn, pitr_data)
+                    with self.units_remaining.get_lock():
+                        self.units_remaining.value -= 1
+                except:
+                    self.tables_to_backup.put((db, table, chunk))
+                    log.error('{proc_id}: Could not dump {db}.{table}, '
+                              'error: {e}'.format(db=db,
+                                                  table=table,
+                                                  e=traceback.format_exc(),
+                                                  proc_id=proc_id))
+                    err_count = err_count + 1
+                    if err_count > MAX_THREAD_ERROR:
+                        log.error('{proc_id}: Error count in thread > MAX_THREAD_ERROR. '
+                                  'Aborting :('.format(proc_id=proc_id))
+                        return
+                finally:
+                    self.end_turn()
+        finally:
+            self.upload_pool.close()
+            self.upload_pool.join()
+            if self.schema_conn:
+                self.schema_conn.close()
+            self.lock_manager.stop_keeper()
+            self.lock_manager.close()
+
+    def mysql_backup_csv_table_wrapper(self, db, table, chunk,
+                                       conn, pitr_data):
+        """ Back up a single table, taking care of the db level backup lock
 
         Args:
         db - the db to be backed up
+        table - the table to be backed up
+        chunk - None to back up the entire table, otherwise a tuple of
+                part number, primary key column, lower and upper bound as
+                returned by get_table_chunks
         conn - a connection the the mysql instance
         pitr_data - data describing the position of the db data in replication
         """
         proc_id = multiprocessing.current_process().name
-        if not self.force_reupload and self.already_backed_up(db):
-            log.info('{proc_id}: {db} is already backed up, skipping'
+        if not self.force_reupload and self.already_backed_up(db, table):
+            log.info('{proc_id}: {db}.{table} is already backed up, skipping'
                      ''.format(proc_id=proc_id,
-                               db=db))
+                               db=db,
+                               table=table))
+            self.journal_done(db, table)
             return
 
-        # attempt to take lock by writing a lock to the master
-        tmp_dir_db = None
         lock_identifier = None
-        extend_lock_thread = None
         try:
-            self.release_expired_locks()
-            lock_identifier = self.take_backup_lock(db)
-            extend_lock_stop_event = threading.Event()
-            extend_lock_thread = threading.Thread(target=self.extend_backup_lock,
-                                                  args=(lock_identifier,
-                                                        extend_lock_stop_event))
-            extend_lock_thread.daemon = True
-            extend_lock_thread.start()
+            lock_identifier = self.acquire_db_lock(db, pitr_data)
             if not lock_identifier:
+                log.info('{proc_id}: {db} is being backed up by another '
+                         'host, skipping {db}.{table}'
+                         ''.format(proc_id=proc_id,
+                                   db=db,
+                                   table=table))
                 return
-
-            log.info('{proc_id}: {db} db backup start'
-                     ''.format(db=db,
-                               proc_id=proc_id))
+            self.lock_manager.hold(lock_identifier)
 
             tmp_dir_db = os.path.join(self.dump_base_path, db)
             if not os.path.exists(tmp_dir_db):
-                os.makedirs(tmp_dir_db)
-            host_utils.change_owner(tmp_dir_db, 'mysql', 'mysql')
+                try:
+                    os.makedirs(tmp_dir_db)
+                except OSError:
+                    # Another worker may have created it in the meantime
+                    if not os.path.isdir(tmp_dir_db):
+                        raise
+                host_utils.change_owner(tmp_dir_db, 'mysql', 'mysql')
+
+            delta = None
+            if table in self.delta_tables.get(db, {}):
+                delta = self.get_delta_range(db, table, conn)
+
+            self.mysql_backup_csv_table(db, table, tmp_dir_db, conn, chunk,
+                                        delta)
+            if delta:
+                self.record_delta(db, table, delta)
+            if chunk:
+                self.journal_done(db, table, chunk[0])
+                self.chunk_complete(db, table)
+            else:
+                self.journal_done(db, table)
+        finally:
+            if lock_identifier:
+                self.lock_manager.unhold(lock_identifier)
+                self.release_db_lock(db)
 
-            self.upload_pitr_data(db, pitr_data)
+    def acquire_db_lock(self, db, pitr_data):
+        """ Take a reference on the backup lock of a db, taking the lock on
+            the master if no other worker holds it. Only the bookkeeping is
+            done under db_locks_mutex, workers wanting a db whose lock is
+            being taken or released wait for that to finish.
 
-            for table in self.get_tables_to_backup(db):
-                self.mysql_backup_csv_table(db, table, tmp_dir_db, conn)
+        Args:
+        db - the db to be backed up
+        pitr_data - data describing the position of the db data in replication
 
-            log.info('{proc_id}: {db} db backup complete'
-                     ''.format(db=db,
-                               proc_id=proc_id))
-        finally:
-            if extend_lock_thread:
-                extend_lock_stop_event.set()
-                log.debug('{proc_id}: {db} waiting for lock expiry thread to'
-                          'end'.format(db=db,
-                                       proc_id=proc_id))
-                extend_lock_thread.join()
+        Returns:
+        a uuid lock identifier, or None if the db is locked by another host
+        """
+        proc_id = multiprocessing.current_process().name
+        while True:
+            with self.db_locks_mutex:
+                if db in self.foreign_dbs:
+                    return None
+                if db not in self.db_locks:
+                    self.db_locks[db] = (None, 0)
+                    break
+                (lock_identifier, in_flight) = self.db_locks[db]
+                if lock_identifier:
+                    self.db_locks[db] = (lock_identifier, in_flight + 1)
+                    return lock_identifier
+            time.sleep(DB_LOCK_WAIT)
+
+        lock_identifier = None
+        try:
+            self.lock_manager.release_expired()
+            lock_identifier = self.lock_manager.take(db)
             if lock_identifier:
-                log.debug('{proc_id}: {db} releasing lock'
-                          ''.format(db=db,
-                                    proc_id=proc_id))
-                self.release_db_backup_lock(lock_identifier)
+                log.info('{proc_id}: {db} db backup lock taken'
+                         ''.format(db=db,
+                                   proc_id=proc_id))
+                if db not in self.pitr_uploaded:
+                    self.upload_pitr_data(db, pitr_data)
+                    self.pitr_uploaded[db] = True
+        except:
+            if lock_identifier:
+                self.lock_manager.release([lock_identifier])
+            with self.db_locks_mutex:
+                del self.db_locks[db]
+            raise
+
+        with self.db_locks_mutex:
+            if lock_identifier:
+                self.db_locks[db] = (lock_identifier, 1)
+            else:
+                del self.db_locks[db]
+                self.foreign_dbs[db] = True
+        return lock_identifier
+
+    def release_db_lock(self, db):
+        """ Drop a reference on the backup lock of a db, releasing the lock on
+            the master when no tables of the db remain in flight.
 
-    def mysql_backup_csv_table(self, db, table, tmp_dir_db, conn):
+        Args:
+        db - the db that was backed up
+        """
+        proc_id = multiprocessing.current_process().name
+        with self.db_locks_mutex:
+            (lock_identifier, in_flight) = self.db_locks[db]
+            if in_flight > 1:
+                self.db_locks[db] = (lock_identifier, in_flight - 1)
+                return
+            self.db_locks[db] = (None, 0)
+
+        try:
+            log.debug('{proc_id}: {db} releasing lock'
+                      ''.format(db=db,
+                                proc_id=proc_id))
+            self.lock_manager.release([lock_identifier])
+        finally:
+            with self.db_locks_mutex:
+                del self.db_locks[db]
+
+    def mysql_backup_csv_table(self, db, table, tmp_dir_db, conn, chunk=None,
+                               delta=None):
         """ Back up a single table of a single db
 
         Args:
@@ -257,19 +753,65 @@ class mysql_backup_csv:
         table - the table to be backed up
         tmp_dir_db - temporary storage used for all tables in the db
         conn - a connection the the mysql instance
+        chunk - (optional) a tuple describing a primary key range of the
+                table to back up, as returned by get_table_chunks
+        delta - (optional) a dict describing the watermark range of the
+                table to back up, as returned by get_delta_range
         """
         proc_id = multiprocessing.current_process().name
-        (_, data_path, _) = environment_specific.get_csv_backup_paths(
-                                self.datestamp, db, table,
-                                self.instance.replica_type,
-                                self.instance.get_zk_replica_set()[0])
+        if chunk:
+            data_path = self.get_part_path(db, table, chunk[0])
+            fifo = os.path.join(tmp_dir_db,
+                                '{table}.{part}'.format(table=table,
+                                                        part=chunk[0]))
+        else:
+            data_path = self.get_data_path(db, table)
+            fifo = os.path.join(tmp_dir_db, table)
         log.debug('{proc_id}: {db}.{table} dump to {path} started'
                   ''.format(proc_id=proc_id,
                             db=db,
                             table=table,
                             path=data_path))
-        self.upload_schema(db, table, tmp_dir_db)
-        fifo = os.path.join(tmp_dir_db, table)
+        schema_upload = None
+        if not chunk or chunk[0] == 0:
+            (schema_path, schema_upload) = self.upload_schema(db, table)
+        start = time.time()
+        if self.output_format == OUTPUT_FORMAT_PARQUET:
+            stats = self.mysql_backup_parquet_table(db, table, tmp_dir_db,
+                                                    data_path, conn, chunk,
+                                                    delta)
+        elif lzop.available():
+            stats = self.mysql_backup_csv_table_in_process(db, table, fifo,
+                                                           data_path, conn,
+                                                           chunk, delta)
+        else:
+            stats = self.mysql_backup_csv_table_forked(db, table, fifo,
+                                                       data_path, conn,
+                                                       chunk, delta)
+        self.record_ledger(db, table, data_path, stats, time.time() - start)
+        # The table is not done until its schema is uploaded, this will
+        # raise if the upload failed
+        if schema_upload:
+            self.record_ledger(db, table, schema_path, schema_upload.get(),
+                               None)
+
+    def mysql_backup_csv_table_forked(self, db, table, fifo, data_path,
+                                      conn, chunk, delta):
+        """ Back up a single table through forked cat, nullescape and lzop
+            processes
+
+        Args:
+        db - the db to be backed up
+        table - the table to be backed up
+        fifo - The path to the fifo to dump the table into
+        data_path - The s3 key to upload to
+        conn - a connection the the mysql instance
+        chunk - a tuple describing a primary key range of the table to back
+                up, or None for the entire table
+        delta - a dict describing the watermark range of the table to back
+                up, or None for the entire table
+        """
+        proc_id = multiprocessing.current_process().name
         procs = dict()
         try:
             # giant try so we can try to clean things up in case of errors
@@ -289,7 +831,8 @@ class mysql_backup_csv:
             return_value = set()
             query_thread = threading.Thread(target=self.run_dump_query,
                                             args=(db, table, fifo,
-                                                  conn, procs['cat'], return_value))
+                                                  conn, procs['cat'], return_value,
+                                                  chunk, delta))
             query_thread.daemon = True
             query_thread.start()
 
@@ -305,6 +848,11 @@ class mysql_backup_csv:
                       ''.format(proc_id=proc_id,
                                 db=db,
                                 table=table))
+            # The data goes straight from lzop to the uploader, so its size
+            # and checksum are not known
+            return {'bytes': None,
+                    'rows': self.get_dump_rows(return_value),
+                    'checksum': None}
         except:
             log.debug('{proc_id}: in exception handling for failed table upload'
                       ''.format(proc_id=proc_id))
@@ -315,6 +863,187 @@ class mysql_backup_csv:
             safe_uploader.kill_precursor_procs(procs)
             raise
 
+    def mysql_backup_csv_table_in_process(self, db, table, fifo, data_path,
+                                          conn, chunk, delta):
+        """ Back up a single table, reading the fifo and doing the null
+            escape and lzop compression in this process rather than forking
+            cat, nullescape and lzop
+
+        Args:
+        db - the db to be backed up
+        table - the table to be backed up
+        fifo - The path to the fifo to dump the table into
+        data_path - The s3 key to upload to
+        conn - a connection the the mysql instance
+        chunk - a tuple describing a primary key range of the table to back
+                up, or None for the entire table
+        delta - a dict describing the watermark range of the table to back
+                up, or None for the entire table
+        """
+        proc_id = multiprocessing.current_process().name
+        try:
+            self.create_fifo(fifo)
+            return_value = set()
+            query_thread = threading.Thread(target=self.run_dump_query,
+                                            args=(db, table, fifo,
+                                                  conn, None, return_value,
+                                                  chunk, delta))
+            query_thread.daemon = True
+            query_thread.start()
+
+            stats = dict()
+            safe_uploader.safe_stream_upload(
+                stream=self.measure_stream(self.stream_fifo(fifo, query_thread),
+                                           stats),
+                bucket=self.upload_bucket,
+                key=data_path,
+                check_func=self.check_dump_success,
+                check_arg=return_value)
+            os.remove(fifo)
+            log.debug('{proc_id}: {db}.{table} clean up complete'
+                      ''.format(proc_id=proc_id,
+                                db=db,
+                                table=table))
+            stats['rows'] = self.get_dump_rows(return_value)
+            return stats
+        except:
+            log.debug('{proc_id}: in exception handling for failed table upload'
+                      ''.format(proc_id=proc_id))
+
+            if os.path.exists(fifo):
+                self.cleanup_fifo(fifo)
+            raise
+
+    def mysql_backup_parquet_table(self, db, table, tmp_dir_db, data_path,
+                                   conn, chunk, delta):
+        """ Back up a single table as a Parquet file. The rows are read over
+            the worker's connection, so the export comes from the same
+            snapshot as a csv export would, and written to a local file
+            since Parquet puts its metadata in a footer.
+
+        Args:
+        db - the db to be backed up
+        table - the table to be backed up
+        tmp_dir_db - temporary storage used for all tables in the db
+        data_path - The s3 key to upload to
+        conn - a connection the the mysql instance
+        chunk - a tuple describing a primary key range of the table to back
+                up, or None for the entire table
+        delta - a dict describing the watermark range of the table to back
+                up, or None for the entire table
+        """
+        proc_id = multiprocessing.current_process().name
+        local_path = os.path.join(tmp_dir_db,
+                                  os.path.basename(data_path))
+        columns = mysql_lib.get_table_columns(self.instance, db, table)
+        sql = ("SELECT {columns} "
+               "FROM {db}.{table} "
+               "").format(columns=', '.join('`{column}`'.format(column=column['COLUMN_NAME'])
+                                            for column in columns),
+                          db=db,
+                          table=table)
+        (where, params) = self.get_dump_conditions(chunk, delta)
+        try:
+            rows = parquet_writer.write_query(conn, sql + where, params,
+                                              columns, local_path)
+            log.debug('{proc_id}: {db}.{table} wrote {rows} rows to {path}'
+                      ''.format(proc_id=proc_id,
+                                db=db,
+                                table=table,
+                                rows=rows,
+                                path=local_path))
+            stats = {'rows': rows}
+            safe_uploader.safe_stream_upload(
+                stream=self.measure_stream(self.stream_file(local_path), stats),
+                bucket=self.upload_bucket,
+                key=data_path)
+            return stats
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+
+    def measure_stream(self, stream, stats):
+        """ Pass through a stream of data, measuring its size and checksum
+
+        Args:
+        stream - An iterable of strings
+        stats - A dict which bytes and checksum (hex md5) are set in once the
+                stream is exhausted
+
+        Yields:
+        The strings of stream
+        """
+        size = 0
+        checksum = hashlib.md5()
+        for data in stream:
+            size += len(data)
+            checksum.update(data)
+            yield data
+        stats['bytes'] = size
+        stats['checksum'] = checksum.hexdigest()
+
+    def stream_file(self, path):
+        """ Read a local file in blocks
+
+        Args:
+        path - The path to the file
+
+        Yields:
+        Strings of data
+        """
+        with open(path, 'rb') as handle:
+            while True:
+                data = handle.read(UPLOAD_READ_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def stream_fifo(self, fifo, query_thread):
+        """ Read a fifo, null escape and lzop compress the data
+
+        Args:
+        fifo - The path to the fifo
+        query_thread - The thread running the dump query, which will be
+                       waited on once the fifo has been drained
+
+        Yields:
+        Strings of lzop compressed data
+        """
+        escaper = nullescape.NullEscaper()
+        compressor = lzop.LzopCompressor()
+        yield compressor.header()
+        with open(fifo, 'rb') as handle:
+            while True:
+                data = handle.read(PIPELINE_READ_SIZE)
+                if not data:
+                    break
+                compressed = compressor.compress(escaper.transform(data))
+                if compressed:
+                    yield compressed
+        yield compressor.compress(escaper.flush()) + compressor.flush()
+        # EOF on the fifo happens just before the query returns, make sure
+        # the query's status is known before it is checked
+        query_thread.join()
+
+    def unblock_fifo_reader(self, fifo):
+        """ If a dump query fails before opening the fifo, the reader will
+            block forever waiting for a writer. Open and close the fifo so
+            the reader sees an EOF.
+
+        Args:
+        fifo - The path to the fifo
+        """
+        timeout = time.time() + FIFO_UNBLOCK_TIMEOUT
+        while time.time() < timeout:
+            try:
+                handle = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                # No reader yet
+                time.sleep(.1)
+                continue
+            os.close(handle)
+            return
+
     def create_fifo(self, fifo):
         """ Create a fifo to be used for dumping a mysql table
 
@@ -329,7 +1058,7 @@ class mysql_backup_csv:
                             fifo=fifo))
         os.mkfifo(fifo)
         # Could not get os.mkfifo(fifo, 0777) to work due to umask
-        host_utils.change_owner(fifo, 'mysql', 'mysql')
+        host_utils.change_file_owner(fifo, 'mysql', 'mysql')
 
     def cleanup_fifo(self, fifo):
         """ Safely cleanup a fifo that is an unknown state
@@ -348,7 +1077,8 @@ class mysql_backup_csv:
                   ''.format(proc_id=multiprocessing.current_process().name,
                             fifo=fifo))
 
-    def run_dump_query(self, db, table, fifo, conn, cat_proc, return_value):
+    def run_dump_query(self, db, table, fifo, conn, cat_proc, return_value,
+                       chunk=None, delta=None):
         """ Run a SELECT INTO OUTFILE into a fifo
 
         Args:
@@ -356,11 +1086,16 @@ class mysql_backup_csv:
         table - The table of the db to dump
         fifo - The fifo to dump the table.db into
         conn - The connection to MySQL
-        cat_proc - The process reading from the fifo
+        cat_proc - The process reading from the fifo, or None if the fifo is
+                   read in process
         return_value - A set to be used to populated the return status. This is
                        a semi-ugly hack that is required because of the use of
                        threads not being able to return data, however being
                        able to modify objects (like a set).
+        chunk - (optional) a tuple describing a primary key range of the
+                table to dump, as returned by get_table_chunks
+        delta - (optional) a dict describing the watermark range of the
+                table to dump, as returned by get_delta_range
         """
         log.debug('{proc_id}: {db}.{table} dump started'
                   ''.format(proc_id=multiprocessing.current_process().name,
@@ -372,24 +1107,82 @@ class mysql_backup_csv:
                "").format(fifo=fifo,
                           db=db,
                           table=table)
+        (where, params) = self.get_dump_conditions(chunk, delta)
+        sql = sql + where
         cursor = conn.cursor()
         try:
-            cursor.execute(sql)
+            cursor.execute(sql, params)
         except Exception as detail:
             # if we have not output any data, then the cat proc will never
             # receive an EOF, so we will be stuck
-            if psutil.pid_exists(cat_proc.pid):
+            if cat_proc is None:
+                self.unblock_fifo_reader(fifo)
+            elif psutil.pid_exists(cat_proc.pid):
                 cat_proc.kill()
             log.error('{proc_id}: dump query encountered an error: {er}'
                       ''.format(er=detail,
                                 proc_id=multiprocessing.current_process().name))
+            return
 
         log.debug('{proc_id}: {db}.{table} dump complete'
                   ''.format(proc_id=multiprocessing.current_process().name,
                             db=db,
                             table=table))
+        # For SELECT INTO OUTFILE the row count is the number of rows written
+        return_value.add((ROWS_ENTRY, cursor.rowcount))
         return_value.add(SUCCESS_ENTRY)
 
+    def get_dump_rows(self, return_value):
+        """ Get the number of rows a dump query wrote
+
+        Args:
+        return_value - The set populated by run_dump_query
+
+        Returns:
+        The number of rows, or None if not known
+        """
+        for entry in return_value:
+            if isinstance(entry, tuple) and entry[0] == ROWS_ENTRY:
+                return entry[1]
+        return None
+
+    def get_dump_conditions(self, chunk, delta):
+        """ Build the WHERE clause restricting a dump to a chunk and/or delta
+
+        Args:
+        chunk - a tuple describing a primary key range of the table, as
+                returned by get_table_chunks, or None
+        delta - a dict describing the watermark range of the table, as
+                returned by get_delta_range, or None
+
+        Returns:
+        A tuple of a WHERE clause (possibly empty) and a dict of parameters
+        for it (None if there are no parameters)
+        """
+        params = None
+        conditions = list()
+        if chunk:
+            params = dict()
+            (_, column, lower, upper) = chunk
+            if lower is not None:
+                conditions.append('`{column}` >= %(lower)s'.format(column=column))
+                params['lower'] = lower
+            if upper is not None:
+                conditions.append('`{column}` < %(upper)s'.format(column=column))
+                params['upper'] = upper
+        if delta and delta['upper'] is not None:
+            params = params or dict()
+            if delta['lower'] is not None:
+                conditions.append('`{column}` > %(delta_lower)s'
+                                  ''.format(column=delta['column']))
+                params['delta_lower'] = delta['lower']
+            conditions.append('`{column}` <= %(delta_upper)s'
+                              ''.format(column=delta['column']))
+            params['delta_upper'] = delta['upper']
+        if not conditions:
+            return ('', params)
+        return ('WHERE ' + ' AND '.join(conditions), params)
+
     def check_dump_success(self, return_value):
         """ Check to see if a dump query succeeded
 
@@ -401,6 +1194,377 @@ class mysql_backup_csv:
             raise Exception('{proc_id}: dump failed'
                             ''.format(proc_id=multiprocessing.current_process().name))
 
+    def get_table_chunks(self, db, table, size):
+        """ Split a table into primary key ranges which can be exported
+            concurrently
+
+        Args:
+        db - the db of the table
+        table - the table to be split
+        size - the data length of the table in bytes
+
+        Returns:
+        A list of tuples of part number, primary key column, lower bound
+        (inclusive) and upper bound (exclusive). The first and last ranges
+        are open ended, so the parts cover the whole table in any snapshot
+        even though the bounds are read outside of one. Parts only line up
+        with parts of the same plan, so a part is only ever skipped if the
+        journal of the plan records it as done. None is returned if the
+        table should not be split.
+        """
+        if size <= CHUNK_SIZE:
+            return None
+
+        column = mysql_lib.get_integer_primary_key(self.instance, db, table)
+        if not column:
+            log.info('{db}.{table} does not have a single integer primary '
+                     'key, it will not be split'.format(db=db,
+                                                        table=table))
+            return None
+
+        conn = mysql_lib.connect_mysql(self.instance)
+        cursor = conn.cursor()
+        sql = ("SELECT MIN(`{column}`) AS min_id, MAX(`{column}`) AS max_id "
+               "FROM {db}.{table}").format(column=column,
+                                            db=db,
+                                            table=table)
+        cursor.execute(sql)
+        row = cursor.fetchone()
+        if row['min_id'] is None:
+            return None
+
+        num_chunks = min(MAX_CHUNKS, -(-size // CHUNK_SIZE))
+        step = max(1, (row['max_id'] - row['min_id']) // num_chunks)
+        boundaries = [row['min_id'] + step * i for i in range(1, num_chunks)
+                      if row['min_id'] + step * i <= row['max_id']]
+        lowers = [None] + boundaries
+        uppers = boundaries + [None]
+        chunks = [(part, column, lowers[part], uppers[part])
+                  for part in range(len(lowers))]
+        log.info('{db}.{table} will be exported in {cnt} parts on {column}'
+                 ''.format(db=db,
+                           table=table,
+                           cnt=len(chunks),
+                           column=column))
+        return chunks
+
+    def get_delta_range(self, db, table, conn):
+        """ Determine the range of a delta table to export
+
+        Args:
+        db - the db of the table
+        table - the table
+        conn - a connection inside the worker's consistent snapshot, so that
+               the upper bound matches the data that will be exported
+
+        Returns:
+        A dict with keys column, lower (exclusive, None for a full export,
+        otherwise the previous watermark less an overlap), upper (inclusive,
+        None if the table is empty), full (bool), and previous_watermark and
+        previous_full_export (the state the range was computed from, None if
+        there was none)
+        """
+        column = self.delta_tables[db][table]
+        sql = ('SELECT watermark_column, watermark, backup_date, '
+               '       last_full_export, previous_watermark, '
+               '       previous_full_export '
+               'FROM {db}.{tbl} '
+               'WHERE db = %(db)s AND '
+               '      tbl = %(tbl)s'
+               '').format(db=mysql_lib.METADATA_DB,
+                          tbl=CSV_WATERMARK_TABLE_NAME)
+        rows = self.lock_manager.execute(sql, {'db': db, 'tbl': table})
+
+        ret = {'column': column,
+               'lower': None,
+               'full': True,
+               'previous_watermark': None,
+               'previous_full_export': None}
+        backup_date = datetime.datetime.strptime(self.datestamp, '%Y-%m-%d').date()
+        if rows and rows[0]['watermark_column'] == column:
+            if rows[0]['backup_date'] == backup_date:
+                # A rerun, ie --force_reupload or resuming from the journal,
+                # must not start from the watermark this date already moved
+                ret['previous_watermark'] = rows[0]['previous_watermark']
+                ret['previous_full_export'] = rows[0]['previous_full_export']
+            else:
+                ret['previous_watermark'] = rows[0]['watermark']
+                ret['previous_full_export'] = rows[0]['last_full_export']
+
+        cursor = conn.cursor()
+        if (ret['previous_watermark'] is not None and
+                (backup_date - ret['previous_full_export']).days < DELTA_FULL_EXPORT_DAYS):
+            ret['lower'] = self.get_delta_lower(db, table, column,
+                                                ret['previous_watermark'],
+                                                cursor)
+            ret['full'] = False
+
+        cursor.execute('SELECT MAX(`{column}`) AS upper FROM {db}.{table}'
+                       ''.format(column=column,
+                                 db=db,
+                                 table=table))
+        upper = cursor.fetchone()['upper']
+        ret['upper'] = str(upper) if upper is not None else None
+        if ret['upper'] is None:
+            ret['lower'] = None
+            ret['full'] = True
+        log.info('{db}.{table} {kind} export on {column}, after {lower} up to '
+                 '{upper}'.format(db=db,
+                                  table=table,
+                                  kind='full' if ret['full'] else 'delta',
+                                  column=column,
+                                  lower=ret['lower'],
+                                  upper=ret['upper']))
+        return ret
+
+    def get_delta_lower(self, db, table, column, watermark, cursor):
+        """ Hold the lower bound of a delta export back from the previous
+            watermark, to pick up rows which became visible below it after
+            it was read
+
+        Args:
+        db - the db of the table
+        table - the table
+        column - the watermark column
+        watermark - the previous watermark
+        cursor - a cursor on the worker's connection
+
+        Returns:
+        The exclusive lower bound of the export
+        """
+        cursor.execute('SELECT DATA_TYPE '
+                       'FROM information_schema.columns '
+                       'WHERE TABLE_SCHEMA = %(db)s AND '
+                       '      TABLE_NAME = %(tbl)s AND '
+                       '      COLUMN_NAME = %(column)s',
+                       {'db': db, 'tbl': table, 'column': column})
+        data_type = cursor.fetchone()['DATA_TYPE']
+        if data_type in DELTA_INTEGER_TYPES:
+            sql = ('SELECT CAST(%(watermark)s AS SIGNED) - {ids} AS lower'
+                   ''.format(ids=DELTA_OVERLAP_IDS))
+        elif data_type in DELTA_TEMPORAL_TYPES:
+            sql = ('SELECT CAST(%(watermark)s AS DATETIME(6)) - '
+                   'INTERVAL {seconds} SECOND AS lower'
+                   ''.format(seconds=DELTA_OVERLAP_SECONDS))
+        else:
+            log.warning('{db}.{table}: No delta overlap for {column} of type '
+                        '{data_type}'.format(db=db,
+                                             table=table,
+                                             column=column,
+                                             data_type=data_type))
+            return watermark
+        cursor.execute(sql, {'watermark': watermark})
+        return str(cursor.fetchone()['lower'])
+
+    def record_delta(self, db, table, delta):
+        """ After a delta table has been uploaded, describe the export next to
+            the pitr data and move the watermark forward
+
+        Args:
+        db - the db of the table
+        table - the table
+        delta - a dict as returned by get_delta_range
+        """
+        s3_path = PATH_DELTA_DATA.format(replica_set=self.instance.get_zk_replica_set()[0],
+                                         db_name=db,
+                                         table=table,
+                                         date=self.datestamp)
+        self.upload_string(s3_path, json.dumps({'column': delta['column'],
+                                                'after': delta['lower'],
+                                                'up_to': delta['upper'],
+                                                'full': delta['full']}))
+        if delta['upper'] is None:
+            return
+
+        if delta['full']:
+            last_full_export = self.datestamp
+        else:
+            last_full_export = delta['previous_full_export']
+        sql = ('REPLACE INTO {db}.{tbl} '
+               'SET db = %(db)s, '
+               '    tbl = %(tbl)s, '
+               '    watermark_column = %(column)s, '
+               '    watermark = %(watermark)s, '
+               '    backup_date = %(backup_date)s, '
+               '    last_full_export = %(last_full_export)s, '
+               '    previous_watermark = %(previous_watermark)s, '
+               '    previous_full_export = %(previous_full_export)s, '
+               '    updated = NOW()'
+               '').format(db=mysql_lib.METADATA_DB,
+                          tbl=CSV_WATERMARK_TABLE_NAME)
+        self.lock_manager.execute(sql, {'db': db,
+                                        'tbl': table,
+                                        'column': delta['column'],
+                                        'watermark': delta['upper'],
+                                        'backup_date': self.datestamp,
+                                        'last_full_export': last_full_export,
+                                        'previous_watermark': delta['previous_watermark'],
+                                        'previous_full_export': delta['previous_full_export']})
+
+    def get_data_path(self, db, table):
+        """ Get the s3 path that a table is exported to
+
+        Args:
+        db - the db of the table
+        table - the table
+
+        Returns:
+        The data path from get_csv_backup_paths, with the extension replaced
+        when exporting parquet
+        """
+        (_, data_path, _) = environment_specific.get_csv_backup_paths(
+                                self.datestamp, db, table,
+                                self.instance.replica_type,
+                                self.instance.get_zk_replica_set()[0])
+        if self.output_format == OUTPUT_FORMAT_PARQUET:
+            data_path = os.path.splitext(data_path)[0] + PARQUET_EXTENSION
+        return data_path
+
+    def get_part_path(self, db, table, part):
+        """ Get the s3 path of a part of a chunked table export
+
+        Args:
+        db - the db of the table
+        table - the table
+        part - the part number
+
+        Returns:
+        The s3 path, alongside the data path of the table
+        """
+        (base, ext) = os.path.splitext(self.get_data_path(db, table))
+        return PART_PATH_FORMAT.format(base=base,
+                                       part=part,
+                                       ext=ext)
+
+    def chunk_complete(self, db, table):
+        """ Record that a part of a chunked table has been uploaded. Once all
+            parts are uploaded the first part is moved to the data path of
+            the table, so the presence of the data path continues to mean
+            that the whole table has been backed up.
+
+        Args:
+        db - the db of the table
+        table - the table
+        """
+        with self.db_locks_mutex:
+            remaining = self.chunks_remaining[(db, table)] - 1
+            self.chunks_remaining[(db, table)] = remaining
+        if not remaining:
+            self.finish_chunked_table(db, table)
+
+    def finish_chunked_table(self, db, table):
+        """ Move the first part of a chunked table to the data path of the
+            table once all parts are uploaded
+
+        Args:
+        db - the db of the table
+        table - the table
+        """
+        data_path = self.get_data_path(db, table)
+        first_part = self.get_part_path(db, table, 0)
+        log.info('{proc_id}: All parts of {db}.{table} uploaded, moving '
+                 '{first_part} to {data_path}'
+                 ''.format(proc_id=multiprocessing.current_process().name,
+                           db=db,
+                           table=table,
+                           first_part=first_part,
+                           data_path=data_path))
+        boto_conn = boto.connect_s3()
+        bucket = boto_conn.get_bucket(self.upload_bucket, validate=False)
+        bucket.copy_key(data_path, self.upload_bucket, first_part)
+        bucket.delete_key(first_part)
+        # The ledger follows the key
+        params = {'data_path': data_path,
+                  'backup_date': self.datestamp,
+                  'bucket': self.upload_bucket,
+                  'first_part': first_part}
+        sql = ('REPLACE INTO {db}.{tbl} '
+               '(backup_date, bucket, s3_key, db, tbl, bytes, row_count, '
+               ' duration, checksum, uploaded) '
+               'SELECT backup_date, bucket, %(data_path)s, db, tbl, bytes, '
+               '       row_count, duration, checksum, uploaded '
+               'FROM {db}.{tbl} '
+               'WHERE backup_date = %(backup_date)s AND '
+               '      bucket = %(bucket)s AND '
+               '      s3_key = %(first_part)s'
+               '').format(db=mysql_lib.METADATA_DB,
+                          tbl=CSV_LEDGER_TABLE_NAME)
+        self.lock_manager.execute(sql, params)
+        sql = ('DELETE FROM {db}.{tbl} '
+               'WHERE backup_date = %(backup_date)s AND '
+               '      bucket = %(bucket)s AND '
+               '      s3_key = %(first_part)s'
+               '').format(db=mysql_lib.METADATA_DB,
+                          tbl=CSV_LEDGER_TABLE_NAME)
+        self.lock_manager.execute(sql, params)
+        self.journal_done(db, table)
+
+    def load_journal(self):
+        """ Load the journal of a previous run for the same datestamp, and
+            remove journals of other datestamps
+
+        Returns:
+        A tuple of whether a journal was found, a set of (db, table, part)
+        which are complete, with part None for a whole table, and a dict of
+        (db, table) to the chunks the table was split into.
+        """
+        self.journal_path = os.path.join(self.dump_base_path,
+                                         JOURNAL_FILE_PREFIX + self.datestamp)
+        for entry in os.listdir(self.dump_base_path):
+            path = os.path.join(self.dump_base_path, entry)
+            if entry.startswith(JOURNAL_FILE_PREFIX) and path != self.journal_path:
+                log.info('Removing old journal {path}'.format(path=path))
+                os.remove(path)
+
+        done = set()
+        chunk_plans = dict()
+        if self.force_reupload:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            return (False, done, chunk_plans)
+
+        if not os.path.exists(self.journal_path):
+            return (False, done, chunk_plans)
+
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partial line from a crash while writing
+                    continue
+                if entry['type'] == JOURNAL_CHUNKS:
+                    chunk_plans[(entry['db'], entry['table'])] = \
+                        [tuple(chunk) for chunk in entry['chunks']]
+                elif entry['type'] == JOURNAL_DONE:
+                    done.add((entry['db'], entry['table'], entry['part']))
+        return (True, done, chunk_plans)
+
+    def journal(self, entry):
+        """ Append an entry to the journal
+
+        Args:
+        entry - A dict which will be written as a line of json
+        """
+        with self.journal_lock:
+            with open(self.journal_path, 'a') as journal:
+                journal.write(json.dumps(entry) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def journal_done(self, db, table, part=None):
+        """ Record in the journal that a table or a part of a table is done
+
+        Args:
+        db - the db of the table
+        table - the table
+        part - (optional) the part number of a chunked table
+        """
+        self.journal({'type': JOURNAL_DONE,
+                      'db': db,
+                      'table': table,
+                      'part': part})
+
     def upload_pitr_data(self, db, pitr_data):
         """ Upload a file of PITR data to s3 for each schema
 
@@ -416,52 +1580,345 @@ class mysql_backup_csv:
                   ''.format(s3_path=s3_path,
                             proc_id=multiprocessing.current_process().name,
                             db=db))
-        boto_conn = boto.connect_s3()
-        bucket = boto_conn.get_bucket(self.upload_bucket, validate=False)
-        key = bucket.new_key(s3_path)
-        key.set_contents_from_string(json.dumps(pitr_data))
+        self.upload_string(s3_path, json.dumps(pitr_data))
 
-    def upload_schema(self, db, table, tmp_dir_db):
-        """ Upload the schema of a table to s3
+    def upload_schema(self, db, table):
+        """ Start an upload of the schema of a table to s3
 
         Args:
         db - the db to be backed up
         table - the table to be backed up
-        tmp_dir_db - temporary storage used for all tables in the db
+
+        Returns:
+        A tuple of the s3 path of the schema and an AsyncResult for the
+        upload. get() returns the stats of the upload, or raises if it failed
         """
         (schema_path, _, _) = environment_specific.get_csv_backup_paths(
                                      self.datestamp, db, table,
                                      self.instance.replica_type,
                                      self.instance.get_zk_replica_set()[0])
-        create_stm = mysql_lib.show_create_table(self.instance, db, table)
+        create_stm = self.get_create_table(db, table)
         log.debug('{proc_id}: Uploading schema to {schema_path}'
                   ''.format(schema_path=schema_path,
                             proc_id=multiprocessing.current_process().name))
-        boto_conn = boto.connect_s3()
-        bucket = boto_conn.get_bucket(self.upload_bucket, validate=False)
-        key = bucket.new_key(schema_path)
-        key.set_contents_from_string(create_stm)
+        return (schema_path,
+                self.upload_pool.apply_async(self.upload_string,
+                                             (schema_path, create_stm)))
+
+    def get_create_table(self, db, table):
+        """ Get the CREATE TABLE statement of a table. The statements for
+            all tables of a db are fetched the first time any is needed.
+
+        Args:
+        db - the db of the table
+        table - the table
+
+        Returns:
+        A string of the CREATE TABLE statement
+        """
+        if db not in self.schemas:
+            if not self.schema_conn:
+                self.schema_conn = mysql_lib.connect_mysql(self.instance)
+            self.schemas[db] = mysql_lib.show_create_tables(self.instance, db,
+                                                            conn=self.schema_conn)
+        if table not in self.schemas[db]:
+            # Created since the db was read
+            self.schemas[db][table] = mysql_lib.show_create_table(self.instance,
+                                                                  db, table)
+        return self.schemas[db][table]
+
+    def get_bucket(self):
+        """ Get the upload bucket, with one boto connection per thread
+
+        Returns:
+        A boto bucket object
+        """
+        if not hasattr(self.s3_sessions, 'bucket'):
+            boto_conn = boto.connect_s3()
+            self.s3_sessions.bucket = boto_conn.get_bucket(self.upload_bucket,
+                                                           validate=False)
+        return self.s3_sessions.bucket
+
+    def upload_string(self, s3_path, data):
+        """ Upload a small object to s3
+
+        Args:
+        s3_path - The key to upload to
+        data - A string of the contents
+
+        Returns:
+        A dict of the bytes, rows (None) and checksum of the upload
+        """
+        key = self.get_bucket().new_key(s3_path)
+        key.set_contents_from_string(data)
+        return {'bytes': len(data),
+                'rows': None,
+                'checksum': hashlib.md5(data).hexdigest()}
+
+    def record_ledger(self, db, table, s3_path, stats, duration):
+        """ Record an uploaded key in the ledger on the master. Rows are
+            keyed by bucket so a dev bucket run can not stand in for a
+            production backup.
+
+        Args:
+        db - the db of the table
+        table - the table
+        s3_path - the key which was uploaded
+        stats - a dict of bytes, rows and checksum, any of which may be None
+        duration - seconds the export and upload took, or None
+        """
+        sql = ('REPLACE INTO {db}.{tbl} '
+               'SET backup_date = %(backup_date)s, '
+               '    bucket = %(bucket)s, '
+               '    s3_key = %(s3_key)s, '
+               '    db = %(db)s, '
+               '    tbl = %(tbl)s, '
+               '    bytes = %(bytes)s, '
+               '    row_count = %(rows)s, '
+               '    duration = %(duration)s, '
+               '    checksum = %(checksum)s, '
+               '    uploaded = NOW()'
+               '').format(db=mysql_lib.METADATA_DB,
+                          tbl=CSV_LEDGER_TABLE_NAME)
+        self.lock_manager.execute(sql, {'backup_date': self.datestamp,
+                                        'bucket': self.upload_bucket,
+                                        's3_key': s3_path,
+                                        'db': db,
+                                        'tbl': table,
+                                        'bytes': stats.get('bytes'),
+                                        'rows': stats.get('rows'),
+                                        'duration': duration,
+                                        'checksum': stats.get('checksum')})
+
+    def already_backed_up(self, db, table):
+        """ Check to see if a table had already been uploaded to s3 when the
+            run started
+
+        Args:
+        db - The db of the table
+        table - The table to check for being backed up
+
+        Returns:
+        bool - True if the table has already been backed up, False otherwise
+        """
+        return self.get_data_path(db, table) in self.existing_keys
+
+    def get_tables_to_backup(self, db):
+        """ Determine which tables should be backed up in a db
+
+        Args:
+        db -  The db for which we need a list of tables eligible for backup
+
+        Returns:
+        a set of table names
+        """
+        tables = environment_specific.filter_tables_to_csv_backup(
+                     self.instance, db,
+                     mysql_lib.get_tables(self.instance, db, skip_views=True))
+        if not self.force_table:
+            return tables
+
+        if self.force_table not in tables:
+            raise Exception('Requested table {t} is not available to backup'
+                            ''.format(t=self.force_table))
+        else:
+            return set([self.force_table])
+
+    def check_replication_for_backup(self):
+        """ Confirm that replication is caught up enough to run """
+        while True:
+            heartbeat = mysql_lib.get_heartbeat(self.instance)
+            if heartbeat.date() < self.timestamp.date():
+                log.warning('Replicaiton is too lagged ({cur}) to run daily backup, '
+                            'sleeping'.format(cur=heartbeat))
+                time.sleep(10)
+            elif heartbeat.date() > self.timestamp.date():
+                raise Exception('Replication is later than expected day')
+            else:
+                log.info('Replicaiton is ok ({cur}) to run daily backup'
+                         ''.format(cur=heartbeat))
+                return
+
+    def setup_and_get_tmp_path(self):
+        """ Figure out where to temporarily store csv backups,
+            and clean it up
+        """
+        tmp_dir_root = os.path.join(host_utils.find_root_volume(),
+                                    'csv_export',
+                                    str(self.instance.port))
+        if not os.path.exists(tmp_dir_root):
+            os.makedirs(tmp_dir_root)
+        host_utils.change_owner(tmp_dir_root, 'mysql', 'mysql')
+        self.dump_base_path = tmp_dir_root
+
+
+def get_csv_delta_tables(instance, db):
+    """ Determine which tables of a db are exported as deltas
+
+    Args:
+    instance - A hostAddr object
+    db - The db
+
+    Returns:
+    A dict with a key of table name and a value of the column used as a
+    watermark. This should be an auto increment primary key for append only
+    tables, or an updated_at column if consumers merge updated rows.
 
-    def take_backup_lock(self, db):
+    A delta only covers rows visible when the previous watermark was read,
+    plus DELTA_OVERLAP_IDS or DELTA_OVERLAP_SECONDS below it. Rows committed
+    later than that below the watermark, ie from very long transactions or
+    updated_at values set in the past, are only picked up by the next full
+    export. Consumers must merge on the primary key, as the overlap exports
+    rows again.
+    """
+    if not hasattr(environment_specific, 'get_csv_delta_tables'):
+        return dict()
+    return environment_specific.get_csv_delta_tables(instance, db)
+
+
+class BackupLockManager(object):
+    """ Take, renew and release csv backup locks on the master. One of these
+        is used per process, sharing a single master connection and a single
+        thread which renews all held locks at once.
+    """
+
+    def __init__(self, instance):
+        """
+        Args:
+        instance - A hostAddr object of the instance being backed up
+        """
+        self.instance = instance
+        self.master_conn = None
+        self.conn_lock = threading.Lock()
+        # lock identifier => count of tables in flight in this process
+        self.held = dict()
+        self.held_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.keeper_thread = None
+        self.last_expired_release = 0
+
+    def execute(self, sql, params=None):
+        """ Run a statement against the master on the shared connection,
+            reconnecting once if the connection has gone away
+
+        Args:
+        sql - The statement to run
+        params - Parameters for the statement
+
+        Returns:
+        The rows returned by the statement
+        """
+        with self.conn_lock:
+            for attempt in range(2):
+                try:
+                    if not self.master_conn:
+                        zk = host_utils.MysqlZookeeper()
+                        (replica_set, _) = self.instance.get_zk_replica_set()
+                        master = zk.get_mysql_instance_from_replica_set(
+                                     replica_set,
+                                     host_utils.REPLICA_ROLE_MASTER)
+                        self.master_conn = mysql_lib.connect_mysql(master,
+                                                                   role='scriptrw')
+                    cursor = self.master_conn.cursor()
+                    cursor.execute(sql, params)
+                    self.master_conn.commit()
+                    log.debug(cursor._executed)
+                    return cursor.fetchall()
+                except _mysql_exceptions.OperationalError:
+                    self.master_conn = None
+                    if attempt:
+                        raise
+
+    def close(self):
+        """ Close the master connection """
+        with self.conn_lock:
+            if self.master_conn:
+                self.master_conn.close()
+                self.master_conn = None
+
+    def start_keeper(self):
+        """ Start the thread which renews held locks, if not already running """
+        if self.keeper_thread:
+            return
+        self.keeper_thread = threading.Thread(target=self.keep_locks)
+        self.keeper_thread.daemon = True
+        self.keeper_thread.start()
+
+    def stop_keeper(self):
+        """ Stop the thread which renews held locks """
+        if self.keeper_thread:
+            self.stop_event.set()
+            self.keeper_thread.join()
+            self.keeper_thread = None
+
+    def keep_locks(self):
+        """ Renew all held locks every LOCK_EXTEND_FREQUENCY seconds. This is
+            to be used by a thread.
+        """
+        while not self.stop_event.wait(LOCK_EXTEND_FREQUENCY):
+            with self.held_lock:
+                lock_identifiers = list(self.held)
+            if not lock_identifiers:
+                continue
+            try:
+                self.renew(lock_identifiers)
+            except Exception as e:
+                log.error('{proc_id}: Could not renew backup locks: {e}'
+                          ''.format(proc_id=multiprocessing.current_process().name,
+                                    e=e))
+
+    def renew(self, lock_identifiers):
+        """ Extend the expiry of a number of locks with a single UPDATE
+
+        Args:
+        lock_identifiers - A list of lock identifiers
+        """
+        params = dict(('lock{}'.format(i), lock_identifier)
+                      for (i, lock_identifier) in enumerate(lock_identifiers))
+        sql = ('UPDATE {db}.{tbl} '
+               'SET expires = NOW() + INTERVAL {locks_held_time} '
+               'WHERE lock_identifier IN ({locks}) AND '
+               '      lock_active is NOT NULL'
+               '').format(db=mysql_lib.METADATA_DB,
+                          tbl=CSV_BACKUP_LOCK_TABLE_NAME,
+                          locks_held_time=LOCKS_HELD_TIME,
+                          locks=', '.join('%({})s'.format(param)
+                                          for param in sorted(params)))
+        self.execute(sql, params)
+
+    def hold(self, lock_identifier):
+        """ Start renewing a lock, while a table it covers is in flight
+
+        Args:
+        lock_identifier - a uuid to identify a lock row
+        """
+        with self.held_lock:
+            self.held[lock_identifier] = self.held.get(lock_identifier, 0) + 1
+        self.start_keeper()
+
+    def unhold(self, lock_identifier):
+        """ Stop renewing a lock once no tables it covers are in flight in
+            this process
+
+        Args:
+        lock_identifier - a uuid to identify a lock row
+        """
+        with self.held_lock:
+            self.held[lock_identifier] -= 1
+            if not self.held[lock_identifier]:
+                del self.held[lock_identifier]
+
+    def take(self, db):
         """ Write a lock row on to the master
 
         Args:
         db - the db to be backed up
 
         Returns:
-        a uuid lock identifier
+        a uuid lock identifier, or None if the db is locked by another host
         """
-        zk = host_utils.MysqlZookeeper()
-        (replica_set, _) = self.instance.get_zk_replica_set()
-        master = zk.get_mysql_instance_from_replica_set(replica_set,
-                                                        host_utils.REPLICA_ROLE_MASTER)
-        master_conn = mysql_lib.connect_mysql(master, role='scriptrw')
-        cursor = master_conn.cursor()
-
         lock_identifier = str(uuid.uuid4())
-        log.debug('Taking backup lock: {replica_set} {db} '
-                  ''.format(replica_set=replica_set,
-                            db=db))
+        log.debug('Taking backup lock: {db}'.format(db=db))
         params = {'lock': lock_identifier,
                   'db': db,
                   'hostname': self.instance.hostname,
@@ -480,104 +1937,62 @@ class mysql_backup_csv:
                "").format(db=mysql_lib.METADATA_DB,
                           tbl=CSV_BACKUP_LOCK_TABLE_NAME,
                           locks_held_time=LOCKS_HELD_TIME)
-        cursor = master_conn.cursor()
         try:
-            cursor.execute(sql, params)
-            master_conn.commit()
+            self.execute(sql, params)
         except _mysql_exceptions.IntegrityError:
-            lock_identifier = None
-            sql = ("SELECT hostname, port, expires "
+            sql = ("SELECT lock_identifier, hostname, port, expires "
                    "FROM {db}.{tbl} "
                    "WHERE "
                    "    lock_active = %(active)s AND "
                    "    db = %(db)s"
                    "").format(db=mysql_lib.METADATA_DB,
                               tbl=CSV_BACKUP_LOCK_TABLE_NAME)
-            cursor.execute(sql,
-                           {'db': db, 'active': ACTIVE})
-            ret = cursor.fetchone()
-            log.debug('DB {db} is already being backed up on {hostname}:{port}, '
-                      'lock will expire at {expires}.'
-                      ''.format(db=db,
-                                hostname=ret['hostname'],
-                                port=ret['port'],
-                                expires=str(ret['expires'])))
+            ret = self.execute(sql, {'db': db, 'active': ACTIVE})
+            if ret and ret[0]['lock_identifier'] == lock_identifier:
+                # execute retried the INSERT after the connection went away,
+                # but the first attempt had already committed. The row is
+                # ours.
+                log.debug('Backup lock on {db} was taken by a retried insert'
+                          ''.format(db=db))
+                return lock_identifier
+            if ret:
+                log.debug('DB {db} is already being backed up on '
+                          '{hostname}:{port}, lock will expire at {expires}.'
+                          ''.format(db=db,
+                                    hostname=ret[0]['hostname'],
+                                    port=ret[0]['port'],
+                                    expires=str(ret[0]['expires'])))
+            return None
 
-        log.debug(cursor._executed)
         return lock_identifier
 
-    def extend_backup_lock(self, lock_identifier, extend_lock_stop_event):
-        """ Extend a backup lock. This is to be used by a thread
-
-        Args:
-        lock_identifier - Corrosponds to a lock identifier row in the
-                          CSV_BACKUP_LOCK_TABLE_NAME.
-        extend_lock_stop_event - An event that will be used to inform this
-                                 thread to stop extending the lock
-        """
-        # Assumption is that this is callled right after creating the lock
-        last_update = time.time()
-        while(not extend_lock_stop_event.is_set()):
-            if (time.time() - last_update) > LOCK_EXTEND_FREQUENCY:
-                zk = host_utils.MysqlZookeeper()
-                (replica_set, _) = self.instance.get_zk_replica_set()
-                master = zk.get_mysql_instance_from_replica_set(replica_set, host_utils.REPLICA_ROLE_MASTER)
-                master_conn = mysql_lib.connect_mysql(master, role='scriptrw')
-                cursor = master_conn.cursor()
-
-                params = {'lock_identifier': lock_identifier}
-                sql = ('UPDATE {db}.{tbl} '
-                       'SET expires = NOW() + INTERVAL {locks_held_time} '
-                       'WHERE lock_identifier = %(lock_identifier)s'
-                       '').format(db=mysql_lib.METADATA_DB,
-                                  tbl=CSV_BACKUP_LOCK_TABLE_NAME,
-                                  locks_held_time=LOCKS_HELD_TIME)
-                cursor.execute(sql, params)
-                master_conn.commit()
-                log.debug(cursor._executed)
-                last_update = time.time()
-            extend_lock_stop_event.wait(.5)
-
-    def release_db_backup_lock(self, lock_identifier):
-        """ Release a backup lock created by take_backup_lock
+    def release(self, lock_identifiers):
+        """ Release a batch of locks created by take
 
         Args:
-        lock_identifier - a uuid to identify a lock row
+        lock_identifiers - a list of uuids to identify lock rows
         """
-        zk = host_utils.MysqlZookeeper()
-        (replica_set, _) = self.instance.get_zk_replica_set()
-        master = zk.get_mysql_instance_from_replica_set(replica_set, host_utils.REPLICA_ROLE_MASTER)
-        master_conn = mysql_lib.connect_mysql(master, role='scriptrw')
-        cursor = master_conn.cursor()
-
-        params = {'lock_identifier': lock_identifier}
+        if not lock_identifiers:
+            return
+        params = dict(('lock{}'.format(i), lock_identifier)
+                      for (i, lock_identifier) in enumerate(lock_identifiers))
         sql = ('UPDATE {db}.{tbl} '
                'SET lock_active = NULL, released = NOW() '
-               'WHERE lock_identifier = %(lock_identifier)s AND '
+               'WHERE lock_identifier IN ({locks}) AND '
                '      lock_active is NOT NULL'
                '').format(db=mysql_lib.METADATA_DB,
-                          tbl=CSV_BACKUP_LOCK_TABLE_NAME)
-        cursor.execute(sql, params)
-        master_conn.commit()
-        log.debug(cursor._executed)
+                          tbl=CSV_BACKUP_LOCK_TABLE_NAME,
+                          locks=', '.join('%({})s'.format(param)
+                                          for param in sorted(params)))
+        self.execute(sql, params)
 
-    def ensure_backup_locks_sanity(self):
+    def ensure_sanity(self):
         """ Release any backup locks that aren't sane. This means locks
             created by the same host as the caller. The instance level flock
             should allow this assumption to be correct.
         """
-        zk = host_utils.MysqlZookeeper()
-        (replica_set, _) = self.instance.get_zk_replica_set()
-        master = zk.get_mysql_instance_from_replica_set(replica_set, host_utils.REPLICA_ROLE_MASTER)
-        master_conn = mysql_lib.connect_mysql(master, role='scriptrw')
-        cursor = master_conn.cursor()
-
-        if not mysql_lib.does_table_exist(master, mysql_lib.METADATA_DB,
-                                          CSV_BACKUP_LOCK_TABLE_NAME):
-            log.debug('Creating missing metadata table')
-            cursor.execute(CSV_BACKUP_LOCK_TABLE.format(db=mysql_lib.METADATA_DB,
-                                                        tbl=CSV_BACKUP_LOCK_TABLE_NAME))
-
+        self.execute(CSV_BACKUP_LOCK_TABLE.format(db=mysql_lib.METADATA_DB,
+                                                  tbl=CSV_BACKUP_LOCK_TABLE_NAME))
         params = {'hostname': self.instance.hostname,
                   'port': self.instance.port}
         sql = ('UPDATE {db}.{tbl} '
@@ -586,110 +2001,31 @@ class mysql_backup_csv:
                '     port = %(port)s'
                '').format(db=mysql_lib.METADATA_DB,
                           tbl=CSV_BACKUP_LOCK_TABLE_NAME)
-        cursor.execute(sql, params)
-        master_conn.commit()
-
-    def release_expired_locks(self):
-        """ Release any expired locks """
-        zk = host_utils.MysqlZookeeper()
-        (replica_set, _) = self.instance.get_zk_replica_set()
-        master = zk.get_mysql_instance_from_replica_set(replica_set, host_utils.REPLICA_ROLE_MASTER)
-        master_conn = mysql_lib.connect_mysql(master, role='scriptrw')
-        cursor = master_conn.cursor()
+        self.execute(sql, params)
 
+    def release_expired(self):
+        """ Release any expired locks, at most once per LOCK_EXTEND_FREQUENCY
+            seconds
+        """
+        if time.time() - self.last_expired_release < LOCK_EXTEND_FREQUENCY:
+            return
         sql = ('UPDATE {db}.{tbl} '
                'SET lock_active = NULL, released = NOW() '
                'WHERE expires < NOW()'
                '').format(db=mysql_lib.METADATA_DB,
                           tbl=CSV_BACKUP_LOCK_TABLE_NAME)
-        cursor.execute(sql)
-        master_conn.commit()
-        log.debug(cursor._executed)
+        self.execute(sql)
+        self.last_expired_release = time.time()
 
-    def purge_old_expired_locks(self):
+    def purge_old_expired(self):
         """ Delete any locks older than a week """
-        zk = host_utils.MysqlZookeeper()
-        (replica_set, _) = self.instance.get_zk_replica_set()
-        master = zk.get_mysql_instance_from_replica_set(replica_set, host_utils.REPLICA_ROLE_MASTER)
-        master_conn = mysql_lib.connect_mysql(master, role='scriptrw')
-        cursor = master_conn.cursor()
-
         sql = ('DELETE FROM {db}.{tbl} '
                'WHERE expires < NOW() - INTERVAL 1 WEEK AND '
                '        lock_active is NOT NULL '
                '').format(db=mysql_lib.METADATA_DB,
                           tbl=CSV_BACKUP_LOCK_TABLE_NAME)
-        cursor.execute(sql)
-        master_conn.commit()
-        log.debug(cursor._executed)
-
-    def already_backed_up(self, db):
-        """ Check to see if a db has already been uploaded to s3
-
-        Args:
-        db - The db to check for being backed up
-
-        Returns:
-        bool - True if the db has already been backed up, False otherwise
-        """
-        boto_conn = boto.connect_s3()
-        bucket = boto_conn.get_bucket(self.upload_bucket, validate=False)
-        for table in self.get_tables_to_backup(db):
-            (_, data_path, _) = environment_specific.get_csv_backup_paths(
-                                           self.datestamp, db, table,
-                                           self.instance.replica_type,
-                                           self.instance.get_zk_replica_set()[0])
-            if not bucket.get_key(data_path):
-                return False
-        return True
-
-    def get_tables_to_backup(self, db):
-        """ Determine which tables should be backed up in a db
-
-        Args:
-        db -  The db for which we need a list of tables eligible for backup
-
-        Returns:
-        a set of table names
-        """
-        tables = environment_specific.filter_tables_to_csv_backup(
-                     self.instance, db,
-                     mysql_lib.get_tables(self.instance, db, skip_views=True))
-        if not self.force_table:
-            return tables
-
-        if self.force_table not in tables:
-            raise Exception('Requested table {t} is not available to backup'
-                            ''.format(t=self.force_table))
-        else:
-            return set([self.force_table])
+        self.execute(sql)
 
-    def check_replication_for_backup(self):
-        """ Confirm that replication is caught up enough to run """
-        while True:
-            heartbeat = mysql_lib.get_heartbeat(self.instance)
-            if heartbeat.date() < self.timestamp.date():
-                log.warning('Replicaiton is too lagged ({cur}) to run daily backup, '
-                            'sleeping'.format(cur=heartbeat))
-                time.sleep(10)
-            elif heartbeat.date() > self.timestamp.date():
-                raise Exception('Replication is later than expected day')
-            else:
-                log.info('Replicaiton is ok ({cur}) to run daily backup'
-                         ''.format(cur=heartbeat))
-                return
-
-    def setup_and_get_tmp_path(self):
-        """ Figure out where to temporarily store csv backups,
-            and clean it up
-        """
-        tmp_dir_root = os.path.join(host_utils.find_root_volume(),
-                                    'csv_export',
-                                    str(self.instance.port))
-        if not os.path.exists(tmp_dir_root):
-            os.makedirs(tmp_dir_root)
-        host_utils.change_owner(tmp_dir_root, 'mysql', 'mysql')
-        self.dump_base_path = tmp_dir_root
 
 if __name__ == "__main__":
     environment_specific.initialize_logger()
@@ -1,11 +1,11 @@
 #!/usr/bin/python
 import argparse
-import copy
 import datetime
 import multiprocessing
 import os
 import sys
 import pprint
+import time
 
 import boto
 import mysql_backup_csv
@@ -19,6 +19,8 @@ BACKUP_OK_RETURN = 0
 BACKUP_MISSING_RETURN = 1
 BACKUP_NOT_IN_ZK_RETURN = 127
 CSV_CHECK_PROCESSES = 8
+# Keys missing from a listing are rechecked this many at a time
+CSV_RECHECK_BATCH = 32
 CSV_STARTUP = datetime.time(0, 15)
 CSV_COMPLETION_TIME = datetime.time(2, 30)
 MISSING_BACKUP_VERBOSE_LIMIT = 20
@@ -27,6 +29,17 @@ CSV_BACKUP_LOG_TABLE_DEFINITION = """CREATE TABLE {db}.{tbl} (
  `completion` datetime DEFAULT NULL,
  PRIMARY KEY (`backup_date`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1 """
+TIMING_TEMPLATE = '{shard_type:<30}{seconds:>10}'
+
+# Shared by all checks in a run, so that checking several shard types does
+# not start a pool or list a prefix more than once
+_check_pool = None
+_listing_cache = dict()
+_buckets = dict()
+_check_stats = {'ledger_keys': 0,
+                'lists': 0,
+                'listing_cache_hits': 0,
+                'rechecks': 0}
 
 
 def find_mysql_backup(replica_set, date, backup_type):
@@ -78,12 +91,19 @@ def verify_csv_backup(shard_type, date, instance=None):
         print 'Backups are currently running'
         return True
 
-    if shard_type in environment_specific.SHARDED_DBS_PREFIX_MAP:
-        ret = verify_sharded_csv_backup(shard_type, date, instance)
-    elif shard_type in environment_specific.FLEXSHARD_DBS:
-        ret = verify_flexsharded_csv_backup(shard_type, date, instance)
-    else:
-        ret = verify_unsharded_csv_backup(shard_type, date, instance)
+    # A caller checking several shard types starts the pool itself so that
+    # it is shared, otherwise it is shut down once this check is done
+    owns_check_pool = _check_pool is None
+    try:
+        if shard_type in environment_specific.SHARDED_DBS_PREFIX_MAP:
+            ret = verify_sharded_csv_backup(shard_type, date, instance)
+        elif shard_type in environment_specific.FLEXSHARD_DBS:
+            ret = verify_flexsharded_csv_backup(shard_type, date, instance)
+        else:
+            ret = verify_unsharded_csv_backup(shard_type, date, instance)
+    finally:
+        if owns_check_pool:
+            close_check_pool()
 
     if instance and ret:
         log_csv_backup_success(instance, date)
@@ -115,33 +135,53 @@ def verify_flexsharded_csv_backup(shard_type, date, instance=None):
             environment_specific.FLEXSHARD_DBS[shard_type]['example_shard_replica_set'],
             repl_type=host_utils.REPLICA_ROLE_SLAVE)
 
-    boto_conn = boto.connect_s3()
-    bucket = boto_conn.get_bucket(environment_specific.S3_CSV_BUCKET, validate=False)
+    bucket = get_csv_bucket()
     missing_uploads = set()
+    chk_instances = [zk.get_mysql_instance_from_replica_set(replica_set)
+                     for replica_set in replica_sets]
 
+    # Work out every key we expect, so that each prefix is listed once
+    expected = dict()
     for db in mysql_lib.get_dbs(schema_host):
         for table in mysql_backup_csv.mysql_backup_csv(schema_host).get_tables_to_backup(db):
-            if not verify_csv_schema_upload(shard_type, date, schema_host, db, [table]):
-                success = False
-                continue
-
-            table_missing_uploads = set()
-            for replica_set in replica_sets:
-                chk_instance = zk.get_mysql_instance_from_replica_set(replica_set)
+            (schema_path, _, _) = environment_specific.get_csv_backup_paths(
+                                      date, db, table, schema_host.replica_type,
+                                      schema_host.get_zk_replica_set()[0])
+            data_paths = set()
+            for chk_instance in chk_instances:
                 (_, data_path, success_path) = environment_specific.get_csv_backup_paths(
                                                    date, db, table, chk_instance.replica_type,
                                                    chk_instance.get_zk_replica_set()[0])
-                if not bucket.get_key(data_path):
-                    table_missing_uploads.add(data_path)
-                    success = False
+                data_paths.add(data_path)
+            expected[(db, table)] = (schema_path, data_paths, success_path)
+
+    ledger_master = zk.get_mysql_instance_from_replica_set(
+            environment_specific.FLEXSHARD_DBS[shard_type]['example_shard_replica_set'])
+    recorded_keys = get_ledger_keys(chk_instances + [ledger_master], date)
+    existing_keys = get_csv_key_index(bucket, expected.values(), date,
+                                      recorded_keys)
+    missing_keys = get_missing_keys(bucket, existing_keys,
+                                    [schema_path for (schema_path, _, _) in expected.values()] +
+                                    [data_path for (_, data_paths, _) in expected.values()
+                                     for data_path in data_paths])
+
+    success_paths = set()
+    for (db, table) in sorted(expected):
+        (schema_path, data_paths, success_path) = expected[(db, table)]
+        if schema_path in missing_keys:
+            print 'Expected schema files are missing: {missing}'.format(missing=set([schema_path]))
+            success = False
+            continue
 
-            if not table_missing_uploads and not instance:
-                if not bucket.get_key(success_path):
-                    print 'Creating success key {key}'.format(key=success_path)
-                    key = bucket.new_key(success_path)
-                    key.set_contents_from_string('')
+        table_missing_uploads = data_paths.intersection(missing_keys)
+        if table_missing_uploads:
+            success = False
+        elif not instance:
+            create_success_key(bucket, existing_keys, success_path)
+            success_paths.add(success_path)
 
-            missing_uploads.update(table_missing_uploads)
+        missing_uploads.update(table_missing_uploads)
+    record_ledger_keys(ledger_master, date, success_paths - recorded_keys)
 
     if missing_uploads:
         if len(missing_uploads) < MISSING_BACKUP_VERBOSE_LIMIT:
@@ -173,29 +213,41 @@ def verify_sharded_csv_backup(shard_type, date, instance=None):
     example_shard = environment_specific.SHARDED_DBS_PREFIX_MAP[shard_type]['example_shard']
     schema_host = zk.shard_to_instance(example_shard, repl_type=host_utils.REPLICA_ROLE_SLAVE)
     tables = mysql_backup_csv.mysql_backup_csv(schema_host).get_tables_to_backup(environment_specific.convert_shard_to_db(example_shard))
-    success = verify_csv_schema_upload(shard_type, date, schema_host,
-                                       environment_specific.convert_shard_to_db(example_shard), tables)
+    bucket = get_csv_bucket()
+    host_shard_map = zk.get_host_shard_map()
     if instance:
-        host_shard_map = zk.get_host_shard_map()
         (replica_set, replica_type) = zk.get_replica_set_from_instance(instance)
         master = zk.get_mysql_instance_from_replica_set(replica_set, host_utils.REPLICA_ROLE_MASTER)
         shards = host_shard_map[master.__str__()]
     else:
         shards = zk.get_shards_by_shard_type(shard_type)
+    ledger_master = zk.get_mysql_instance_from_replica_set(schema_host.get_zk_replica_set()[0],
+                                                           host_utils.REPLICA_ROLE_MASTER)
+    masters = set([ledger_master])
+    for (master, master_shards) in host_shard_map.iteritems():
+        if set(master_shards).intersection(shards):
+            masters.add(host_utils.HostAddr(master))
+    recorded_keys = get_ledger_keys(masters, date)
+    success = verify_csv_schema_upload(shard_type, date, schema_host,
+                                       environment_specific.convert_shard_to_db(example_shard), tables,
+                                       bucket, recorded_keys)
 
-    pool = multiprocessing.Pool(processes=CSV_CHECK_PROCESSES)
-    pool_args = list()
     if not tables:
         raise Exception('No tables will be checked for backups')
     if not shards:
         raise Exception('No shards will be checked for backups')
 
+    expected_s3_keys = set()
     for table in tables:
-        pool_args.append((table, shard_type, date, shards))
-    results = pool.map(get_missing_uploads, pool_args)
-    missing_uploads = set()
-    for result in results:
-        missing_uploads.update(result)
+        for shard in shards:
+            (_, data_path, _) = environment_specific.get_csv_backup_paths(
+                                    date, environment_specific.convert_shard_to_db(shard),
+                                    table, shard_type)
+            expected_s3_keys.add(data_path)
+    missing_uploads = get_missing_keys(bucket,
+                                       get_csv_key_index(bucket, [expected_s3_keys], date,
+                                                         recorded_keys),
+                                       expected_s3_keys)
 
     if missing_uploads or not success:
         if len(missing_uploads) < MISSING_BACKUP_VERBOSE_LIMIT:
@@ -212,64 +264,22 @@ def verify_sharded_csv_backup(shard_type, date, instance=None):
             print 'Instance {instance} is backed up'.format(instance=instance)
         else:
             # we have checked all shards, all are good, create success files
-            boto_conn = boto.connect_s3()
-            bucket = boto_conn.get_bucket(environment_specific.S3_CSV_BUCKET, validate=False)
+            success_paths = set()
             for table in tables:
                 (_, _, success_path) = environment_specific.get_csv_backup_paths(date,
                                                                                  environment_specific.convert_shard_to_db(example_shard),
                                                                                  table, shard_type)
-                if not bucket.get_key(success_path):
-                    print 'Creating success key {key}'.format(key=success_path)
-                    key = bucket.new_key(success_path)
-                    key.set_contents_from_string('')
+                success_paths.add(success_path)
+            existing_keys = get_csv_key_index(bucket, [success_paths], date,
+                                              recorded_keys)
+            for success_path in success_paths:
+                create_success_key(bucket, existing_keys, success_path)
+            record_ledger_keys(ledger_master, date, success_paths - recorded_keys)
             print 'Shard type {shard_type} is backed up'.format(shard_type=shard_type)
 
         return True
 
 
-def get_missing_uploads(args):
-    """ Check to see if all backups are present
-
-    Args: A tuple which can be expanded to:
-    table - table name
-    shard_type -  sharddb, etc
-    shards -  a set of shards
-
-    Returns: a set of shards which are not backed up
-    """
-    (table, shard_type, date, shards) = args
-    expected_s3_keys = set()
-    prefix = None
-
-    for shard in shards:
-        (_, data_path, _) = environment_specific.get_csv_backup_paths(
-                                date, environment_specific.convert_shard_to_db(shard),
-                                table, shard_type)
-        expected_s3_keys.add(data_path)
-        if not prefix:
-            prefix = os.path.dirname(data_path)
-
-    boto_conn = boto.connect_s3()
-    bucket = boto_conn.get_bucket(environment_specific.S3_CSV_BUCKET, validate=False)
-    uploaded_keys = set()
-    for key in bucket.list(prefix=prefix):
-        uploaded_keys.add(key.name)
-
-    missing_uploads = expected_s3_keys.difference(uploaded_keys)
-
-    for entry in copy.copy(missing_uploads):
-        # the list api occassionally has issues, so we will recheck any missing
-        # entries. If any are actually missing we will quit checking because
-        # there is definitely work that needs to be done
-        if bucket.get_key(entry):
-            print 'List method erronious did not return data for key:{entry}'.format(entry=entry)
-            missing_uploads.discard(entry)
-        else:
-            return missing_uploads
-
-    return missing_uploads
-
-
 def verify_unsharded_csv_backup(shard_type, date, instance):
     """ Verify that a non-sharded db has been backed up to hive
 
@@ -281,35 +291,45 @@ def verify_unsharded_csv_backup(shard_type, date, instance):
     Returns True for no problems found, False otherwise.
     """
     return_status = True
-    boto_conn = boto.connect_s3()
-    bucket = boto_conn.get_bucket(environment_specific.S3_CSV_BUCKET, validate=False)
+    bucket = get_csv_bucket()
     missing_uploads = set()
+    expected = dict()
     for db in mysql_lib.get_dbs(instance):
         tables = mysql_backup_csv.mysql_backup_csv(instance).get_tables_to_backup(db)
         for table in tables:
-            if not verify_csv_schema_upload(shard_type, date, instance, db,
-                                            set([table])):
-                return_status = False
-                print 'Missing schema for {db}.{table}'.format(db=db,
-                                                               table=table)
-                continue
-
-            (_, data_path, success_path) = \
-                environment_specific.get_csv_backup_paths(date, db, table,
-                                                          instance.replica_type,
-                                                          instance.get_zk_replica_set()[0])
-            if not bucket.get_key(data_path):
-                missing_uploads.add(data_path)
-            else:
-                # we still need to create a success file for the data
-                # team for this table, even if something else is AWOL
-                # later in the backup.
-                if bucket.get_key(success_path):
-                    print 'Key already exists {key}'.format(key=success_path)
-                else:
-                    print 'Creating success key {key}'.format(key=success_path)
-                    key = bucket.new_key(success_path)
-                    key.set_contents_from_string('')
+            expected[(db, table)] = environment_specific.get_csv_backup_paths(
+                                        date, db, table,
+                                        instance.replica_type,
+                                        instance.get_zk_replica_set()[0])
+
+    zk = host_utils.MysqlZookeeper()
+    ledger_master = zk.get_mysql_instance_from_replica_set(
+                        zk.get_replica_set_from_instance(instance)[0])
+    recorded_keys = get_ledger_keys([ledger_master], date)
+    existing_keys = get_csv_key_index(bucket, expected.values(), date,
+                                      recorded_keys)
+    missing_keys = get_missing_keys(bucket, existing_keys,
+                                    [path for (schema_path, data_path, _) in expected.values()
+                                     for path in (schema_path, data_path)])
+
+    success_paths = set()
+    for (db, table) in sorted(expected):
+        (schema_path, data_path, success_path) = expected[(db, table)]
+        if schema_path in missing_keys:
+            return_status = False
+            print 'Missing schema for {db}.{table}'.format(db=db,
+                                                           table=table)
+            continue
+
+        if data_path in missing_keys:
+            missing_uploads.add(data_path)
+        else:
+            # we still need to create a success file for the data
+            # team for this table, even if something else is AWOL
+            # later in the backup.
+            create_success_key(bucket, existing_keys, success_path)
+            success_paths.add(success_path)
+    record_ledger_keys(ledger_master, date, success_paths - recorded_keys)
 
     if missing_uploads:
         if len(missing_uploads) < MISSING_BACKUP_VERBOSE_LIMIT:
@@ -433,7 +453,7 @@ def csv_backup_success_logged(instance, date):
 
 
 def verify_csv_schema_upload(shard_type, date, instance, schema_db,
-                             tables):
+                             tables, bucket=None, recorded_keys=frozenset()):
     """ Confirm that schema files are uploaded
 
     Args:
@@ -443,25 +463,323 @@ def verify_csv_schema_upload(shard_type, date, instance, schema_db,
     schema_host - A host to examine to find which tables should exist
     schema_db - Which db to inxpect on schema_host
     tables - A set of which tables to check in schema_db for schema upload
+    bucket - (optional) A boto bucket object to reuse
+    recorded_keys - (optional) Keys known to exist per the csv backup
+                    ledger, see get_ledger_keys
 
     Returns True for no problems found, False otherwise.
     """
-    return_status = True
-    missing = set()
-    boto_conn = boto.connect_s3()
-    bucket = boto_conn.get_bucket(environment_specific.S3_CSV_BUCKET, validate=False)
+    if not bucket:
+        bucket = get_csv_bucket()
+    paths = set()
     for table in tables:
         (path, _, _) = environment_specific.get_csv_backup_paths(
                            date, schema_db, table,
                            instance.replica_type,
                            instance.get_zk_replica_set()[0])
-        if not bucket.get_key(path):
-            missing.add(path)
-            return_status = False
+        paths.add(path)
 
+    missing = get_missing_keys(bucket,
+                               get_csv_key_index(bucket, [paths], date,
+                                                 recorded_keys),
+                               paths)
     if missing:
         print 'Expected schema files are missing: {missing}'.format(missing=missing)
-    return return_status
+        return False
+    return True
+
+
+def get_csv_bucket():
+    """ Get the csv backup bucket, reusing a connection within a process
+
+    Returns:
+    A boto bucket object
+    """
+    pid = os.getpid()
+    if pid not in _buckets:
+        boto_conn = boto.connect_s3()
+        _buckets[pid] = boto_conn.get_bucket(environment_specific.S3_CSV_BUCKET,
+                                             validate=False)
+    return _buckets[pid]
+
+
+def get_check_pool():
+    """ Get the pool of processes used for listing and rechecking keys,
+        starting it if needed
+
+    Returns:
+    A multiprocessing.Pool
+    """
+    global _check_pool
+    if not _check_pool:
+        _check_pool = multiprocessing.Pool(processes=CSV_CHECK_PROCESSES)
+    return _check_pool
+
+
+def close_check_pool():
+    """ Shut down the pool started by get_check_pool, if any """
+    global _check_pool
+    if _check_pool:
+        _check_pool.close()
+        _check_pool.join()
+        _check_pool = None
+
+
+def list_prefix(prefix):
+    """ List a prefix of the csv bucket. Run in the check pool.
+
+    Args:
+    prefix - The prefix to list
+
+    Returns:
+    A set of key names
+    """
+    return set(key.name for key in get_csv_bucket().list(prefix=prefix))
+
+
+def key_exists(key_name):
+    """ Check for a key in the csv bucket. Run in the check pool.
+
+    Args:
+    key_name - The key to check
+
+    Returns:
+    True if the key exists, False otherwise
+    """
+    return bool(get_csv_bucket().get_key(key_name))
+
+
+def get_covering_prefix(prefix):
+    """ Find a cached listing which includes everything under a prefix
+
+    Args:
+    prefix - An s3 prefix
+
+    Returns:
+    The prefix of the cached listing, or None
+    """
+    for cached in _listing_cache:
+        if prefix.startswith(cached):
+            return cached
+    return None
+
+
+def list_prefixes(prefixes):
+    """ List prefixes of the csv bucket, concurrently and at most once per
+        run. The pages of a single LIST are fetched in sequence, as each
+        page starts from the marker of the previous one, so concurrency is
+        across prefixes.
+
+    Args:
+    prefixes - An iterable of prefixes
+
+    Returns:
+    A set of the names of all keys under the prefixes
+    """
+    prefixes = set(prefixes)
+    to_list = sorted(prefix for prefix in prefixes
+                     if not get_covering_prefix(prefix))
+    _check_stats['listing_cache_hits'] += len(prefixes) - len(to_list)
+    if to_list:
+        _check_stats['lists'] += len(to_list)
+        for (prefix, keys) in zip(to_list, get_check_pool().map(list_prefix, to_list)):
+            _listing_cache[prefix] = keys
+
+    ret = set()
+    for prefix in prefixes:
+        covering = get_covering_prefix(prefix)
+        if covering == prefix:
+            ret.update(_listing_cache[covering])
+        else:
+            ret.update(key for key in _listing_cache[covering]
+                       if key.startswith(prefix))
+    return ret
+
+
+def get_csv_key_index(bucket, path_groups, date, recorded_keys=frozenset()):
+    """ Build an index of the csv backup keys which exist for a date. Keys
+        recorded in the ledger are trusted, the rest are found by listing
+        each of their prefixes once rather than a HEAD per key
+
+    Args:
+    bucket - A boto bucket object, unused as listings are done in the
+             check pool
+    path_groups - An iterable of iterables of expected s3 key names, ie the
+                  tuples returned by get_csv_backup_paths. Any nested
+                  iterables of paths are flattened.
+    date - The date of the backup
+    recorded_keys - (optional) Keys known to exist per the csv backup
+                    ledger, see get_ledger_keys
+
+    Returns:
+    A set of the names of the expected keys which are recorded, and of the
+    keys which exist under the prefixes of the expected keys which are not
+    """
+    paths = set()
+    for group in path_groups:
+        for entry in group:
+            if isinstance(entry, basestring):
+                paths.add(entry)
+            else:
+                paths.update(entry)
+    ret = paths.intersection(recorded_keys)
+    unrecorded = paths.difference(recorded_keys)
+    if unrecorded:
+        ret.update(list_prefixes(backup.get_listing_prefixes(unrecorded, date)))
+    return ret
+
+
+def get_ledger_keys(masters, date):
+    """ Get the keys recorded in the csv backup ledgers of some masters
+
+    Args:
+    masters - An iterable of hostaddr objects of masters
+    date - The date of the backup
+
+    Returns:
+    A set of key names
+    """
+    ret = set()
+    args = [(master, date)
+            for master in sorted(set(master.__str__() for master in masters))]
+    for keys in get_check_pool().map(get_ledger_keys_from_master, args):
+        ret.update(keys)
+    _check_stats['ledger_keys'] += len(ret)
+    return ret
+
+
+def get_ledger_keys_from_master(args):
+    """ Get the keys recorded in the csv backup ledger of a master. Run in
+        the check pool.
+
+    Args: A tuple which can be expanded to:
+    master - A string of the master instance
+    date - The date of the backup
+
+    Returns:
+    A set of key names recorded for the production csv bucket
+    """
+    (master, date) = args
+    master = host_utils.HostAddr(master)
+    if not mysql_lib.does_table_exist(master, mysql_lib.METADATA_DB,
+                                      mysql_backup_csv.CSV_LEDGER_TABLE_NAME):
+        return set()
+
+    conn = mysql_lib.connect_mysql(master, 'scriptrw')
+    try:
+        cursor = conn.cursor()
+        sql = ('SELECT s3_key '
+               'FROM {METADATA_DB}.{CSV_LEDGER_TABLE} '
+               'WHERE backup_date = %(date)s AND '
+               '      bucket = %(bucket)s '
+               ''.format(METADATA_DB=mysql_lib.METADATA_DB,
+                         CSV_LEDGER_TABLE=mysql_backup_csv.CSV_LEDGER_TABLE_NAME))
+        cursor.execute(sql, {'date': date,
+                             'bucket': environment_specific.S3_CSV_BUCKET})
+        return set(row['s3_key'] for row in cursor.fetchall())
+    finally:
+        conn.close()
+
+
+def record_ledger_keys(master, date, keys):
+    """ Record keys created or found by verification, ie success keys, in the
+        csv backup ledger so later checks do not need to look for them in s3
+
+    Args:
+    master - A hostaddr object of the master whose ledger to write
+    date - The date of the backup
+    keys - An iterable of key names
+    """
+    keys = sorted(keys)
+    if not keys:
+        return
+
+    conn = mysql_lib.connect_mysql(master, 'scriptrw')
+    try:
+        cursor = conn.cursor()
+        cursor.execute(mysql_backup_csv.CSV_LEDGER_TABLE.format(
+                           db=mysql_lib.METADATA_DB,
+                           tbl=mysql_backup_csv.CSV_LEDGER_TABLE_NAME))
+        sql = ('REPLACE INTO {METADATA_DB}.{CSV_LEDGER_TABLE} '
+               '(backup_date, bucket, s3_key, db, tbl, bytes, uploaded) '
+               'VALUES (%s, %s, %s, "", "", 0, NOW())'
+               ''.format(METADATA_DB=mysql_lib.METADATA_DB,
+                         CSV_LEDGER_TABLE=mysql_backup_csv.CSV_LEDGER_TABLE_NAME))
+        cursor.executemany(sql, [(date, environment_specific.S3_CSV_BUCKET, key)
+                                 for key in keys])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_missing_keys(bucket, existing_keys, expected_keys):
+    """ Determine which expected keys are missing from an index built by
+        get_csv_key_index
+
+    Args:
+    bucket - A boto bucket object, unused as rechecks are done in the
+             check pool
+    existing_keys - A set returned by get_csv_key_index
+    expected_keys - An iterable of s3 key names
+
+    Returns:
+    A set of the expected keys which are missing
+    """
+    missing = set(expected_keys).difference(existing_keys)
+    to_recheck = sorted(missing)
+    # the list api occassionally has issues, so we will recheck any missing
+    # entries a batch at a time. Once one is actually missing we will quit
+    # checking because there is definitely work that needs to be done
+    for offset in range(0, len(to_recheck), CSV_RECHECK_BATCH):
+        batch = to_recheck[offset:offset + CSV_RECHECK_BATCH]
+        _check_stats['rechecks'] += len(batch)
+        found = get_check_pool().map(key_exists, batch)
+        for (entry, exists) in zip(batch, found):
+            if exists:
+                print 'List method erronious did not return data for key:{entry}'.format(entry=entry)
+                missing.discard(entry)
+        if not all(found):
+            break
+    return missing
+
+
+def create_success_key(bucket, existing_keys, success_path):
+    """ Create a success key for the data team if it does not already exist
+
+    Args:
+    bucket - A boto bucket object
+    existing_keys - A set returned by get_csv_key_index
+    success_path - The name of the success key
+    """
+    if success_path in existing_keys:
+        print 'Key already exists {key}'.format(key=success_path)
+        return
+
+    print 'Creating success key {key}'.format(key=success_path)
+    key = bucket.new_key(success_path)
+    key.set_contents_from_string('')
+    existing_keys.add(success_path)
+
+
+def print_check_timings(timings, total):
+    """ Print how long the csv checks took and how much s3 work they did
+
+    Args:
+    timings - A list of tuples of shard type and seconds
+    total - Total seconds for all checks
+    """
+    print TIMING_TEMPLATE.format(shard_type='shard type', seconds='seconds')
+    for (shard_type, seconds) in timings:
+        print TIMING_TEMPLATE.format(shard_type=shard_type,
+                                     seconds='{:.2f}'.format(seconds))
+    print TIMING_TEMPLATE.format(shard_type='total',
+                                 seconds='{:.2f}'.format(total))
+    print ('{ledger_keys} keys found in ledgers, {lists} prefixes listed, '
+           '{hits} listings served from cache, {rechecks} keys rechecked'
+           ''.format(ledger_keys=_check_stats['ledger_keys'],
+                     lists=_check_stats['lists'],
+                     hits=_check_stats['listing_cache_hits'],
+                     rechecks=_check_stats['rechecks']))
 
 
 def main():
@@ -560,9 +878,18 @@ def main():
                               int(split_date[2])) -
                 datetime.timedelta(days=1)).strftime("%Y-%m-%d")
 
-        for shard_type in shard_types:
-            if not verify_csv_backup(shard_type, date, instance):
-                return_code = BACKUP_MISSING_RETURN
+        timings = list()
+        run_start = time.time()
+        get_check_pool()
+        try:
+            for shard_type in shard_types:
+                start = time.time()
+                if not verify_csv_backup(shard_type, date, instance):
+                    return_code = BACKUP_MISSING_RETURN
+                timings.append((shard_type, time.time() - start))
+        finally:
+            close_check_pool()
+        print_check_timings(timings, time.time() - run_start)
 
     else:
         raise Exception('Backup type unsupported')
@@ -14,6 +14,14 @@ from lib import environment_specific
 
 MAX_ZK_WRITE_ATTEMPTS = 5
 WAIT_TIME_CONFIRM_QUIESCE = 10
+# Bounds on how often to poll replication lag during a failover
+LAG_POLL_MIN = 1
+LAG_POLL_MAX = 5
+# Heartbeat lag each tolerance accepts, used to estimate catch up time. With
+# REPLICATION_TOLERANCE_NONE the heartbeat is blocked by read_only, so there
+# is no estimate.
+LAG_TOLERANCE_TARGET_SBM = {mysql_lib.REPLICATION_TOLERANCE_NORMAL: mysql_lib.NORMAL_HEARTBEAT_LAG,
+                            mysql_lib.REPLICATION_TOLERANCE_LOOSE: mysql_lib.LOOSE_HEARTBEAT_LAG}
 
 
 def main():
@@ -375,8 +383,10 @@ def confirm_max_replica_lag(replicas, lag_tolerance, dead_master,
     else:
         replication_checks = mysql_lib.ALL_REPLICATION_CHECKS
 
+    trackers = dict()
     while True:
         acceptable = True
+        lagged_replicas = set()
         for replica in replicas:
             # Confirm threads are running, expected master
             try:
@@ -394,6 +404,7 @@ def confirm_max_replica_lag(replicas, lag_tolerance, dead_master,
             except Exception as e:
                 log.warning(e)
                 acceptable = False
+                lagged_replicas.add(replica)
 
         if replicas_synced and not confirm_replicas_in_sync(replicas):
             acceptable = False
@@ -406,8 +417,39 @@ def confirm_max_replica_lag(replicas, lag_tolerance, dead_master,
             raise Exception('Replication is not in an acceptable state on '
                             'replica {r}'.format(r=replica))
         else:
-            log.info('Sleeping for 5 second to allow replication to catch up')
-            time.sleep(5)
+            sleep_duration = LAG_POLL_MAX
+            for replica in lagged_replicas:
+                if lag_tolerance not in LAG_TOLERANCE_TARGET_SBM:
+                    break
+                # The estimate is only informational, so anything which
+                # goes wrong getting it is not fatal to the failover
+                try:
+                    replication = mysql_lib.calc_slave_lag(replica, dead_master)
+                except Exception as e:
+                    log.warning('Could not sample lag of {r}: {e}'
+                                ''.format(r=replica,
+                                          e=e))
+                    continue
+                # Replicas can also be flagged for IO lag
+                if replication['sbm'] <= LAG_TOLERANCE_TARGET_SBM[lag_tolerance]:
+                    continue
+
+                if replica not in trackers:
+                    trackers[replica] = mysql_lib.ReplicationLagTracker(
+                        LAG_TOLERANCE_TARGET_SBM[lag_tolerance])
+                trackers[replica].add_sample(replication)
+                estimate = trackers[replica].get_estimate()
+                log.info('Replica {r} estimated time to catch up: {eta} '
+                         'seconds (confidence {conf:.2f})'
+                         ''.format(r=replica,
+                                   eta=estimate['eta'],
+                                   conf=estimate['confidence']))
+                sleep_duration = min(sleep_duration,
+                                     trackers[replica].next_poll_interval(LAG_POLL_MIN,
+                                                                          LAG_POLL_MAX))
+            log.info('Sleeping for {s:.1f} seconds to allow replication to '
+                     'catch up'.format(s=sleep_duration))
+            time.sleep(sleep_duration)
 
 
 def is_master_alive(master, replicas):
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+import argparse
+import collections
+import datetime
+import multiprocessing.pool
+import os
+import shutil
+import subprocess
+import time
+
+import boto
+import boto.s3.key
+
+import archive_mysql_binlogs
+import mysql_restore
+from lib import backup
+from lib import binlog_index
+from lib import environment_specific
+from lib import host_utils
+from lib import mysql_lib
+
+# How many binlogs are downloaded and decompressed ahead of the one being
+# replayed. This also bounds how many binlogs are on local disk at once.
+PREFETCH_BINLOGS = 4
+PITR_DIR = '/tmp/mysql_pitr'
+TARGET_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+log = environment_specific.setup_logging_defaults(__name__)
+
+
+def main():
+    description = ('Restore a backup and replay archived binlogs on top of it '
+                   'up to a point in time')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-t',
+                        '--target_time',
+                        help=('Replay binlogs up to, but not including, this '
+                              'time in UTC. Format is YYYY-MM-DD HH:MM:SS'),
+                        required=True)
+    parser.add_argument('-b',
+                        '--backup_type',
+                        help='Type of backup to restore. Default is xtrabackup',
+                        default=backup.BACKUP_TYPE_XBSTREAM,
+                        choices=(backup.BACKUP_TYPE_LOGICAL,
+                                 backup.BACKUP_TYPE_XBSTREAM))
+    parser.add_argument('-s',
+                        '--source_instance',
+                        help=('Which instances backups to restore. Default is '
+                              'a best guess based on the hostname.'),
+                        default=None)
+    parser.add_argument('-d',
+                        '--date',
+                        help=('Restore a backup from a specific date. Default '
+                              'is the day before the target time, as backups '
+                              'from the day of the target may be from after '
+                              'it. The backup must be from before the target '
+                              'time.'))
+    parser.add_argument('-p',
+                        '--destination_port',
+                        help='Port on localhost on to restore. Default 3306.',
+                        default='3306')
+    parser.add_argument('--database',
+                        help=('Only replay statements for this database. '
+                              'Default is to replay everything.'),
+                        default=None)
+    parser.add_argument('--prefetch',
+                        help=('Number of binlogs to download ahead of '
+                              'replay. Default is {prefetch}'
+                              ''.format(prefetch=PREFETCH_BINLOGS)),
+                        default=PREFETCH_BINLOGS,
+                        type=int)
+    parser.add_argument('--skip_production_check',
+                        help=('DANGEROUS! Skip check of whether the instance '
+                              'to be built is already in use'),
+                        default=False,
+                        action='store_true')
+    args = parser.parse_args()
+
+    target_time = datetime.datetime.strptime(args.target_time,
+                                             TARGET_TIME_FORMAT)
+    if args.date:
+        date = args.date
+    else:
+        date = str(target_time.date() - datetime.timedelta(days=1))
+    if args.source_instance:
+        source = host_utils.HostAddr(args.source_instance)
+    else:
+        source = None
+    destination = host_utils.HostAddr(':'.join((host_utils.HOSTNAME,
+                                               args.destination_port)))
+
+    mysql_pitr(backup_type=args.backup_type,
+               restore_source=source,
+               destination=destination,
+               date=date,
+               target_time=target_time,
+               database=args.database,
+               prefetch=args.prefetch,
+               skip_production_check=args.skip_production_check)
+
+
+def mysql_pitr(backup_type, restore_source, destination, date, target_time,
+               database, prefetch, skip_production_check):
+    """ Restore a backup on to localhost, then replay the archived binlogs of
+        the master it was replicating from up to a point in time
+
+    Args:
+    backup_type - Type of backup to restore
+    restore_source - A hostaddr object for where to pull a backup from
+    destination - A hostaddr object for where to restore the backup
+    date - What date should the backup be from
+    target_time - A datetime in UTC to replay up to
+    database - If set, only replay statements for this database
+    prefetch - Number of binlogs to download ahead of replay
+    skip_production_check - Do not check if the host is already in zk for
+                            production use.
+    """
+    log.info('Restoring a backup, replication will be set up but not '
+             'started')
+    mysql_restore.restore_instance(backup_type=backup_type,
+                                   restore_source=restore_source,
+                                   destination=destination,
+                                   no_repl='SKIP',
+                                   date=date,
+                                   add_to_zk='SKIP',
+                                   skip_production_check=skip_production_check)
+
+    # The restore points replication at where the backup was taken, which is
+    # where replay starts
+    slave_status = mysql_lib.get_slave_status(destination)
+    binlog_host = host_utils.HostAddr(':'.join((slave_status['Master_Host'],
+                                                str(slave_status['Master_Port']))))
+    start_binlog = slave_status['Relay_Master_Log_File']
+    start_position = slave_status['Exec_Master_Log_Pos']
+    log.info('Backup was taken at {binlog}:{position} of {binlog_host}'
+             ''.format(binlog=start_binlog,
+                       position=start_position,
+                       binlog_host=binlog_host))
+
+    # Replication would replay the same binlogs again
+    mysql_lib.reset_slave(destination)
+
+    binlogs = binlog_index.get_binlogs_for_window(get_index_instance(binlog_host),
+                                                  binlog_host,
+                                                  start_binlog,
+                                                  start_position,
+                                                  target_time)
+    if not binlogs:
+        log.info('Backup is already at {target_time}, nothing to replay'
+                 ''.format(target_time=target_time))
+        return
+
+    log.info('Replaying {cnt} binlogs, {first} through {last}'
+             ''.format(cnt=len(binlogs),
+                       first=binlogs[0]['binlog'],
+                       last=binlogs[-1]['binlog']))
+    bucket = find_binlog_bucket(binlog_host, binlogs[0]['binlog'])
+    replay_binlogs(destination, binlog_host, bucket, binlogs, start_binlog,
+                   start_position, target_time, database, prefetch)
+    log.info('Point in time recovery to {target_time} complete'
+             ''.format(target_time=target_time))
+
+
+def get_index_instance(binlog_host):
+    """ Find an instance to query for the binlog index of a host
+
+    Args:
+    binlog_host - A hostAddr object of the instance which wrote the binlogs
+
+    Returns:
+    A hostAddr object of the current master of the replica set of
+    binlog_host, or binlog_host itself if the replica set is not in zk
+    """
+    replica_set = binlog_host.get_zk_replica_set()
+    if not replica_set:
+        return binlog_host
+
+    zk = host_utils.MysqlZookeeper()
+    return zk.get_mysql_instance_from_replica_set(replica_set[0],
+                                                  host_utils.REPLICA_ROLE_MASTER)
+
+
+def find_binlog_bucket(binlog_host, binlog):
+    """ Find which backup bucket holds the archived binlogs of a host
+
+    Args:
+    binlog_host - A hostAddr object of the instance which wrote the binlogs
+    binlog - The name of a binlog which should be archived
+
+    Returns:
+    A boto bucket object
+    """
+    conn = boto.connect_s3()
+    s3_path = archive_mysql_binlogs.s3_binlog_path(binlog_host, binlog)
+    for bucket_name in environment_specific.BACKUP_BUCKET_DOWNLOAD_MAP[host_utils.get_iam_role()]:
+        bucket = conn.get_bucket(bucket_name, validate=False)
+        if bucket.get_key(s3_path):
+            return bucket
+    raise Exception('Could not find {s3_path} in any backup bucket'
+                    ''.format(s3_path=s3_path))
+
+
+def replay_binlogs(destination, binlog_host, bucket, binlogs, start_binlog,
+                   start_position, target_time, database, prefetch):
+    """ Replay binlogs into a local instance. Binlogs are downloaded
+        concurrently ahead of replay and removed once replayed.
+
+        Every binlog is replayed through one mysql client session, so
+        temporary tables created by statement based replication survive
+        from one binlog to the next.
+
+    Args:
+    destination - A hostaddr object of the local instance
+    binlog_host - A hostAddr object of the instance which wrote the binlogs
+    bucket - A boto bucket object holding the archived binlogs
+    binlogs - A list of dicts as returned by
+              binlog_index.get_binlogs_for_window
+    start_binlog - The name of the binlog to start replay from
+    start_position - The position in start_binlog to start replay from
+    target_time - A datetime in UTC to replay up to
+    database - If set, only replay statements for this database
+    prefetch - Number of binlogs to download ahead of replay
+    """
+    if os.path.exists(PITR_DIR):
+        shutil.rmtree(PITR_DIR)
+    os.makedirs(PITR_DIR)
+
+    pool = multiprocessing.pool.ThreadPool(prefetch)
+    downloads = collections.deque()
+    pending = collections.deque(binlogs)
+    mysql_cmd = ['mysql', '--port', str(destination.port)]
+    log.info(' '.join(mysql_cmd))
+    mysql_proc = subprocess.Popen(mysql_cmd, stdin=subprocess.PIPE)
+    try:
+        while pending or downloads:
+            while pending and len(downloads) < prefetch:
+                binlog = pending.popleft()['binlog']
+                downloads.append(pool.apply_async(download_binlog,
+                                                  (binlog_host, bucket,
+                                                   binlog)))
+            local_file = downloads.popleft().get()
+            if os.path.basename(local_file) == start_binlog:
+                position = start_position
+                # Nothing has been replayed yet, so a backup from after the
+                # target is caught before the data is changed
+                event_time = binlog_index.get_event_time(local_file, position)
+                if event_time >= target_time:
+                    raise Exception('Restored backup is at {binlog}:{position}'
+                                    ', which was written at {event_time}, '
+                                    'after {target_time}. Restore an older '
+                                    'backup.'.format(binlog=start_binlog,
+                                                     position=position,
+                                                     event_time=event_time,
+                                                     target_time=target_time))
+            else:
+                position = None
+            replay_binlog(local_file, mysql_proc, position, target_time,
+                          database)
+            os.remove(local_file)
+        mysql_proc.stdin.close()
+        if mysql_proc.wait() != 0:
+            raise Exception('mysql exited with {ret} while replaying binlogs'
+                            ''.format(ret=mysql_proc.returncode))
+    finally:
+        pool.terminate()
+        pool.join()
+        if mysql_proc.poll() is None:
+            mysql_proc.kill()
+        shutil.rmtree(PITR_DIR, ignore_errors=True)
+
+
+def download_binlog(binlog_host, bucket, binlog):
+    """ Download and decompress an archived binlog
+
+    Args:
+    binlog_host - A hostAddr object of the instance which wrote the binlog
+    bucket - A boto bucket object holding the archived binlogs
+    binlog - The name of the binlog
+
+    Returns:
+    The local path of the decompressed binlog
+    """
+    key = boto.s3.key.Key(bucket,
+                          archive_mysql_binlogs.s3_binlog_path(binlog_host,
+                                                               binlog))
+    local_file = os.path.join(PITR_DIR, binlog)
+    procs = dict()
+    with open(local_file, 'wb') as handle:
+        procs['s3_download'] = backup.create_s3_download_proc(key)
+        procs['lzop'] = subprocess.Popen(['lzop', '--decompress',
+                                          '--to-stdout'],
+                                         stdin=procs['s3_download'].stdout,
+                                         stdout=handle)
+        while not host_utils.check_dict_of_procs(procs):
+            time.sleep(.5)
+    return local_file
+
+
+def replay_binlog(local_file, mysql_proc, start_position, target_time,
+                  database):
+    """ Replay a binlog through a running mysql client
+
+    Args:
+    local_file - The path to a decompressed binlog
+    mysql_proc - A mysql client process reading from a pipe
+    start_position - If set, the position in the binlog to start from
+    target_time - A datetime in UTC to replay up to
+    database - If set, only replay statements for this database
+    """
+    cmd = ['mysqlbinlog',
+           '--stop-datetime={target}'.format(target=target_time.strftime(TARGET_TIME_FORMAT))]
+    if start_position:
+        cmd.append('--start-position={position}'.format(position=start_position))
+    if database:
+        cmd.append('--database={database}'.format(database=database))
+    cmd.append(local_file)
+    log.info(' '.join(cmd + ['|']))
+
+    # mysqlbinlog reads --stop-datetime in the local timezone
+    env = dict(os.environ)
+    env['TZ'] = 'UTC'
+    proc = subprocess.Popen(cmd, stdout=mysql_proc.stdin, env=env)
+    if proc.wait() != 0:
+        raise Exception('mysqlbinlog exited with {ret} on {binlog}'
+                        ''.format(ret=proc.returncode,
+                                  binlog=local_file))
+    if mysql_proc.poll() is not None:
+        raise Exception('mysql exited with {ret} while replaying {binlog}'
+                        ''.format(ret=mysql_proc.returncode,
+                                  binlog=local_file))
+
+
+if __name__ == "__main__":
+    main()
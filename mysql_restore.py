@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 import argparse
+import calendar
 import datetime
+import os
 import subprocess
 import time
 
 import boto
+import boto.utils
 
 import modify_mysql_zk
 import mysql_backup
@@ -16,6 +19,27 @@ from lib import mysql_lib
 
 
 SCARY_TIMEOUT = 20
+# Used to estimate time to service for candidate backups
+DEFAULT_S3_THROUGHPUT = 100 * 1024 * 1024
+THROUGHPUT_SAMPLE_BYTES = 32 * 1024 * 1024
+# Bytes of backup processed per second after download, ie decompression and
+# apply log for xtrabackup, or import for mysqldump
+RESTORE_PROCESSING_RATE = {backup.BACKUP_TYPE_XBSTREAM: 150 * 1024 * 1024,
+                           backup.BACKUP_TYPE_LOGICAL: 15 * 1024 * 1024}
+# Bytes of replication logs replayed per second
+REPLAY_RATE = 5 * 1024 * 1024
+# Settings which speed up replaying replication logs at the expense of
+# durability. These are only ever used before an instance is in zk.
+CATCH_UP_SETTINGS = {'innodb_flush_log_at_trx_commit': 2,
+                     'sync_binlog': 0,
+                     'slave_parallel_workers': 8,
+                     'slave_pending_jobs_size_max': 1024 * 1024 * 1024,
+                     'innodb_change_buffer_max_size': 50}
+# Settings which only take effect once the SQL thread is restarted
+CATCH_UP_SQL_THREAD_SETTINGS = set(['slave_parallel_workers',
+                                    'slave_pending_jobs_size_max'])
+
+log = environment_specific.setup_logging_defaults(__name__)
 
 
 def main():
@@ -56,6 +80,11 @@ def main():
                               'to be built is already in use'),
                         default=False,
                         action='store_true')
+    parser.add_argument('--skip_catch_up_mode',
+                        help=('Do not relax durability settings while '
+                              'replication catches up'),
+                        default=False,
+                        action='store_true')
 
     args = parser.parse_args()
     if args.source_instance:
@@ -72,12 +101,13 @@ def main():
                      no_repl=args.no_repl,
                      date=args.date,
                      add_to_zk=args.add_to_zk,
-                     skip_production_check=args.skip_production_check)
+                     skip_production_check=args.skip_production_check,
+                     catch_up_mode=not args.skip_catch_up_mode)
 
 
 def restore_instance(backup_type, restore_source, destination,
                      no_repl, date,
-                     add_to_zk, skip_production_check):
+                     add_to_zk, skip_production_check, catch_up_mode=True):
     """ Restore a MySQL backup on to localhost
 
     Args:
@@ -90,6 +120,7 @@ def restore_instance(backup_type, restore_source, destination,
                 host being launched will be consulted.
     skip_production_check - Do not check if the host is already in zk for
                             production use.
+    catch_up_mode - Relax durability settings while replication catches up
     """
     log.info('Supplied source is {source}'.format(source=restore_source))
     log.info('Supplied destination is {dest}'.format(dest=destination))
@@ -130,6 +161,7 @@ def restore_instance(backup_type, restore_source, destination,
                                                'replication': no_repl,
                                                'zookeeper': add_to_zk})
     # Giant try to allow logging if anything goes wrong.
+    profiler = backup.RestoreProfiler()
     try:
         # If we hit an exception, this status will be used. If not, it will
         # be overwritten
@@ -137,11 +169,12 @@ def restore_instance(backup_type, restore_source, destination,
 
         # This also ensures that all needed directories exist
         log.info('Rebuilding local mysql instance')
-        mysql_init_server.mysql_init_server(destination, skip_production_check=True,
-                                            skip_backup=True, skip_locking=True)
+        with profiler.phase('mysql_init_server'):
+            mysql_init_server.mysql_init_server(destination, skip_production_check=True,
+                                                skip_backup=True, skip_locking=True)
 
         if backup_type == backup.BACKUP_TYPE_XBSTREAM:
-            xbstream_restore(backup_key, destination.port)
+            xbstream_restore(backup_key, destination.port, profiler)
             if master == restore_source:
                 log.info('Pulling replication info from restore to backup source')
                 (binlog_file, binlog_pos) = backup.parse_xtrabackup_binlog_info(destination.port)
@@ -150,21 +183,28 @@ def restore_instance(backup_type, restore_source, destination,
                          'master of backup source')
                 (binlog_file, binlog_pos) = backup.parse_xtrabackup_slave_info(destination.port)
         elif backup_type == backup.BACKUP_TYPE_LOGICAL:
-            logical_restore(backup_key, destination)
+            with profiler.phase('logical_restore', size=backup_key.size):
+                logical_restore(backup_key, destination)
             host_utils.stop_mysql(destination.port)
 
         log.info('Running MySQL upgrade')
-        host_utils.upgrade_auth_tables(destination.port)
+        with profiler.phase('upgrade_auth_tables'):
+            host_utils.upgrade_auth_tables(destination.port)
 
         log.info('Starting MySQL')
-        host_utils.start_mysql(destination.port,
-                               options=host_utils.DEFAULTS_FILE_EXTRA_ARG.format(defaults_file=host_utils.MYSQL_NOREPL_CNF_FILE))
+        with profiler.phase('start_mysql'):
+            host_utils.start_mysql(destination.port,
+                                   options=host_utils.DEFAULTS_FILE_EXTRA_ARG.format(defaults_file=host_utils.MYSQL_NOREPL_CNF_FILE))
 
         # Since we haven't started the slave yet, make sure we've got these
         # plugins installed, whether we use them or not.
         mysql_lib.setup_semisync_plugins(destination)
         restore_log_update = {'restore_status': 'OK'}
 
+        # Warm the buffer pool from the page list of the backup source while
+        # replication catches up.
+        buffer_pool_loading = start_buffer_pool_warm_up(destination)
+
         # Try to configure replication.
         log.info('Setting up MySQL replication')
         restore_log_update['replication'] = 'FAIL'
@@ -180,9 +220,17 @@ def restore_instance(backup_type, restore_source, destination,
             else:
                 mysql_lib.restart_replication(destination)
         if no_repl == 'REQ':
-            mysql_lib.wait_replication_catch_up(destination)
+            with profiler.phase('replication_catch_up') as phase:
+                phase['bytes'] = get_replication_bytes_behind(destination)
+                replication_catch_up(destination, catch_up_mode)
         restore_log_update['replication'] = 'OK'
 
+        if buffer_pool_loading:
+            log.info('Waiting for buffer pool warm up before the instance '
+                     'is put into service')
+            with profiler.phase('buffer_pool_load'):
+                mysql_lib.wait_buffer_pool_load(destination)
+
         host_utils.restart_pt_daemons(destination.port)
         mysql_lib.setup_response_time_metrics(destination)
 
@@ -197,6 +245,7 @@ def restore_instance(backup_type, restore_source, destination,
             log.info('Releasing lock')
             host_utils.release_flock_lock(lock_handle)
         backup.update_restore_log(master, row_id, restore_log_update)
+        backup.log_restore_phases(master, row_id, profiler)
 
     try:
         if add_to_zk == 'REQ':
@@ -301,13 +350,10 @@ def find_a_backup_to_restore(possible_sources, destination,
         for days in range(0, backup.DEFAULT_MAX_RESTORE_AGE):
             dates.append(datetime.date.today() - datetime.timedelta(days=days))
 
-    # Find a backup file with a preference for newer
+    # Find all backups in the window, they will be ranked by estimated time
+    # to service
     possible_keys = []
     for restore_date in dates:
-        if possible_keys:
-            # we are looping to older dates, if we already found some keys, we
-            # quit looking
-            continue
         log.info('Looking for a backup for {restore_date}'.format(restore_date=restore_date))
         for possible_source in possible_sources:
             try:
@@ -329,23 +375,291 @@ def find_a_backup_to_restore(possible_sources, destination,
     if not possible_keys:
         raise Exception('Could not find a backup to restore')
 
-    most_recent = None
+    return choose_fastest_backup(possible_keys, destination, backup_type)
+
+
+def choose_fastest_backup(possible_keys, destination, backup_type):
+    """ Rank backups by estimated time until a restored instance could be
+        put into service and return the fastest
+
+    Args:
+    possible_keys - A list of s3 keys of backups
+    destination - A hostaddr object for where to restore the backup
+    backup_type - What sort of backup is being restored
+
+    Returns:
+    The s3 key with the lowest estimated time to service. If replay can not
+    be estimated for every backup, the newest backup is returned instead, as
+    comparing backups without replay time favors old backups.
+    """
+    master = None
+    max_binlog_size = None
+    try:
+        zk = host_utils.MysqlZookeeper()
+        replica_set = destination.get_zk_replica_set()[0]
+        master = zk.get_mysql_instance_from_replica_set(replica_set,
+                                                        host_utils.REPLICA_ROLE_MASTER)
+        max_binlog_size = int(mysql_lib.get_global_variables(master)['max_binlog_size'])
+    except Exception as e:
+        log.warning('Unable to determine replication volume, replay time will '
+                    'not be considered: {e}'.format(e=e))
+        master = None
+
+    throughputs = dict()
+    estimates = list()
     for key in possible_keys:
-        if not most_recent:
-            most_recent = key
-        elif most_recent.last_modified < key.last_modified:
-            most_recent = key
+        if key.bucket.name not in throughputs:
+            throughputs[key.bucket.name] = measure_s3_throughput(key)
+
+        estimate = estimate_time_to_service(key, backup_type,
+                                            throughputs[key.bucket.name],
+                                            master, max_binlog_size)
+        log.info('Candidate s3://{bucket}/{key} size: {size}, '
+                 'download: {download:.0f}s, processing: {processing:.0f}s, '
+                 'binlogs to replay: {binlogs}, replay: {replay:.0f}s, '
+                 'estimated time to service: {total:.0f}s'
+                 ''.format(bucket=key.bucket.name,
+                           key=key.name,
+                           size=key.size,
+                           **estimate))
+        estimates.append((key, estimate))
+
+    if any(estimate['binlogs'] is None for (_, estimate) in estimates):
+        best = max(estimates,
+                   key=lambda candidate: boto.utils.parse_ts(candidate[0].last_modified))
+        log.info('Replay time is not known for every backup, using the '
+                 'newest backup: {key}'.format(key=best[0]))
+        return best[0]
+
+    best = min(estimates, key=lambda candidate: candidate[1]['total'])
+    log.info('Found a backup: {key}, estimated time to service is {total:.0f} '
+             'seconds'.format(key=best[0],
+                              total=best[1]['total']))
+    return best[0]
+
+
+def measure_s3_throughput(key):
+    """ Measure download throughput from the bucket of an s3 key
+
+    Args:
+    key - An s3 key, which should be larger than THROUGHPUT_SAMPLE_BYTES
+
+    Returns:
+    Bytes per second
+    """
+    try:
+        start = time.time()
+        data = key.get_contents_as_string(
+            headers={'Range': 'bytes=0-{}'.format(THROUGHPUT_SAMPLE_BYTES - 1)})
+        elapsed = time.time() - start
+        throughput = len(data) / elapsed
+        log.info('Measured throughput from bucket {bucket} of '
+                 '{rate:.1f} MB/sec'.format(bucket=key.bucket.name,
+                                            rate=throughput / 1024 / 1024))
+        return throughput
+    except Exception as e:
+        log.warning('Unable to measure throughput from bucket {bucket}, '
+                    'using default: {e}'.format(bucket=key.bucket.name,
+                                                e=e))
+        return DEFAULT_S3_THROUGHPUT
+
+
+def estimate_time_to_service(key, backup_type, throughput,
+                             master, max_binlog_size):
+    """ Estimate the time until a restored instance is caught up
+
+    Args:
+    key - An s3 key of a backup
+    backup_type - What sort of backup is being restored
+    throughput - Bytes per second that can be downloaded from the bucket
+    master - A hostaddr object of the master the restored instance will
+             replicate from, or None if unknown
+    max_binlog_size - The max binlog size on master
+
+    Returns:
+    A dict of estimated seconds for download, processing and replay, the
+    number of binlogs to replay, and total seconds
+    """
+    ret = {'download': key.size / float(throughput),
+           'processing': key.size / float(RESTORE_PROCESSING_RATE[backup_type]),
+           'binlogs': None,
+           'replay': 0}
+    if master:
+        # last_modified is UTC, binlog_creation is local time
+        created = datetime.datetime.fromtimestamp(
+            calendar.timegm(boto.utils.parse_ts(key.last_modified).timetuple()))
+        try:
+            ret['binlogs'] = mysql_lib.get_binlogs_archived_since(master,
+                                                                  created)
+            ret['replay'] = ret['binlogs'] * max_binlog_size / float(REPLAY_RATE)
+        except Exception as e:
+            log.warning('Unable to count binlogs to replay: {e}'.format(e=e))
+    ret['total'] = ret['download'] + ret['processing'] + ret['replay']
+    return ret
+
+
+def replication_catch_up(instance, catch_up_mode):
+    """ Wait for replication to catch up, optionally with settings that
+        favor replay speed over durability
+
+    Args:
+    instance - A hostaddr object for the replica
+    catch_up_mode - If set, apply CATCH_UP_SETTINGS until caught up
+    """
+    original_settings = None
+    if catch_up_mode:
+        original_settings = enable_catch_up_mode(instance)
+
+    try:
+        mysql_lib.wait_replication_catch_up(instance)
+    finally:
+        if original_settings:
+            disable_catch_up_mode(instance, original_settings)
+
+
+def enable_catch_up_mode(instance):
+    """ Apply CATCH_UP_SETTINGS to a replica which is not in zk
+
+    Args:
+    instance - A hostaddr object for the replica
+
+    Returns:
+    A dict of the settings prior to modification, to be passed to
+    disable_catch_up_mode. None if nothing was changed.
+    """
+    zk = host_utils.MysqlZookeeper()
+    if instance in zk.get_all_mysql_instances():
+        log.warning('Instance {i} is in zk, not enabling catch up mode'
+                    ''.format(i=instance))
+        return None
+
+    global_vars = mysql_lib.get_global_variables(instance)
+    new_settings = dict()
+    original_settings = dict()
+    for variable, value in CATCH_UP_SETTINGS.iteritems():
+        if variable not in global_vars:
+            log.info('Variable {v} is not supported by this version of '
+                     'MySQL, skipping'.format(v=variable))
+            continue
+        original_settings[variable] = global_vars[variable]
+        new_settings[variable] = value
+
+    if not new_settings:
+        return None
+
+    log.info('Enabling replication catch up mode')
+    apply_replication_settings(instance, new_settings)
+    return original_settings
+
+
+def disable_catch_up_mode(instance, original_settings):
+    """ Revert settings changed by enable_catch_up_mode
+
+    Args:
+    instance - A hostaddr object for the replica
+    original_settings - The return of enable_catch_up_mode
+    """
+    log.info('Disabling replication catch up mode')
+    settings = dict()
+    for variable, value in original_settings.iteritems():
+        # SHOW GLOBAL VARIABLES returns strings, but numeric variables
+        # can not be set from a string.
+        if value.isdigit():
+            value = int(value)
+        settings[variable] = value
+    apply_replication_settings(instance, settings)
+
+    global_vars = mysql_lib.get_global_variables(instance)
+    for variable, value in original_settings.iteritems():
+        if global_vars[variable] != value:
+            raise Exception('Failed to revert {v} to {value}, current value '
+                            'is {cur}'.format(v=variable,
+                                              value=value,
+                                              cur=global_vars[variable]))
+
+
+def apply_replication_settings(instance, settings):
+    """ Set global variables on a replica, restarting the SQL thread if
+        required for the settings to take effect
+
+    Args:
+    instance - A hostaddr object for the replica
+    settings - A dict of variable names to values
+    """
+    restart_sql_thread = bool(CATCH_UP_SQL_THREAD_SETTINGS.intersection(settings))
+    sql_thread_running = False
+    if restart_sql_thread:
+        ss = mysql_lib.get_slave_status(instance)
+        sql_thread_running = (ss['Slave_SQL_Running'] == 'Yes')
+        if sql_thread_running:
+            mysql_lib.stop_replication(instance,
+                                       mysql_lib.REPLICATION_THREAD_SQL)
+
+    try:
+        for variable, value in settings.iteritems():
+            mysql_lib.set_global_variable(instance, variable, value)
+    finally:
+        if sql_thread_running:
+            mysql_lib.start_replication(instance,
+                                        mysql_lib.REPLICATION_THREAD_SQL)
+
+
+def start_buffer_pool_warm_up(instance):
+    """ Start loading the buffer pool page list captured by the backup
+
+    Args:
+    instance - A hostaddr object for the restored instance on localhost
+
+    Returns:
+    True if a buffer pool load was started, False otherwise
+    """
+    try:
+        datadir = host_utils.get_cnf_setting('datadir', instance.port)
+        dump_file = mysql_lib.get_global_variables(instance)['innodb_buffer_pool_filename']
+        if not os.path.exists(os.path.join(datadir, dump_file)):
+            log.info('Backup did not include a buffer pool dump, the buffer '
+                     'pool will not be warmed up')
+            return False
+
+        log.info('Loading buffer pool from {f}'.format(f=dump_file))
+        mysql_lib.load_buffer_pool(instance)
+        return True
+    except Exception as e:
+        log.warning('Unable to start buffer pool warm up: {e}'.format(e=e))
+        return False
+
+
+def get_replication_bytes_behind(instance):
+    """ Determine how many bytes of replication logs a replica must process
+
+    Args:
+    instance - A hostaddr object for a replica
+
+    Returns:
+    The number of bytes behind or None if it can not be determined
+    """
+    try:
+        sql_bytes = mysql_lib.calc_slave_lag(instance)['sql_bytes']
+    except Exception as e:
+        log.warning('Could not determine replication lag in bytes: '
+                    '{e}'.format(e=e))
+        return None
 
-    log.info('Found a backup: {}'.format(key))
-    return most_recent
+    if sql_bytes == mysql_lib.INVALID:
+        return None
+    return sql_bytes
 
 
-def xbstream_restore(xbstream, port):
+def xbstream_restore(xbstream, port, profiler=None):
     """ Restore an xtrabackup file
 
     xbstream - An xbstream file in S3
     port - The port on which to act on on localhost
+    profiler - (optional) A backup.RestoreProfiler object to record timing
+               of each phase of the restore
     """
+    if not profiler:
+        profiler = backup.RestoreProfiler()
     datadir = host_utils.get_cnf_setting('datadir', port)
 
     log.info('Shutting down MySQL')
@@ -355,13 +669,18 @@ def xbstream_restore(xbstream, port):
     mysql_init_server.delete_mysql_data(port)
 
     log.info('Downloading and unpacking backup')
-    backup.xbstream_unpack(xbstream, datadir)
+    with profiler.phase('xbstream_unpack', size=xbstream.size):
+        backup.xbstream_unpack(xbstream, datadir)
 
     log.info('Decompressing compressed ibd files')
-    backup.innobackup_decompress(datadir)
+    with profiler.phase('innobackup_decompress') as phase:
+        backup.innobackup_decompress(datadir)
+        phase['bytes'] = host_utils.get_directory_size(datadir)
 
     log.info('Applying logs')
-    backup.apply_log(datadir)
+    with profiler.phase('apply_log') as phase:
+        phase['bytes'] = host_utils.get_directory_size(datadir)
+        backup.apply_log(datadir)
 
     log.info('Removing old innodb redo logs')
     mysql_init_server.delete_innodb_log_files(port)
@@ -412,5 +731,4 @@ def logical_restore(dump, destination):
         time.sleep(.5)
 
 if __name__ == "__main__":
-    log = environment_specific.setup_logging_defaults(__name__)
     main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import argparse
+import distutils.spawn
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+from lib import nullescape
+
+DEFAULT_SIZE = 256 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+LINE_TEMPLATE = '{implementation:<24}{backslashes:>14}{seconds:>10}{throughput:>12}'
+# Fraction of bytes which are backslashes
+BACKSLASH_RATES = [0, 0.0001, 0.01, 0.1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Measure the throughput of '
+                                                  'the null escape transform'))
+    parser.add_argument('--size',
+                        help=('Bytes of data to transform. Default is '
+                              '{size}'.format(size=DEFAULT_SIZE)),
+                        default=DEFAULT_SIZE,
+                        type=int)
+    parser.add_argument('--binary',
+                        help=('Path to a nullescape CLI to measure. Default '
+                              'is whatever is in the PATH.'),
+                        default=distutils.spawn.find_executable('nullescape'))
+    args = parser.parse_args()
+
+    print LINE_TEMPLATE.format(implementation='implementation',
+                               backslashes='backslashes',
+                               seconds='seconds',
+                               throughput='MB/sec')
+    for rate in BACKSLASH_RATES:
+        block = generate_block(rate)
+        blocks = args.size / len(block)
+
+        implementations = [('python', nullescape.NullEscaper(pure_python=True))]
+        if nullescape._library:
+            implementations.append(('libnullescape',
+                                    nullescape.NullEscaper()))
+        for (name, escaper) in implementations:
+            start = time.time()
+            for _ in range(blocks):
+                escaper.transform(block)
+            escaper.flush()
+            print_result(name, rate, blocks * len(block), time.time() - start)
+
+        if args.binary:
+            print_result(args.binary, rate, blocks * len(block),
+                         time_binary(args.binary, block, blocks))
+
+
+def generate_block(rate):
+    """ Generate a block of tab separated data in which roughly the supplied
+        fraction of bytes are escape sequences
+
+    Args:
+    rate - The fraction of bytes which should be backslashes
+
+    Returns:
+    A string of BLOCK_SIZE bytes
+    """
+    rand = random.Random(0)
+    data = bytearray(rand.choice(b'abcdefghij\t\n') for _ in range(BLOCK_SIZE))
+    for _ in range(int(BLOCK_SIZE * rate / 2)):
+        offset = rand.randint(0, BLOCK_SIZE - 2)
+        data[offset:offset + 2] = rand.choice([b'\\0', b'\\\\', b'\\t'])
+    return bytes(data)
+
+
+def time_binary(binary, block, blocks):
+    """ Time a nullescape CLI transforming data from a file
+
+    Args:
+    binary - The path to the CLI
+    block - A block of data
+    blocks - The number of times to repeat the block
+
+    Returns:
+    Elapsed seconds
+    """
+    with tempfile.TemporaryFile() as source:
+        for _ in range(blocks):
+            source.write(block)
+        source.seek(0)
+        with open(os.devnull, 'wb') as devnull:
+            start = time.time()
+            subprocess.check_call([binary], stdin=source, stdout=devnull)
+            return time.time() - start
+
+
+def print_result(implementation, rate, size, seconds):
+    print LINE_TEMPLATE.format(implementation=os.path.basename(implementation),
+                               backslashes='{:.2%}'.format(rate),
+                               seconds='{:.2f}'.format(seconds),
+                               throughput='{:.1f}'.format(size / seconds /
+                                                          1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+
+from lib import backup
+from lib import environment_specific
+from lib import host_utils
+
+DEFAULT_DAYS = 30
+LINE_TEMPLATE = ('{phase:<24}{restores:>10}{avg_duration:>14}'
+                 '{max_duration:>14}{pct_time:>10}{throughput:>18}')
+
+log = environment_specific.setup_logging_defaults(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report on where time is '
+                                                 'spent during restores')
+    parser.add_argument('-r',
+                        '--replica_set',
+                        help=('Restrict the report to a single replica set. '
+                              'Default is all replica sets.'),
+                        default=None)
+    parser.add_argument('-d',
+                        '--days',
+                        help=('How many days of restores to consider. Default '
+                              'is {days}.'.format(days=DEFAULT_DAYS)),
+                        default=DEFAULT_DAYS,
+                        type=int)
+    parser.add_argument('--successful_only',
+                        help='Only consider restores which completed OK',
+                        default=False,
+                        action='store_true')
+    args = parser.parse_args()
+
+    if args.replica_set:
+        replica_sets = [args.replica_set]
+    else:
+        zk = host_utils.MysqlZookeeper()
+        replica_sets = zk.get_all_mysql_replica_sets()
+
+    phases = get_phases(replica_sets, args.days)
+    if args.successful_only:
+        phases = [p for p in phases if p['restore_status'] == 'OK']
+
+    if not phases:
+        print 'No restore phase data found'
+        return
+
+    print_report(aggregate_phases(phases))
+
+
+def get_phases(replica_sets, days):
+    """ Pull restore phase timings from all requested replica sets
+
+    Args:
+    replica_sets - An iterable of replica set names
+    days - How many days of restores to consider
+
+    Returns:
+    A list of dicts, one per phase of a restore
+    """
+    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    results = pool.map(backup.get_restore_phase_stats,
+                       [(replica_set, days) for replica_set in replica_sets])
+    pool.close()
+    ret = []
+    for result in results:
+        ret.extend(result)
+    return ret
+
+
+def aggregate_phases(phases):
+    """ Aggregate phase timings across restores
+
+    Args:
+    phases - A list of dicts as returned by backup.get_restore_phase_stats
+
+    Returns:
+    A list of dicts, one per phase name, ordered by position in the restore
+    """
+    agg = dict()
+    total_time = 0
+    for phase in phases:
+        name = phase['phase']
+        if name not in agg:
+            agg[name] = {'phase': name,
+                         'order': phase['phase_order'],
+                         'restores': set(),
+                         'durations': [],
+                         'bytes': 0,
+                         'timed_bytes': 0}
+        duration = float(phase['duration'])
+        agg[name]['restores'].add((phase['replica_set'], phase['restore_id']))
+        agg[name]['durations'].append(duration)
+        agg[name]['order'] = max(agg[name]['order'], phase['phase_order'])
+        if phase['bytes']:
+            agg[name]['bytes'] += phase['bytes']
+            agg[name]['timed_bytes'] += duration
+        total_time += duration
+
+    ret = []
+    for entry in sorted(agg.values(), key=lambda e: e['order']):
+        durations = entry['durations']
+        if entry['timed_bytes']:
+            throughput = entry['bytes'] / entry['timed_bytes']
+        else:
+            throughput = None
+        ret.append({'phase': entry['phase'],
+                    'restores': len(entry['restores']),
+                    'avg_duration': sum(durations) / len(durations),
+                    'max_duration': max(durations),
+                    'pct_time': 100 * sum(durations) / total_time if total_time else 0,
+                    'throughput': throughput})
+    return ret
+
+
+def print_report(report):
+    """ Print aggregated phase timings
+
+    Args:
+    report - A list of dicts as returned by aggregate_phases
+    """
+    print LINE_TEMPLATE.format(phase='Phase',
+                               restores='Restores',
+                               avg_duration='Avg (sec)',
+                               max_duration='Max (sec)',
+                               pct_time='% time',
+                               throughput='MB/sec')
+    print '=' * 90
+    for entry in report:
+        if entry['throughput'] is None:
+            throughput = '-'
+        else:
+            throughput = '{:.1f}'.format(entry['throughput'] / 1024 / 1024)
+        print LINE_TEMPLATE.format(phase=entry['phase'],
+                                   restores=entry['restores'],
+                                   avg_duration='{:.1f}'.format(entry['avg_duration']),
+                                   max_duration='{:.1f}'.format(entry['max_duration']),
+                                   pct_time='{:.1f}'.format(entry['pct_time']),
+                                   throughput=throughput)
+
+
+if __name__ == "__main__":
+    main()
@@ -165,6 +165,51 @@ def safe_upload(precursor_procs, stdin, bucket, key,
         os.remove(term_path)
 
 
+def safe_stream_upload(stream, bucket, key,
+                       check_func=None, check_arg=None):
+    """ Safely upload data generated in process to s3, without the repeater
+
+    Args:
+    stream - An iterable of strings which will be uploaded in order
+    bucket - The s3 bucket where we should upload the data
+    key - The name of the key which will be the destination of the data
+    check_func - An optional function that if supplied will be run after the
+                 stream has been exhausted.
+    check_args - The arguments to supply to the check_func
+    """
+    uploader = None
+    devnull = open(os.devnull, 'w')
+    try:
+        uploader = subprocess.Popen([S3_SCRIPT, 'put',
+                                     '-k', urllib.quote_plus(key),
+                                     '-b', bucket],
+                                    stdin=subprocess.PIPE,
+                                    stderr=devnull)
+        for data in stream:
+            if uploader.poll() is not None:
+                raise Exception('Uploader exited before the stream was '
+                                'complete')
+            uploader.stdin.write(data)
+
+        if check_func:
+            check_func(check_arg)
+
+        # Closing stdin is what tells the uploader that the data is complete,
+        # so this must only happen after the stream has been checked.
+        uploader.stdin.close()
+        if uploader.wait() != 0:
+            raise Exception('Uploader encountered an error')
+    except:
+        # Kill the uploader before its stdin is closed so that under no
+        # circumstances the upload is successfull with bad data
+        if uploader and psutil.pid_exists(uploader.pid):
+            try:
+                uploader.kill()
+            except:
+                pass
+        raise
+
+
 def kill_precursor_procs(procs):
     """ In the case of a failure, we will need to kill off the precursor_procs
 
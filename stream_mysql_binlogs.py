@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import time
+import traceback
+
+import boto
+
+import archive_mysql_binlogs
+import mysql_cnf_builder
+import safe_uploader
+from lib import binlog_index
+from lib import environment_specific
+from lib import host_utils
+from lib import mysql_lib
+
+# Archived binlogs are complete, so the position within the binlog which is
+# being streamed is tracked separately
+BINLOG_STREAM_CHECKPOINT_TABLE_NAME = 'binlog_stream_checkpoints'
+BINLOG_STREAM_CHECKPOINT_TABLE = """CREATE TABLE IF NOT EXISTS {db}.{tbl} (
+  `hostname` varchar(90) NOT NULL,
+  `port` int(11) NOT NULL,
+  `binlog` varchar(90) NOT NULL,
+  `position` bigint unsigned NOT NULL,
+  `streamed_by` varchar(90) NOT NULL,
+  `updated` datetime NOT NULL,
+  PRIMARY KEY (`hostname`, `port`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1"""
+CHECKPOINT_INTERVAL = 60
+CHECKPOINT_SUFFIX = '.partial'
+POLL_INTERVAL = 5
+STREAM_DIR = '/tmp/binlog_stream'
+STREAM_LOCK_FILE = '/tmp/stream_mysql_binlogs.lock'
+STREAM_TERM_FILE = '/tmp/stream_mysql_binlogs.die'
+# server_ids are normally derived from an ip address, see
+# mysql_cnf_builder.hostname_to_server_id. Streamers use ids from this base
+# up, which is in the multicast range so will not collide with a real
+# server, offset by the low 24 bits of the local ip address and the last
+# digit of the local port so that streamers on different hosts do not
+# collide with each other.
+STREAM_SERVER_ID_BASE = 4000000000
+STREAM_SERVER_ID_HOST_MASK = 0xFFFFFF
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Continuously stream the '
+                                                  'binlogs of a replica set '
+                                                  'master to s3'))
+    parser.add_argument('-p',
+                        '--port',
+                        help=('Port of the local instance, whose replica set '
+                              'master will be streamed. Default is 3306'),
+                        default=3306,
+                        type=int)
+    args = parser.parse_args()
+    stream_mysql_binlogs(args.port)
+
+
+def stream_mysql_binlogs(port):
+    """ Stream binlogs from the master of the replica set of a local instance
+        until STREAM_TERM_FILE exists, following the master through failovers
+
+    Args:
+    port - Port of the local MySQL instance
+    """
+    zk = host_utils.MysqlZookeeper()
+    instance = host_utils.HostAddr(':'.join((host_utils.HOSTNAME,
+                                             str(port))))
+    replica_set = zk.get_replica_set_from_instance(instance)[0]
+    if replica_set is None:
+        log.info('Instance is not in production, exiting')
+        return
+
+    lock_handle = None
+    streamer = None
+    try:
+        log.info('Taking binlog streamer lock')
+        lock_handle = host_utils.take_flock_lock(STREAM_LOCK_FILE)
+        while not os.path.exists(STREAM_TERM_FILE):
+            try:
+                master = zk.get_mysql_instance_from_replica_set(replica_set)
+                if streamer and streamer.master.__str__() != master.__str__():
+                    log.info('Master of {replica_set} is now {master}, '
+                             'restarting stream'.format(replica_set=replica_set,
+                                                        master=master))
+                    streamer.stop()
+                    streamer = None
+                elif streamer and not streamer.running():
+                    log.error('mysqlbinlog exited, restarting stream')
+                    streamer.stop()
+                    streamer = None
+
+                if not streamer:
+                    streamer = BinlogStreamer(master, port)
+                    streamer.start()
+                streamer.archive_finished_binlogs()
+                streamer.checkpoint()
+            except:
+                # Whatever failed is retried on the next poll
+                log.error('error: {e}'.format(e=traceback.format_exc()))
+            time.sleep(POLL_INTERVAL)
+        log.info('Found {term_file}, exiting'.format(term_file=STREAM_TERM_FILE))
+    finally:
+        if streamer:
+            streamer.stop()
+        if lock_handle:
+            log.info('Releasing lock')
+            host_utils.release_flock_lock(lock_handle)
+
+
+class BinlogStreamer(object):
+    """ Stream the binlogs of a master with mysqlbinlog, archiving each binlog
+        once it is complete and checkpointing the one in progress
+    """
+
+    def __init__(self, master, port):
+        """
+        Args:
+        master - A hostAddr object of the master to stream from
+        port - Port of the local MySQL instance, used to pick a server_id
+        """
+        self.master = master
+        self.server_id = (STREAM_SERVER_ID_BASE +
+                          (mysql_cnf_builder.hostname_to_server_id(host_utils.HOSTNAME) &
+                           STREAM_SERVER_ID_HOST_MASK) * 10 +
+                          int(port) % 10)
+        self.stream_dir = os.path.join(STREAM_DIR,
+                                       '{hostname}-{port}'.format(hostname=master.hostname,
+                                                                  port=master.port))
+        self.bucket_name = environment_specific.BACKUP_BUCKET_UPLOAD_MAP[host_utils.get_iam_role()]
+        self.proc = None
+        self.master_conn = None
+        self.last_checkpoint = (None, 0)
+        self.last_checkpoint_time = 0
+
+    def start(self):
+        """ Start mysqlbinlog from the oldest binlog which is not archived """
+        self.master_conn = mysql_lib.connect_mysql(self.master, 'scriptrw')
+        archive_mysql_binlogs.ensure_binlog_archiving_table_sanity(self.master_conn)
+        cursor = self.master_conn.cursor()
+        cursor.execute(BINLOG_STREAM_CHECKPOINT_TABLE.format(db=mysql_lib.METADATA_DB,
+                                                             tbl=BINLOG_STREAM_CHECKPOINT_TABLE_NAME))
+        self.master_conn.commit()
+
+        # Anything left over from a previous run is not archived, so it will
+        # be streamed again
+        if os.path.exists(self.stream_dir):
+            shutil.rmtree(self.stream_dir)
+        os.makedirs(self.stream_dir)
+
+        start_binlog = self.get_start_binlog()
+        username, password = mysql_lib.get_mysql_user_for_role('replication')
+        cmd = ['mysqlbinlog',
+               '--read-from-remote-server',
+               '--raw',
+               '--stop-never',
+               '--stop-never-slave-server-id={server_id}'.format(server_id=self.server_id),
+               '--host={host}'.format(host=self.master.hostname),
+               '--port={port}'.format(port=self.master.port),
+               '--user={username}'.format(username=username),
+               '--password={password}'.format(password=password),
+               '--result-file={stream_dir}/'.format(stream_dir=self.stream_dir),
+               start_binlog]
+        log.info(' '.join(cmd).replace(password, 'REDACTED'))
+        self.proc = subprocess.Popen(cmd)
+
+    def running(self):
+        """ Check if mysqlbinlog is still running
+
+        Returns:
+        True if running, False otherwise
+        """
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self):
+        """ Stop mysqlbinlog, archiving what is complete and checkpointing
+            what is not
+        """
+        if self.running():
+            self.proc.terminate()
+            self.proc.wait()
+        try:
+            self.archive_finished_binlogs()
+            self.checkpoint(force=True)
+        except:
+            # ie the master is gone. Anything not archived will be streamed
+            # again, or is covered by the binlogs of the new master.
+            log.error('Could not archive or checkpoint on stop: {e}'
+                      ''.format(e=traceback.format_exc()))
+        finally:
+            if self.master_conn:
+                self.master_conn.close()
+                self.master_conn = None
+
+    def get_start_binlog(self):
+        """ Determine where streaming should start
+
+        Returns:
+        The name of the oldest binlog of the master which is not logged as
+        archived, or the current binlog if all others are
+        """
+        bin_logs = [binlog['Log_name'] for binlog in mysql_lib.get_master_logs(self.master)]
+        logged_uploads = archive_mysql_binlogs.get_logged_binlog_uploads(self.master)
+        for binlog in bin_logs:
+            if binlog not in logged_uploads:
+                return binlog
+        return bin_logs[-1]
+
+    def get_streamed_binlogs(self):
+        """ Get the binlogs which have been streamed to local disk
+
+        Returns:
+        A list of full paths, oldest first. All but the last are complete,
+        as mysqlbinlog only starts a file once the previous one is rotated.
+        """
+        return [os.path.join(self.stream_dir, binlog)
+                for binlog in sorted(os.listdir(self.stream_dir))]
+
+    def archive_finished_binlogs(self):
+        """ Upload, index and log the binlogs which are complete, then
+            remove them from local disk
+        """
+        finished = self.get_streamed_binlogs()[:-1]
+        if not finished:
+            return
+
+        entries = list()
+        for binlog in finished:
+            archive_mysql_binlogs.upload_binlog(self.master, binlog,
+                                                self.bucket_name, False)
+            entry = archive_mysql_binlogs.index_binlog(binlog)
+            if entry:
+                entries.append(entry)
+        binlog_index.record_binlog_index(self.master_conn, self.master,
+                                         entries)
+        archive_mysql_binlogs.log_binlog_uploads(self.master_conn,
+                                                 self.master, finished)
+
+        # Checkpoints may be left over from before a restart, so one is
+        # removed for every binlog whether or not this run wrote it
+        boto_conn = boto.connect_s3()
+        bucket = boto_conn.get_bucket(self.bucket_name, validate=False)
+        bucket.delete_keys([self.get_checkpoint_path(binlog)
+                            for binlog in finished])
+        for binlog in finished:
+            os.remove(binlog)
+
+    def checkpoint(self, force=False):
+        """ Upload what has been streamed of the current binlog, if it has
+            grown and CHECKPOINT_INTERVAL has passed
+
+        Args:
+        force - Checkpoint regardless of CHECKPOINT_INTERVAL
+        """
+        streamed = self.get_streamed_binlogs()
+        if not streamed:
+            return
+        if not force and time.time() - self.last_checkpoint_time < CHECKPOINT_INTERVAL:
+            return
+
+        binlog = streamed[-1]
+        # mysqlbinlog keeps appending, only the complete events written up to
+        # now are checkpointed
+        try:
+            position = binlog_index.parse_binlog(binlog)['end_position']
+        except:
+            # ie mysqlbinlog has not written a complete event yet
+            log.debug('Nothing to checkpoint in {binlog}: {e}'
+                      ''.format(binlog=binlog,
+                                e=traceback.format_exc()))
+            return
+        if (os.path.basename(binlog), position) == self.last_checkpoint:
+            return
+
+        s3_path = self.get_checkpoint_path(binlog)
+        log.debug('Checkpointing {binlog} at {position} to {s3_path}'
+                  ''.format(binlog=binlog,
+                            position=position,
+                            s3_path=s3_path))
+        procs = dict()
+        try:
+            procs['head'] = subprocess.Popen(['head', '-c', str(position),
+                                              binlog],
+                                             stdout=subprocess.PIPE)
+            procs['lzop'] = subprocess.Popen(['lzop'],
+                                             stdin=procs['head'].stdout,
+                                             stdout=subprocess.PIPE)
+            safe_uploader.safe_upload(precursor_procs=procs,
+                                      stdin=procs['lzop'].stdout,
+                                      bucket=self.bucket_name,
+                                      key=s3_path)
+        except:
+            safe_uploader.kill_precursor_procs(procs)
+            raise
+
+        cursor = self.master_conn.cursor()
+        sql = ("REPLACE INTO {metadata_db}.{tbl} "
+               "SET hostname = %(hostname)s, "
+               "    port = %(port)s, "
+               "    binlog = %(binlog)s, "
+               "    position = %(position)s, "
+               "    streamed_by = %(streamed_by)s, "
+               "    updated = NOW() ").format(metadata_db=mysql_lib.METADATA_DB,
+                                              tbl=BINLOG_STREAM_CHECKPOINT_TABLE_NAME)
+        cursor.execute(sql, {'hostname': self.master.hostname,
+                             'port': str(self.master.port),
+                             'binlog': os.path.basename(binlog),
+                             'position': position,
+                             'streamed_by': host_utils.HOSTNAME})
+        self.master_conn.commit()
+        self.last_checkpoint = (os.path.basename(binlog), position)
+        self.last_checkpoint_time = time.time()
+
+    def get_checkpoint_path(self, binlog):
+        """ Determine the path in s3 for a checkpoint of a binlog
+
+        Args:
+        binlog - A binlog filename
+
+        Returns:
+        A path in s3 alongside the archived binlogs of the master
+        """
+        return archive_mysql_binlogs.s3_binlog_path(self.master,
+                                                    ''.join((os.path.basename(binlog),
+                                                             CHECKPOINT_SUFFIX)))
+
+
+if __name__ == "__main__":
+    environment_specific.initialize_logger()
+    main()